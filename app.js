@@ -60,20 +60,46 @@ app.use('/ext/getmoneysupply', function(req,res){
 app.use('/ext/getaddress/:hash', function(req,res){
   db.get_address(req.param('hash'), function(address){
     if (address) {
-      var a_ext = {
-        address: address.a_id,
-        sent: (address.sent / 100000000),
-        received: (address.received / 100000000),
-        balance: (address.balance / 100000000).toString().replace(/(^-+)/mg, ''),
-        last_txs: address.txs,
-      };
-      res.send(a_ext);
+      db.get_address_txs(address, settings.txcount, null, function(history){
+        var a_ext = {
+          address: address.a_id,
+          sent: (address.sent / 100000000),
+          received: (address.received / 100000000),
+          balance: (address.balance / 100000000).toString().replace(/(^-+)/mg, ''),
+          // oldest first, as the embedded history was
+          last_txs: history.reverse().map(function(tx) {
+            return { addresses: tx.txid, type: tx.type };
+          }),
+        };
+        res.send(a_ext);
+      });
     } else {
       res.send({ error: 'address not found.', hash: req.param('hash')})
     }
   });
 });
 
+// one page of the history of an address, newest first. The next page
+// is requested with ?before=<blockindex>:<txid> of the last entry.
+app.use('/ext/getaddresstxs/:hash/:count', function(req,res){
+  db.get_address(req.param('hash'), function(address){
+    if (!address) {
+      return res.send({ error: 'address not found.', hash: req.param('hash')});
+    }
+    var count = Math.min(parseInt(req.param('count')) || settings.txcount, 1000);
+    var before = null;
+    if (req.query.before) {
+      var cursor = req.query.before.split(':');
+      before = {blockindex: parseInt(cursor[0]), txid: cursor[1]};
+    }
+    db.get_address_txs(address, count, before, function(history){
+      res.send({ address: address.a_id, txs: history.map(function(tx) {
+        return { txid: tx.txid, blockindex: tx.blockindex, type: tx.type };
+      })});
+    });
+  });
+});
+
 app.use('/ext/getbalance/:hash', function(req,res){
   db.get_address(req.param('hash'), function(address){
     if (address) {
@@ -84,6 +110,62 @@ app.use('/ext/getbalance/:hash', function(req,res){
   });
 });
 
+app.use('/ext/getaddressutxos/:hash', function(req,res){
+  db.get_address_utxos(req.param('hash'), function(utxos){
+    var u_ext = [];
+    for (var i = 0; i < utxos.length; i++) {
+      var key = utxos[i]._id.split(':');
+      u_ext.push({
+        txid: key[0],
+        vout: parseInt(key[1]),
+        height: utxos[i].height,
+        amount: (utxos[i].amount / 100000000),
+        tokens: utxos[i].tokens,
+      });
+    }
+    res.send({ address: req.param('hash'), utxos: u_ext });
+  });
+});
+
+app.use('/ext/getaddressmempool/:hash', function(req,res){
+  db.get_address_mempool(req.param('hash'), function(txs){
+    var m_ext = [];
+    for (var i = 0; i < txs.length; i++) {
+      m_ext.push({
+        txid: txs[i].txid,
+        timestamp: txs[i].timestamp,
+        total: (txs[i].total / 100000000),
+        vin: txs[i].vin,
+        vout: txs[i].vout,
+      });
+    }
+    res.send({ address: req.param('hash'), txs: m_ext });
+  });
+});
+
+app.use('/ext/gettokenholders/:tokenId/:count', function(req,res){
+  var count = Math.min(parseInt(req.param('count')) || settings.txcount, 1000);
+  db.get_token(req.param('tokenId'), function(token){
+    if (!token) {
+      return res.send({ error: 'token not found.', tokenId: req.param('tokenId')});
+    }
+    db.get_token_holders(token.t_id, count, function(holders){
+      res.send({ tokenId: token.t_id, num_holders: token.num_holders, holders: holders.map(function(holder) {
+        return { address: holder.a_id, amount: holder.amount };
+      })});
+    });
+  });
+});
+
+app.use('/ext/gettokentransfers/:tokenId/:count', function(req,res){
+  var count = Math.min(parseInt(req.param('count')) || settings.txcount, 1000);
+  db.get_token_transfers(req.param('tokenId'), count, function(transfers){
+    res.send({ tokenId: req.param('tokenId'), transfers: transfers.map(function(transfer) {
+      return { txid: transfer.txid, height: transfer.height, from: transfer.from, to: transfer.to, amount: transfer.amount };
+    })});
+  });
+});
+
 app.use('/ext/getdistribution', function(req,res){
   db.get_richlist(settings.coin, function(richlist){
     db.get_stats(settings.coin, function(stats){
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Compare the slotted AddressDelta records built by aggregate_addresses()
+with the nested dicts the address aggregation used before: time, peak
+memory, memory held by the result and time spent in the garbage
+collector for one flush worth of transactions.
+
+Runs on generated token heavy transactions, or on a recorded block
+range exported from the txes collection:
+
+    ./benchmarks/address_deltas.py --txs 100000
+    mongoexport -d explorerdb -c txes \\
+        -q '{"blockindex": {"$gte": 2500000, "$lt": 2501000}}' > txes.json
+    ./benchmarks/address_deltas.py --recorded txes.json
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from explorer_sync import aggregate_addresses
+
+
+def process_vout(vouts, addrs):
+    for out in vouts:
+        address = out["addresses"]
+        amount = out["amount"]
+        if addrs.get(address) is None:
+            tokens = []
+            for out_token in out.get("tokens", []):
+                tokens.append({
+                    "id": out_token["id"],
+                    "received": int(out_token.get("amount", "0")),
+                    "sent": 0,
+                    "meta": out_token.get("meta", {})
+                })
+            addrs[address] = {
+                "received": amount,
+                "sent": 0,
+                "tokens": tokens
+            }
+        else:
+            details = addrs[address]
+            details["received"] += amount
+            for out_token in out.get("tokens", []):
+                for addr_token in details["tokens"]:
+                    if addr_token["id"] == out_token["id"]:
+                        addr_token["received"] = addr_token.get(
+                            "received", 0) + int(out_token.get("amount", "0"))
+                        break
+                else:
+                    details["tokens"].append({
+                        "id": out_token["id"],
+                        "received": int(out_token.get("amount", "0")),
+                        "meta": out_token.get("meta", {})
+                    })
+    return addrs
+
+
+def process_vin(vins, addrs):
+    for vin in vins:
+        address = vin["addresses"]
+        amount = vin["amount"]
+        if addrs.get(address) is None:
+            tokens = []
+            for vin_token in vin.get("tokens", []):
+                tokens.append({
+                    "id": vin_token["id"],
+                    "sent": int(vin_token.get("amount", "0")),
+                    "received": 0,
+                    "meta": vin_token.get("meta", {})
+                })
+            addrs[address] = {
+                "sent": amount,
+                "received": 0,
+                "tokens": tokens
+            }
+        else:
+            details = addrs[address]
+            details["sent"] += amount
+            for vin_token in vin.get("tokens", []):
+                for addr_token in details["tokens"]:
+                    if addr_token["id"] == vin_token["id"]:
+                        addr_token["sent"] = addr_token.get(
+                            "sent", 0) + int(vin_token.get("amount", "0"))
+                        break
+                else:
+                    details["tokens"].append({
+                        "id": vin_token["id"],
+                        "sent": int(vin_token.get("amount", "0")),
+                        "meta": vin_token.get("meta", {})
+                    })
+    return addrs
+
+
+def merge_tokens(tokens):
+    merged = {}
+    for t in tokens:
+        token = merged.get(t["id"])
+        if token is None:
+            merged[t["id"]] = {
+                "id": t["id"],
+                "sent": t.get("sent", 0),
+                "received": t.get("received", 0),
+                "meta": t["meta"],
+            }
+        else:
+            token["sent"] += t.get("sent", 0)
+            token["received"] += t.get("received", 0)
+    return list(merged.values())
+
+
+def dict_deltas(transactions):
+    # without the txs history, which moved to address_txs on both sides
+    addrs = {}
+    for tx in transactions:
+        addrs = process_vout(tx["vout"], addrs)
+        addrs = process_vin(tx["vin"], addrs)
+    for details in addrs.values():
+        details["tokens"] = merge_tokens(details["tokens"])
+    return addrs
+
+
+def same(old, new):
+    if set(old) != set(new):
+        return False
+    for addr, details in old.items():
+        delta = new[addr]
+        if (details["sent"], details["received"]) != (delta.sent,
+                                                      delta.received):
+            return False
+        tokens = [(t["id"], t["sent"], t["received"]) for t in details["tokens"]]
+        if tokens != [(t.id, t.sent, t.received)
+                      for t in delta.tokens.values()]:
+            return False
+    return True
+
+
+def transaction(n, addresses, tokens):
+    def io(i, kind):
+        return {
+            "addresses": "N%033d" % ((n * 7 + i) % addresses),
+            "amount": 100000 + i,
+            "tokens": [{"id": "La%036d" % ((n + j) % 50), "amount": 10 + j,
+                        "meta": {"tokenName": "TOK%d" % ((n + j) % 50)}}
+                       for j in range(tokens if kind == "vout" else 1)],
+        }
+    return {
+        "txid": "%064x" % n,
+        "vin": [io(i, "vin") for i in range(2)],
+        "vout": [io(i + 2, "vout") for i in range(3)],
+    }
+
+
+def measure(fn, transactions):
+    collections = []
+
+    def on_gc(phase, info):
+        if phase == "start":
+            collections.append(time.perf_counter())
+        else:
+            collections[-1] = time.perf_counter() - collections[-1]
+
+    gc.collect()
+    gc.callbacks.append(on_gc)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(transactions)
+    elapsed = time.perf_counter() - start
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.callbacks.remove(on_gc)
+    return result, elapsed, peak, held, sum(collections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--txs", type=int, default=50000)
+    parser.add_argument("--addresses", type=int, default=20000)
+    parser.add_argument("--tokens-per-output", type=int, default=1)
+    parser.add_argument("--recorded", type=str,
+                        help="txes documents, one JSON document per line")
+    args = parser.parse_args()
+
+    if args.recorded:
+        with open(args.recorded) as f:
+            batch = [json.loads(line) for line in f if line.strip()]
+    else:
+        batch = [transaction(i, args.addresses, args.tokens_per_output)
+                 for i in range(args.txs)]
+
+    print("%d txs" % len(batch))
+    results = []
+    for name, fn in (("nested dicts", dict_deltas),
+                     ("AddressDelta", aggregate_addresses)):
+        result, elapsed, peak, held, gc_time = measure(fn, batch)
+        results.append(result)
+        print("%-13s %.3fs, peak %.1f MB, held %.1f MB, gc %.3fs" % (
+            name + ":", elapsed, peak / 1e6, held / 1e6, gc_time))
+        del result
+    if not same(*results):
+        sys.exit("the two aggregations disagree")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Benchmark the sync on a recorded block range, without a live node.
+
+A range is recorded once by syncing it through a proxy in front of the
+node and the ntp1api configured in settings.json. Replaying it serves
+the recorded answers from a local stand-in. Both sync into a throwaway
+mongo database, dropped afterwards, and report blocks/s, txs/s, RPC
+calls per block and flush timings:
+
+    ./benchmarks/replay.py record --explorer-config settings.json \\
+        --start 2500000 --end 2501000 -o range.json.gz
+    ./benchmarks/replay.py replay --explorer-config settings.json \\
+        --recording range.json.gz --prefetch-workers 8
+
+The mongo user of settings.json needs access to the benchmark database.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import pymongo
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import explorer_sync
+from standin import Recording, RecordingProxy, StandIn
+
+
+def mongo_uri(db_cfg):
+    return "mongodb://%s:%s@%s:%s/%s" % (
+        db_cfg["user"], db_cfg["password"], db_cfg["address"],
+        db_cfg["port"], db_cfg["database"])
+
+
+def make_daemon(args, standin, workdir, start):
+    """A Daemon syncing from the stand-in into an empty database, from
+    block start on"""
+    cfg = explorer_sync.get_explorer_config(args.explorer_config)
+    cfg["wallet"] = {"host": "127.0.0.1", "port": standin.port,
+                     "user": "bench", "pass": "bench"}
+    cfg["ntp1api"] = dict(cfg.get("ntp1api", {}), url=standin.url + "/ntp1")
+    cfg["dbsettings"]["database"] = args.database
+    if args.max_blocks:
+        cfg["sync_flush"] = dict(cfg.get("sync_flush", {}),
+                                 max_blocks=args.max_blocks)
+    pymongo.MongoClient(mongo_uri(cfg["dbsettings"])).drop_database(
+        args.database)
+    path = os.path.join(workdir, "settings.json")
+    with open(path, "w") as f:
+        json.dump(cfg, f)
+    daemon = explorer_sync.Daemon(path, args.prefetch_workers,
+                                  args.decode_workers)
+    # the sync picks up after the last height it has seen, a range
+    # starting at block 1 is synced from genesis
+    last = max(start - 1, 0)
+    daemon._db.db.coinstats.insert_one(
+        {"coin": cfg["coin"], "last": last, "count": last, "supply": 0})
+    return daemon
+
+
+def run(args, backend, start):
+    standin = StandIn(backend)
+    workdir = tempfile.mkdtemp(prefix="explorer-sync-bench-")
+    daemon = make_daemon(args, standin, workdir, start)
+    try:
+        began = time.time()
+        daemon._process_blocks()
+        elapsed = time.time() - began
+    finally:
+        standin.close()
+        if not args.keep_database:
+            daemon._db._db_conn.drop_database(args.database)
+    return report(standin, elapsed)
+
+
+def report(standin, elapsed, title=None):
+    """Print and return the numbers of a sync run, from the sync
+    metrics and the calls the stand-in got"""
+    if title is not None:
+        print("%s:" % title)
+    snapshot = explorer_sync.metrics.snapshot()
+    blocks = snapshot.get("blocks_synced_total", 0)
+    txs = snapshot.get("txs_synced_total", 0)
+    calls = sum(standin.calls.values())
+    flushes = dict((k[len("flush_seconds{stage="):-1], v)
+                   for k, v in snapshot.items()
+                   if k.startswith("flush_seconds{"))
+    result = {
+        "blocks": blocks,
+        "txs": txs,
+        "seconds": elapsed,
+        "blocks_per_second": blocks / elapsed,
+        "txs_per_second": txs / elapsed,
+        "rpc_calls": dict(standin.calls),
+        "rpc_calls_per_block": calls / max(blocks, 1),
+        "rpc_requests_per_block": standin.requests / max(blocks, 1),
+        "token_api_requests": standin.api_calls,
+        "flush_seconds": flushes,
+    }
+    print("%d blocks, %d txs in %.1fs: %.1f blocks/s, %.1f txs/s" % (
+        blocks, txs, elapsed, result["blocks_per_second"],
+        result["txs_per_second"]))
+    print("%.2f RPC calls in %.2f requests per block, %d token API requests"
+          % (result["rpc_calls_per_block"], result["rpc_requests_per_block"],
+             standin.api_calls))
+    for method, count in sorted(standin.calls.items()):
+        print("  %-20s %d" % (method, count))
+    print("flush timings (count, total, max):")
+    for stage, timing in sorted(flushes.items()):
+        print("  %-10s %4d %9.3fs %8.3fs" % (
+            stage, timing["count"], timing["sum"], timing["max"]))
+    return result
+
+
+def sync_arguments(parser):
+    """Options of the sync runs shared by the benchmarks"""
+    parser.add_argument("--explorer-config", required=True,
+                        help="settings.json with the mongo settings, and "
+                             "the node and ntp1api to record from")
+    parser.add_argument("--database", default="explorer-sync-benchmark",
+                        help="throwaway database synced into")
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--prefetch-workers", type=int, default=0)
+    parser.add_argument("--decode-workers", type=int, default=0)
+    parser.add_argument("--max-blocks", type=int,
+                        help="blocks per flush, overrides sync_flush")
+    parser.add_argument("--journal-depth", type=int,
+                        default=explorer_sync.JOURNAL_DEPTH,
+                        help="blocks from the tip that get undo records")
+    parser.add_argument("--json", help="also write the results here")
+    parser.add_argument("--log-level", default="WARNING")
+
+
+def setup(args):
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    explorer_sync.logger = logging.getLogger("sync")
+    explorer_sync.JOURNAL_DEPTH = args.journal_depth
+    # the Daemon changes to the directory of its settings
+    for name in ("explorer_config", "recording", "output", "json"):
+        if getattr(args, name, None):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("mode", choices=["record", "replay"])
+    sync_arguments(parser)
+    parser.add_argument("--start", type=int, help="first block to record")
+    parser.add_argument("--end", type=int, help="last block to record")
+    parser.add_argument("-o", "--output", help="recording written by record")
+    parser.add_argument("--recording", help="recording replayed by replay")
+    args = parser.parse_args()
+    setup(args)
+
+    if args.mode == "record":
+        if None in (args.start, args.end, args.output):
+            parser.error("record needs --start, --end and --output")
+        cfg = explorer_sync.get_explorer_config(args.explorer_config)
+        wallet = cfg["wallet"]
+        backend = RecordingProxy(
+            "http://%s:%s@%s:%s" % (wallet["user"], wallet["pass"],
+                                    wallet["host"], wallet["port"]),
+            cfg["ntp1api"]["url"], args.start, args.end)
+        result = run(args, backend, args.start)
+        backend.save(args.output)
+        print("recorded %d calls and %d token API answers to %s" % (
+            len(backend.calls), len(backend.api_calls), args.output))
+    else:
+        if args.recording is None:
+            parser.error("replay needs --recording")
+        backend = Recording.load(args.recording)
+        result = run(args, backend, args.start or backend.start)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Compare the copy on write sanitize() used before inserting documents
+with the json round trip and recursive key cleaning it replaced,
+on a batch of token heavy transactions.
+
+    ./benchmarks/sanitize.py --txs 5000
+"""
+
+import argparse
+import copy
+import decimal
+import os
+import sys
+import timeit
+
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from explorer_sync import sanitize
+
+
+def key_cleaner(d):
+    if isinstance(d, (str, int, float)):
+        return d
+    if isinstance(d, dict):
+        new = d.__class__()
+        for k, v in d.items():
+            new_key = k.replace('.', '_')
+            if new_key.startswith('$'):
+                new_key = '_' + new_key[1:]
+            new[new_key] = key_cleaner(v)
+    elif isinstance(d, (list, set, tuple)):
+        new = d.__class__(key_cleaner(v) for v in d)
+    else:
+        return d
+    return new
+
+
+def round_trip(transactions):
+    transactions = json.loads(json.dumps(transactions))
+    return key_cleaner(transactions)
+
+
+def token(n):
+    return {
+        "id": "La%036d" % n,
+        "amount": 1000 + n,
+        "issueTxid": "%064x" % n,
+        "divisibility": 7,
+        "lockStatus": True,
+        "aggregationPolicy": "aggregatable",
+        "meta": {
+            "tokenName": "TOK%d" % n,
+            "issuer": "someone",
+            "description": "a token",
+            "urls": [{"name": "icon", "url": "https://example.com/icon.png",
+                      "mimeType": "image/png"}],
+            "userData": {"meta": [{"key": "value", "weight": decimal.Decimal("1.5")}]},
+        },
+        "meta_of_utxo": {"userData": {"meta": [{"some.key": "value",
+                                                "$ref": "other"}]}},
+    }
+
+
+def transaction(n, tokens_per_output):
+    outs = []
+    for i in range(4):
+        outs.append({
+            "addresses": "N%033d" % (n * 4 + i),
+            "amount": 100000 + i,
+            "tokens": [token(n + j) for j in range(tokens_per_output)],
+        })
+    return {
+        "txid": "%064x" % n,
+        "blockhash": "%064x" % (n // 10),
+        "blockindex": n // 10,
+        "timestamp": 1500000000 + n,
+        "has_token": True,
+        "has_block_vote": False,
+        "is_cold_stake": False,
+        "total": 400006,
+        "vout": outs,
+        "vin": [{"addresses": "N%033d" % n, "amount": 400010,
+                 "tokens": [token(n)]}],
+        "__v": 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--txs", type=int, default=2000)
+    parser.add_argument("--tokens-per-output", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    batch = [transaction(i, args.tokens_per_output) for i in range(args.txs)]
+    copies = [copy.deepcopy(batch) for _ in range(args.repeat * 2)]
+    if round_trip(copy.deepcopy(batch)) != sanitize(copy.deepcopy(batch)):
+        sys.exit("sanitize() and the json round trip disagree")
+
+    old = timeit.timeit(lambda: round_trip(copies.pop()), number=args.repeat)
+    new = timeit.timeit(lambda: sanitize(copies.pop()), number=args.repeat)
+    print("%d txs, %d tokens per output" % (args.txs, args.tokens_per_output))
+    print("json round trip + keyCleaner: %.3fs per batch" % (old / args.repeat))
+    print("sanitize:                     %.3fs per batch" % (new / args.repeat))
+    print("speedup:                      %.1fx" % (old / new))
+
+
+if __name__ == "__main__":
+    main()
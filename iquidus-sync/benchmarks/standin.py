@@ -0,0 +1,229 @@
+"""Stand-ins for the coin daemon's JSON-RPC interface and for the
+ntp1api, so that explorer_sync.Daemon can be benchmarked without a
+live node.
+
+A StandIn serves a backend on a local port: JSON-RPC calls are POSTed
+to /, token metadata is fetched from /ntp1/tokenmetadata/. A Recording
+answers from calls recorded earlier, a RecordingProxy forwards to a
+real node and ntp1api and records their answers.
+"""
+
+import collections
+import gzip
+import http.server
+import threading
+import urllib.error
+import urllib.request
+
+import simplejson as json
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+
+
+API_PREFIX = "/ntp1/"
+
+
+class RpcError(Exception):
+
+    def __init__(self, code, message):
+        super(RpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class StandIn(object):
+    """Serves a backend from a background thread. The calls it gets are
+    counted by method"""
+
+    def __init__(self, backend, port=0):
+        self.backend = backend
+        self.requests = 0
+        self.calls = collections.Counter()
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # replies go out in two writes, headers and body
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length), use_decimal=True)
+                if isinstance(request, list):
+                    response = [standin._call(i) for i in request]
+                else:
+                    response = standin._call(request)
+                with standin._lock:
+                    standin.requests += 1
+                self._reply(200, json.dumps(response, use_decimal=True))
+
+            def do_GET(self):
+                if not self.path.startswith(API_PREFIX):
+                    self._reply(404, "not found", "text/plain")
+                    return
+                with standin._lock:
+                    standin.api_calls += 1
+                status, body = standin.backend.api(
+                    self.path[len(API_PREFIX):])
+                self._reply(status, body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), Handler)
+        self.port = self._server.server_address[1]
+        self.url = "http://127.0.0.1:%d" % self.port
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.calls = collections.Counter()
+            self.api_calls = 0
+
+    def _call(self, request):
+        method = request["method"]
+        with self._lock:
+            self.calls[method] += 1
+        response = {"id": request.get("id"), "result": None, "error": None}
+        try:
+            response["result"] = self.backend.rpc(
+                method, request.get("params", []))
+        except RpcError as err:
+            response["error"] = {"code": err.code, "message": err.message}
+        return response
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Recording(object):
+    """Answers recorded from a node and from the ntp1api. Calls are
+    keyed by method and params, token metadata by path. The tip is
+    pinned to the last block of the recorded range, start is its first
+    block"""
+
+    def __init__(self, tip=None, start=None):
+        self.tip = tip
+        self.start = start
+        self.calls = {}
+        self.api_calls = {}
+        self._hashes = None
+
+    @staticmethod
+    def key(method, params):
+        return json.dumps([method, params], use_decimal=True)
+
+    def rpc(self, method, params):
+        if method == "getbestblockhash":
+            return self.tip["hash"]
+        if method == "getblockcount":
+            return self.tip["height"]
+        answer = self.calls.get(self.key(method, params))
+        if answer is None and method == "getblockhash":
+            # recorded without prefetching, the blocks were fetched by
+            # following nextblockhash
+            return self._block_hash(params[0])
+        if answer is None:
+            raise RpcError(-32601, "%s%r was not recorded" % (
+                method, tuple(params)))
+        if answer.get("error") is not None:
+            raise RpcError(answer["error"]["code"], answer["error"]["message"])
+        return answer["result"]
+
+    def _block_hash(self, height):
+        if self._hashes is None:
+            self._hashes = {}
+            for answer in self.calls.values():
+                blk = answer.get("result")
+                if isinstance(blk, dict) and "height" in blk and "hash" in blk:
+                    self._hashes[blk["height"]] = blk["hash"]
+        if height not in self._hashes:
+            raise RpcError(-8, "Block height %d was not recorded" % height)
+        return self._hashes[height]
+
+    def api(self, path):
+        # a server error is never held against the token
+        return self.api_calls.get(path, (503, '"not recorded"'))
+
+    def save(self, path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt") as f:
+            json.dump({
+                "tip": self.tip,
+                "start": self.start,
+                "calls": self.calls,
+                "api_calls": self.api_calls,
+            }, f, use_decimal=True)
+
+    @classmethod
+    def load(cls, path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            data = json.load(f, use_decimal=True)
+        recording = cls(data["tip"], data["start"])
+        recording.calls = data["calls"]
+        recording.api_calls = dict(
+            (k, tuple(v)) for k, v in data["api_calls"].items())
+        return recording
+
+
+class RecordingProxy(Recording):
+    """Forwards the calls it has no answer for to a node and to the
+    ntp1api, and records the answers"""
+
+    def __init__(self, node_url, api_url, start, tip_height):
+        super(RecordingProxy, self).__init__(start=start)
+        self._node_url = node_url
+        self._api_url = api_url.rstrip("/") + "/"
+        self._lock = threading.Lock()
+        tip_hash = AuthServiceProxy(node_url).getblockhash(tip_height)
+        self.tip = {"hash": tip_hash, "height": tip_height}
+
+    def rpc(self, method, params):
+        if method in ("getbestblockhash", "getblockcount"):
+            return super(RecordingProxy, self).rpc(method, params)
+        key = self.key(method, params)
+        with self._lock:
+            answer = self.calls.get(key)
+            if answer is None:
+                # proxies are not thread safe
+                node = AuthServiceProxy(self._node_url)
+                try:
+                    answer = {"result": getattr(node, method)(*params)}
+                except JSONRPCException as err:
+                    answer = {"error": {"code": err.error["code"],
+                                        "message": err.error["message"]}}
+                self.calls[key] = answer
+        return super(RecordingProxy, self).rpc(method, params)
+
+    def api(self, path):
+        with self._lock:
+            answer = self.api_calls.get(path)
+        if answer is None:
+            try:
+                with urllib.request.urlopen(self._api_url + path,
+                                            timeout=30) as resp:
+                    answer = (resp.status, resp.read().decode())
+            except urllib.error.HTTPError as err:
+                answer = (err.code, err.read().decode())
+            except Exception:
+                # not recorded, tried again on the next request
+                return 503, '"unavailable"'
+            with self._lock:
+                self.api_calls[path] = answer
+        return answer
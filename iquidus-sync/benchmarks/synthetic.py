@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""Sync a generated neblio shaped chain, to see how the sync scales with
+the number of addresses, tokens and reorgs.
+
+Blocks hold a coinbase, a stake or cold stake, and regular transactions
+with a tunable fan-in and fan-out between a tunable number of
+addresses. Some of them issue NTP1 tokens or move them with utxo
+metadata, some blocks carry a vote. The chain is served by a local
+stand-in for the node and the ntp1api. After the initial sync, blocks
+are added one at a time and reorgs injected, the way the sync follows
+the tip:
+
+    ./benchmarks/synthetic.py --explorer-config settings.json \\
+        --blocks 20000 --addresses 3000000 --txs-per-block 50 \\
+        --tip-blocks 500 --reorg-every 50 --reorg-depth 3
+"""
+
+import argparse
+import decimal
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import explorer_sync
+from replay import make_daemon, report, setup, sync_arguments
+from standin import RpcError, StandIn
+
+
+COIN = 100000000
+FEE = 20000
+STAKE_REWARD = COIN
+GENESIS_TIME = 1500000000
+BLOCK_SPACING = 30
+
+P2PKH_ASM = "OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG"
+
+
+class UtxoPool(object):
+    """Unspent outputs, with O(1) removal of given and random ones"""
+
+    def __init__(self):
+        self._keys = []
+        self._pos = {}
+        self._utxos = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def add(self, key, utxo):
+        self._pos[key] = len(self._keys)
+        self._keys.append(key)
+        self._utxos[key] = utxo
+
+    def remove(self, key):
+        pos = self._pos.pop(key)
+        last = self._keys.pop()
+        if last != key:
+            self._keys[pos] = last
+            self._pos[last] = pos
+        return self._utxos.pop(key)
+
+    def pop_random(self, rng):
+        key = self._keys[rng.randrange(len(self._keys))]
+        return key, self.remove(key)
+
+
+class SyntheticChain(object):
+    """A chain generated block by block as the sync asks for it. Block
+    hashes only depend on the branch and the height, so the tip is known
+    before its block is generated. Only the last `retain` blocks are
+    kept, reorgs cannot go deeper than that."""
+
+    def __init__(self, height, addresses=10000, txs_per_block=20,
+                 fan_in=2, fan_out=3, token_ratio=0.2, issue_ratio=0.01,
+                 meta_ratio=0.3, cold_stake_ratio=0.2, vote_ratio=0.1,
+                 premine_blocks=10, retain=10000, seed=1):
+        self.tip = height
+        self._addresses = addresses
+        self._txs_per_block = txs_per_block
+        self._fan_in = fan_in
+        self._fan_out = fan_out
+        self._token_ratio = token_ratio
+        self._issue_ratio = issue_ratio
+        self._meta_ratio = meta_ratio
+        self._cold_stake_ratio = cold_stake_ratio
+        self._vote_ratio = vote_ratio
+        self._premine_blocks = premine_blocks
+        self._retain = retain
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+        # (first height, branch) of the main chain
+        self._branches = [(0, 0)]
+        self._branch = 0
+        self._generated = -1
+        self._blocks = {}
+        self._stale = {}
+        self._undo = {}
+        self._txs = {}
+        self._plain = UtxoPool()
+        self._tokened = UtxoPool()
+        self._tokens = {}
+        self._supply = 0
+        self._ntx = 0
+
+    def _branch_at(self, height):
+        for start, branch in reversed(self._branches):
+            if height >= start:
+                return branch
+
+    def block_hash(self, height):
+        branch = self._branch_at(height)
+        digest = hashlib.sha256(b"%d:%d" % (branch, height)).hexdigest()
+        return "%08x%08x%s" % (branch, height, digest[16:])
+
+    def advance(self, blocks=1):
+        with self._lock:
+            self.tip += blocks
+
+    def reorg(self, depth, extend=1):
+        """Replace the last depth blocks with a new branch, longer by
+        extend blocks"""
+        with self._lock:
+            if depth >= min(self._retain, self.tip):
+                raise ValueError("Reorg deeper than the retained blocks")
+            self._generate_to(self.tip)
+            fork = self.tip - depth
+            for height in range(self.tip, fork, -1):
+                self._disconnect(height)
+            self._branch += 1
+            self._branches.append((fork + 1, self._branch))
+            self.tip += extend
+
+    def _address(self, index=None):
+        if index is None:
+            index = self._rng.randrange(self._addresses)
+        return "N%033d" % index
+
+    def _txid(self):
+        self._ntx += 1
+        return hashlib.sha256(b"tx:%d" % self._ntx).hexdigest()
+
+    def _output(self, n, address, value, tokens=(), cold_staker=None):
+        if cold_staker is not None:
+            script = {
+                "asm": "OP_COLDSTAKE %s %s" % (cold_staker, address),
+                "type": "coldstake",
+                "addresses": [cold_staker, address],
+            }
+        else:
+            script = {
+                "asm": P2PKH_ASM % address,
+                "type": "pubkeyhash",
+                "addresses": [address],
+            }
+        return {
+            "value": decimal.Decimal(value) / COIN,
+            "n": n,
+            "scriptPubKey": script,
+            "tokens": list(tokens),
+        }
+
+    def _empty_output(self):
+        return {
+            "value": decimal.Decimal(0),
+            "n": 0,
+            "scriptPubKey": {"asm": "", "type": "nonstandard"},
+            "tokens": [],
+        }
+
+    def _spend(self, pool, undo, key=None):
+        if key is None:
+            key, utxo = pool.pop_random(self._rng)
+        else:
+            utxo = pool.remove(key)
+        undo["spent"].append((key, utxo))
+        return key, utxo
+
+    def _create(self, undo, txid, out, cold_staker=None):
+        utxo = {
+            "address": out["scriptPubKey"]["addresses"][-1],
+            "value": int(out["value"] * COIN),
+            "tokens": out["tokens"],
+            "cold_staker": cold_staker,
+        }
+        key = (txid, out["n"])
+        if utxo["tokens"]:
+            self._tokened.add(key, utxo)
+        else:
+            self._plain.add(key, utxo)
+        undo["created"].append(key)
+
+    def _vin(self, key):
+        return {
+            "txid": key[0],
+            "vout": key[1],
+            "scriptSig": {"asm": "3045022100 02ab"},
+            "sequence": 4294967295,
+        }
+
+    def _tx(self, txid, vin, vout, timestamp):
+        return {
+            "txid": txid,
+            "version": 1,
+            "time": timestamp,
+            "locktime": 0,
+            "vin": vin,
+            "vout": vout,
+        }
+
+    def _coinbase(self, height, undo, timestamp):
+        txid = self._txid()
+        vin = [{"coinbase": "%08x" % height, "sequence": 4294967295}]
+        if height < self._premine_blocks:
+            amount = 10000000 * COIN
+            out = self._output(0, self._address(), amount)
+            self._create(undo, txid, out)
+            undo["supply"] += amount
+        else:
+            out = self._empty_output()
+        return self._tx(txid, vin, [out], timestamp)
+
+    def _coinstake(self, blk, undo, timestamp):
+        if len(self._plain) == 0:
+            return None
+        txid = self._txid()
+        key, utxo = self._spend(self._plain, undo)
+        staker = utxo["cold_staker"]
+        if staker is None and self._rng.random() < self._cold_stake_ratio:
+            staker = self._address()
+        out = self._output(1, utxo["address"],
+                           utxo["value"] + STAKE_REWARD, cold_staker=staker)
+        self._create(undo, txid, out, staker)
+        undo["supply"] += STAKE_REWARD
+        if self._rng.random() < self._vote_ratio:
+            blk["votevalue"] = {
+                "ProposalID": "%064x" % self._rng.randrange(16),
+                "VoteValue": self._rng.randrange(2),
+            }
+        return self._tx(txid, [self._vin(key)],
+                        [self._empty_output(), out], timestamp)
+
+    def _token(self, token_id, amount):
+        token = self._tokens[token_id]
+        return {
+            "tokenId": token_id,
+            "amount": amount,
+            "issueTxid": token["issueTxid"],
+            "divisibility": 0,
+            "lockStatus": True,
+            "aggregationPolicy": "aggregatable",
+            "metadataOfIssuance": token["metadataOfIssuance"],
+        }
+
+    def _issue(self, txid, height):
+        token_id = "La%036d" % len(self._tokens)
+        name = "TOK%d" % len(self._tokens)
+        self._tokens[token_id] = {
+            "tokenId": token_id,
+            "issueTxid": txid,
+            "firstBlock": height,
+            "someUtxo": "%s:0" % txid,
+            "metadataOfIssuance": {"data": {
+                "tokenName": name,
+                "description": "Synthetic token %s" % name,
+                "issuer": "benchmark",
+                "urls": [{"name": "icon",
+                          "url": "https://example.com/%s.png" % name,
+                          "mimeType": "image/png"}],
+            }},
+        }
+        return token_id, self._rng.randrange(1000, 10 ** 9)
+
+    def _transfer(self, height, undo, timestamp):
+        rng = self._rng
+        txid = self._txid()
+        inputs = []
+        if len(self._tokened) and rng.random() < self._token_ratio:
+            inputs.append(self._spend(self._tokened, undo))
+        n_in = rng.randint(1, self._fan_in)
+        while len(inputs) < n_in and len(self._plain):
+            inputs.append(self._spend(self._plain, undo))
+        if not inputs:
+            return None
+        total = sum(utxo["value"] for _, utxo in inputs)
+        total -= min(FEE, total // 2)
+        # token amounts carried over from the inputs
+        tokens = {}
+        for _, utxo in inputs:
+            for t in utxo["tokens"]:
+                tokens[t["tokenId"]] = tokens.get(t["tokenId"], 0) + t["amount"]
+        if rng.random() < self._issue_ratio:
+            token_id, amount = self._issue(txid, height)
+            tokens[token_id] = amount
+        n_out = rng.randint(1, self._fan_out)
+        cuts = sorted(rng.randrange(total + 1) for _ in range(n_out - 1))
+        values = [b - a for a, b in zip([0] + cuts, cuts + [total])]
+        out_tokens = [[] for _ in range(n_out)]
+        for token_id, amount in tokens.items():
+            if n_out > 1 and rng.random() < 0.5:
+                part = rng.randint(1, amount) if amount > 1 else amount
+                out_tokens[0].append(self._token(token_id, part))
+                if amount - part > 0:
+                    out_tokens[1].append(self._token(token_id, amount - part))
+            else:
+                out_tokens[0].append(self._token(token_id, amount))
+        vout = [self._output(n, self._address(), values[n], out_tokens[n])
+                for n in range(n_out)]
+        tx = self._tx(txid, [self._vin(key) for key, _ in inputs], vout,
+                      timestamp)
+        if tokens and rng.random() < self._meta_ratio:
+            tx["metadataOfUtxos"] = {"userData": {"meta": [
+                {"From": "benchmark"},
+                {"order.id": "%d" % self._ntx},
+                {"$note": "keys the sync has to clean"},
+            ]}}
+        for out in vout:
+            self._create(undo, txid, out)
+        return tx
+
+    def _generate(self, height):
+        blk_hash = self.block_hash(height)
+        timestamp = GENESIS_TIME + height * BLOCK_SPACING + self._branch
+        undo = {"spent": [], "created": [], "supply": 0}
+        blk = {
+            "hash": blk_hash,
+            "height": height,
+            "version": 2,
+            "time": timestamp,
+            "flags": "proof-of-stake",
+        }
+        if height > 0:
+            blk["previousblockhash"] = self.block_hash(height - 1)
+        txs = [self._coinbase(height, undo, timestamp)]
+        if height >= self._premine_blocks:
+            txs.append(self._coinstake(blk, undo, timestamp))
+            for _ in range(self._txs_per_block):
+                txs.append(self._transfer(height, undo, timestamp))
+        blk["tx"] = [tx for tx in txs if tx is not None]
+        for n, tx in enumerate(blk["tx"]):
+            self._txs[tx["txid"]] = (height, n)
+        self._supply += undo["supply"]
+        self._blocks[height] = blk
+        self._undo[height] = undo
+        self._generated = height
+        old = height - self._retain
+        if old in self._blocks:
+            for tx in self._blocks.pop(old)["tx"]:
+                del self._txs[tx["txid"]]
+            del self._undo[old]
+        for stale_hash in [h for h, b in self._stale.items()
+                           if b["height"] <= old]:
+            del self._stale[stale_hash]
+
+    def _disconnect(self, height):
+        blk = self._blocks.pop(height)
+        undo = self._undo.pop(height)
+        for key, utxo in undo["spent"]:
+            if utxo["tokens"]:
+                self._tokened.add(key, utxo)
+            else:
+                self._plain.add(key, utxo)
+        for key in undo["created"]:
+            if key in self._tokened:
+                self._tokened.remove(key)
+            else:
+                self._plain.remove(key)
+        for tx in blk["tx"]:
+            del self._txs[tx["txid"]]
+        self._supply -= undo["supply"]
+        self._stale[blk["hash"]] = blk
+        self._generated = height - 1
+
+    def _generate_to(self, height):
+        while self._generated < height:
+            self._generate(self._generated + 1)
+
+    def _block(self, blk_hash):
+        """A block of the main chain or a stale one, with the fields
+        that depend on the tip"""
+        try:
+            branch, height = int(blk_hash[:8], 16), int(blk_hash[8:16], 16)
+        except ValueError:
+            branch, height = None, None
+        if (height is not None and height <= self.tip and
+                self._branch_at(height) == branch):
+            if height <= self._generated - self._retain:
+                raise RpcError(-5, "Block no longer kept by the generator")
+            self._generate_to(height)
+            blk = dict(self._blocks[height])
+            blk["confirmations"] = self.tip - height + 1
+            if height < self.tip:
+                blk["nextblockhash"] = self.block_hash(height + 1)
+            return blk
+        if blk_hash in self._stale:
+            return dict(self._stale[blk_hash], confirmations=-1)
+        raise RpcError(-5, "Block not found")
+
+    def rpc(self, method, params):
+        with self._lock:
+            if method == "getbestblockhash":
+                return self.block_hash(self.tip)
+            if method == "getblockcount":
+                return self.tip
+            if method == "getblockhash":
+                if not 0 <= params[0] <= self.tip:
+                    raise RpcError(-8, "Block height out of range")
+                return self.block_hash(params[0])
+            if method == "getblock":
+                blk = self._block(params[0])
+                if len(params) < 3 or not params[2]:
+                    blk["tx"] = [tx["txid"] for tx in blk["tx"]]
+                return blk
+            if method == "getrawtransaction":
+                if params[0] not in self._txs:
+                    raise RpcError(
+                        -5, "No information available about transaction")
+                height, n = self._txs[params[0]]
+                tx = dict(self._blocks[height]["tx"][n])
+                tx["blockhash"] = self.block_hash(height)
+                tx["confirmations"] = self.tip - height + 1
+                return tx
+            if method == "getinfo":
+                self._generate_to(self.tip)
+                return {"blocks": self.tip,
+                        "moneysupply": decimal.Decimal(self._supply) / COIN}
+            if method == "getrawmempool":
+                return []
+        raise RpcError(-32601, "Method not found")
+
+    def api(self, path):
+        parts = path.split("/")
+        if len(parts) < 2 or parts[0] != "tokenmetadata":
+            return 404, '"not found"'
+        with self._lock:
+            token = self._tokens.get(parts[1])
+        if token is None:
+            return 404, '"Token not found"'
+        metadata = dict(token)
+        if len(parts) > 2:
+            metadata["metadataOfUtxo"] = {"userData": {"meta": []}}
+        return 200, json.dumps(metadata)
+
+
+def follow_tip(daemon, chain, blocks, reorg_every, reorg_depth):
+    """Add blocks one at a time, with a reorg every reorg_every blocks.
+    Returns the time each sync took, and the ones that rolled back"""
+    latencies = []
+    reorgs = []
+    for i in range(1, blocks + 1):
+        reorg = reorg_every > 0 and i % reorg_every == 0
+        if reorg:
+            chain.reorg(reorg_depth)
+        else:
+            chain.advance()
+        began = time.time()
+        try:
+            daemon._process_blocks()
+        except explorer_sync.ReorgException:
+            # rolled back without a fork point, synced on the next try
+            daemon._process_blocks()
+        (reorgs if reorg else latencies).append(time.time() - began)
+    return latencies, reorgs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sync_arguments(parser)
+    parser.add_argument("--blocks", type=int, default=10000,
+                        help="height of the chain before following the tip")
+    parser.add_argument("--addresses", type=int, default=100000)
+    parser.add_argument("--txs-per-block", type=int, default=20)
+    parser.add_argument("--fan-in", type=int, default=2,
+                        help="most inputs per transaction")
+    parser.add_argument("--fan-out", type=int, default=3,
+                        help="most outputs per transaction")
+    parser.add_argument("--token-ratio", type=float, default=0.2,
+                        help="share of transactions moving tokens")
+    parser.add_argument("--issue-ratio", type=float, default=0.01,
+                        help="share of transactions issuing a token")
+    parser.add_argument("--meta-ratio", type=float, default=0.3,
+                        help="share of token transactions with metadata")
+    parser.add_argument("--cold-stake-ratio", type=float, default=0.2)
+    parser.add_argument("--vote-ratio", type=float, default=0.1)
+    parser.add_argument("--tip-blocks", type=int, default=100,
+                        help="blocks added one at a time after the sync")
+    parser.add_argument("--reorg-every", type=int, default=0,
+                        help="replace the last blocks every this many "
+                             "tip blocks")
+    parser.add_argument("--reorg-depth", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    setup(args)
+
+    chain = SyntheticChain(
+        args.blocks, args.addresses, args.txs_per_block, args.fan_in,
+        args.fan_out, args.token_ratio, args.issue_ratio, args.meta_ratio,
+        args.cold_stake_ratio, args.vote_ratio, seed=args.seed)
+    standin = StandIn(chain)
+    daemon = make_daemon(args, standin,
+                         tempfile.mkdtemp(prefix="explorer-sync-bench-"), 1)
+    try:
+        began = time.time()
+        daemon._process_blocks()
+        results = {"initial": report(standin, time.time() - began,
+                                     "initial sync")}
+        print("%d addresses, %d tokens" % (
+            daemon._db.db.addresses.count_documents({}),
+            daemon._db.db.tokens.count_documents({})))
+        if args.tip_blocks > 0:
+            explorer_sync.metrics.reset()
+            standin.reset()
+            began = time.time()
+            latencies, reorgs = follow_tip(
+                daemon, chain, args.tip_blocks, args.reorg_every,
+                args.reorg_depth)
+            results["tip"] = report(standin, time.time() - began,
+                                    "following the tip")
+            results["tip"]["block_seconds"] = latencies
+            results["tip"]["reorg_seconds"] = reorgs
+            for name, times in (("block", latencies), ("reorg", reorgs)):
+                if times:
+                    print("per %s: %.3fs average, %.3fs max" % (
+                        name, sum(times) / len(times), max(times)))
+    finally:
+        standin.close()
+        if not args.keep_database:
+            daemon._db._db_conn.drop_database(args.database)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import decimal
+import http.client
+import http.server
 import jsmin
 import simplejson as json
 import logging
@@ -8,15 +16,22 @@ import logging.handlers
 import os
 import pymongo
 import shutil
+import socket
 import subprocess
 import time
 import pprint
+import pstats
+import re
+import urllib.parse
 import urllib.request
 import zlib
 import sys
+import threading
+import tracemalloc
 
-from bitcoinrpc.authproxy import AuthServiceProxy
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 from configobj import ConfigObj
+from pymongo.errors import BulkWriteError
 
 
 parser = argparse.ArgumentParser(description='explorer sync parameters')
@@ -27,16 +42,82 @@ parser.add_argument('--log-level', dest='loglevel', type=str, default="INFO",
                     choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"])
 parser.add_argument('--log-file', dest='logfile', type=str,
                     help='log file location')
+parser.add_argument('--prefetch-workers', dest='prefetch_workers', type=int,
+                    default=0,
+                    help='number of threads fetching blocks ahead of the '
+                         'decoder. Also commits batches in the background. '
+                         '0 processes blocks serially')
+parser.add_argument('--decode-workers', dest='decode_workers', type=int,
+                    default=0,
+                    help='number of processes decoding transactions during '
+                         'the initial sync. 0 decodes in the sync process')
+parser.add_argument('--rebuild-workers', dest='rebuild_workers', type=int,
+                    default=0,
+                    help='drop everything synced so far and resync from '
+                         'genesis with this many processes, each syncing '
+                         'its own range of blocks')
+parser.add_argument('--rebuild-shard-size', dest='rebuild_shard_size',
+                    type=int, default=1000,
+                    help='number of blocks per range during a rebuild')
+parser.add_argument('--follow', dest='follow', type=str, default="poll",
+                    choices=["poll", "waitfornewblock", "notify"],
+                    help='how new blocks are noticed once synced: poll the '
+                         'daemon, long-poll its waitfornewblock call or '
+                         'listen for -blocknotify announcements')
+parser.add_argument('--notify-port', dest='notify_port', type=int,
+                    default=18669,
+                    help='local UDP port -blocknotify announcements are '
+                         'sent to with --follow=notify')
+parser.add_argument('--mempool', dest='mempool', action='store_true',
+                    help='also keep the mempool collection in sync with '
+                         'the daemon\'s unconfirmed transactions')
+parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                    default=0,
+                    help='serve sync metrics on this local port, in the '
+                         'Prometheus text format on /metrics and as JSON '
+                         'on /metrics.json. 0 disables it')
+parser.add_argument('--metrics-file', dest='metrics_file', type=str,
+                    help='write the sync metrics as JSON to this file '
+                         'after every flush')
+parser.add_argument('--profile', dest='profile', type=str,
+                    help='profile the sync loop and dump the stats of '
+                         'every flush to this directory. Batches are '
+                         'committed in the foreground while profiling')
+parser.add_argument('--profile-flushes', dest='profile_flushes', type=int,
+                    default=5,
+                    help='number of flushes profiled with --profile')
+parser.add_argument('--profile-memory', dest='profile_memory',
+                    action='store_true',
+                    help='also record allocations with tracemalloc '
+                         'while profiling')
+parser.add_argument('--poll-interval', dest='poll_interval', type=int,
+                    default=10,
+                    help='seconds between syncs, also the longest wait '
+                         'for an announcement before syncing anyway')
 
 
 NUM_UNITS = 100000000
 
-ntp1_api_url = ''
+# max number of calls sent to the daemon in a single JSON-RPC batch
+RPC_BATCH_SIZE = 200
+
+# a rebuild stops this many blocks short of the tip to stay clear of
+# reorgs, the regular sync takes over from there
+REBUILD_TIP_DISTANCE = 100
+
+# blocks this close to the tip get an undo record, as many as the
+# blocks collection keeps
+JOURNAL_DEPTH = 5000
+
+# what -blocknotify sends for %s, anything else on the socket is ignored
+BLOCK_HASH_RE = re.compile("[0-9a-fA-F]{64}")
 
 initial_sync_done = False
 
 # metadata cannot be gathered for these as they are invalid
-# do not bother wasting time trying & retrying to get the metadata
+# do not bother wasting time trying & retrying to get the metadata.
+# Used to seed the invalid_tokens collection, tokens found to be
+# invalid later on are only recorded there
 invalid_token_ids = ['La77KcJTUj991FnvxNKhrCD1ER8S81T3LgECS6',
                      'La347xkKhi5VUCNDCqxXU4F1RUu8wPvC3pnQk6',
                      'La6gfSao2Qwmswzzf3rbn3hCzYtBntRUbSxfdF',
@@ -54,20 +135,17 @@ invalid_token_ids = ['La77KcJTUj991FnvxNKhrCD1ER8S81T3LgECS6',
                      'La6gfSao2Qwmswzzf3rbn3hCzYtBntRUbSxfdF',
                      'La44xkuQuLT7P2bsszt3a6yKqN7E6rw75A8WDT']
 
-class DecimalEncoder(json.JSONEncoder):
-    def _iterencode(self, o, markers=None):
-        if isinstance(o, decimal.Decimal):
-            # wanted a simple yield str(o) in the next line,
-            # but that would mean a yield on the line with super(...),
-            # which wouldn't work (see my comment below), so...
-            return (str(o) for o in [o])
-        return super(DecimalEncoder, self)._iterencode(o, markers)
-
-
 class ReorgException(Exception):
     pass
 
 
+class TokenMetadataError(Exception):
+
+    def __init__(self, message, code=None):
+        super(TokenMetadataError, self).__init__(message)
+        self.code = code
+
+
 def get_explorer_config(cfg_file):
     if os.path.isfile(cfg_file) is False:
         raise IOError("Config file %s not found" % cfg_file)
@@ -76,19 +154,815 @@ def get_explorer_config(cfg_file):
         return json.loads(jsmin.jsmin(fp.read()))
 
 
+def _clean_key(k):
+    k = k.replace('.', '_')
+    if k.startswith('$'):
+        k = '_' + k[1:]
+    return k
+
+
+def sanitize(d):
+    """A version of d mongodb can store: Decimals become floats and
+    keys containing '.' or starting with '$' are renamed. d is never
+    modified, other threads may be reading it. Only the dicts and
+    lists on the way to a change are copied, everything else is shared
+    with the result, which is d itself when nothing needed a change"""
+    if isinstance(d, dict):
+        clean = None
+        for k, v in d.items():
+            if isinstance(v, (str, int, float, bool)) or v is None:
+                continue
+            v_clean = sanitize(v)
+            if v_clean is not v:
+                if clean is None:
+                    clean = dict(d)
+                clean[k] = v_clean
+        bad = [k for k in d if '.' in k or k.startswith('$')]
+        if len(bad) > 0:
+            if clean is None:
+                clean = dict(d)
+            for k in bad:
+                clean[_clean_key(k)] = clean.pop(k)
+        return d if clean is None else clean
+    if isinstance(d, list):
+        clean = None
+        for i, v in enumerate(d):
+            if isinstance(v, (str, int, float, bool)) or v is None:
+                continue
+            v_clean = sanitize(v)
+            if v_clean is not v:
+                if clean is None:
+                    clean = list(d)
+                clean[i] = v_clean
+        return d if clean is None else clean
+    if isinstance(d, decimal.Decimal):
+        return float(d)
+    if isinstance(d, (tuple, set)):
+        return sanitize(list(d))
+    return d
+
+
+def utxo_key(txid, n):
+    return "%s:%d" % (txid, int(n))
+
+
+def decode_prevout(out):
+    """Turn a vout entry of a funding transaction into the input details
+    the explorer stores for the spending vin"""
+    scrypt = out.get("scriptPubKey")
+    if scrypt is None:
+        return
+    addr = scrypt.get("addresses")
+    type = scrypt.get("type", "")
+    addr_index = 0
+    if type == "coldstake":
+        addr_index = 1
+    if addr is None:
+        addr = ["no address could be decoded",]
+    # explorer expects id, not tokenId. Copy the tokens, the funding
+    # transaction may be part of the block currently being decoded
+    tokens = []
+    for t in out.get("tokens", []):
+        t = dict(t)
+        t["id"] = t.pop("tokenId")
+        tokens.append(t)
+    return {
+        "addresses": addr[addr_index],
+        "amount": int(out["value"] * NUM_UNITS),
+        "tokens": tokens,
+    }
+
+
+def tx_utxos(tx):
+    """Spendable outputs of a raw tx, one record per vout"""
+    utxos = []
+    for idx, out in enumerate(tx.get("vout", [])):
+        script = out.get("scriptPubKey")
+        if script is None:
+            continue
+        type = script.get("type", "")
+        # the empty first output of a coinstake
+        if idx == 0 and type == "nonstandard":
+            continue
+        asm = script.get("asm")
+        if asm is None or asm.startswith("OP_RETURN"):
+            continue
+        utxo = decode_prevout(out)
+        utxos.append({
+            "_id": utxo_key(tx["txid"], out["n"]),
+            "address": utxo["addresses"],
+            "amount": utxo["amount"],
+            "is_cold_stake": type == "coldstake",
+            "tokens": utxo["tokens"],
+        })
+    return utxos
+
+
+class TokenDelta(object):
+    """Amounts of a token an address sent and received"""
+    __slots__ = ("id", "meta", "sent", "received")
+
+    def __init__(self, token_id, meta, sent=0, received=0):
+        self.id = token_id
+        self.meta = meta
+        self.sent = sent
+        self.received = received
+
+    def doc(self):
+        return {
+            "id": self.id,
+            "sent": self.sent,
+            "received": self.received,
+            "meta": self.meta,
+            "amount": self.received - self.sent,
+        }
+
+
+class AddressDelta(object):
+    """Changes transactions make to an address. Its history is kept
+    apart, see address_history()"""
+    __slots__ = ("sent", "received", "tokens")
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.tokens = {}
+
+    def add_token(self, token_id, meta, sent=0, received=0):
+        token = self.tokens.get(token_id)
+        if token is None:
+            self.tokens[token_id] = TokenDelta(token_id, meta, sent, received)
+        else:
+            token.sent += sent
+            token.received += received
+
+    def merge(self, other):
+        self.sent += other.sent
+        self.received += other.received
+        for t in other.tokens.values():
+            self.add_token(t.id, t.meta, t.sent, t.received)
+
+
+def aggregate_addresses(transactions):
+    """Fold the ins and outs of decoded transactions into an
+    AddressDelta per address"""
+    addrs = {}
+    for tx in transactions:
+        for out in tx["vout"]:
+            delta = addrs.get(out["addresses"])
+            if delta is None:
+                delta = addrs[out["addresses"]] = AddressDelta()
+            delta.received += out["amount"]
+            for t in out.get("tokens", []):
+                delta.add_token(t["id"], t.get("meta", {}),
+                                received=int(t.get("amount", "0")))
+        for vin in tx["vin"]:
+            delta = addrs.get(vin["addresses"])
+            if delta is None:
+                delta = addrs[vin["addresses"]] = AddressDelta()
+            delta.sent += vin["amount"]
+            for t in vin.get("tokens", []):
+                delta.add_token(t["id"], t.get("meta", {}),
+                                sent=int(t.get("amount", "0")))
+    return addrs
+
+
+def address_history(transactions):
+    """The address_txs documents of decoded transactions, one per
+    address and transaction. type is the way the address shows up in
+    the transaction, vin or vout, whichever came first"""
+    docs = []
+    for tx in transactions:
+        kinds = collections.OrderedDict()
+        for out in tx["vout"]:
+            kinds.setdefault(out["addresses"], "vout")
+        for vin in tx["vin"]:
+            kinds.setdefault(vin["addresses"], "vin")
+        for addr, kind in kinds.items():
+            docs.append({
+                "a_id": addr,
+                "blockindex": tx["blockindex"],
+                "txid": tx["txid"],
+                "blockhash": tx["blockhash"],
+                "type": kind,
+            })
+    return docs
+
+
+def token_transfers(transactions):
+    """The token_transfers documents of decoded transactions, one per
+    token output. The sender is the first input holding the token, None
+    when no input does, which is how tokens get issued"""
+    docs = []
+    for tx in transactions:
+        senders = {}
+        for vin in tx["vin"]:
+            for t in vin.get("tokens", []):
+                senders.setdefault(t["id"], vin["addresses"])
+        for n, out in enumerate(tx["vout"]):
+            for k, t in enumerate(out.get("tokens", [])):
+                docs.append({
+                    "_id": "%s:%d:%d" % (tx["txid"], n, k),
+                    "t_id": t["id"],
+                    "txid": tx["txid"],
+                    "height": tx["blockindex"],
+                    "blockhash": tx["blockhash"],
+                    "from": senders.get(t["id"]),
+                    "to": out["addresses"],
+                    "amount": int(t.get("amount", "0")),
+                })
+    return docs
+
+
+def decode_block(blk, prevouts):
+    """Decode the transactions of blk into the documents stored in
+    txes. prevouts has to hold every output the block spends. Does
+    not talk to the daemon or the database, so it can run in a
+    worker process."""
+    transactions = []
+    trx = blk.get("tx", [])
+    block_vote = blk.get("votevalue", None)
+    for tx in trx:
+        tpayTx = Tx(tx, blk["height"], blk["time"], prevouts)
+        details = tpayTx.details()
+        has_token = False
+        has_block_vote = False
+        for o in details.get("vout", []):
+            if (len(o["tokens"]) > 0):
+                has_token = True
+                break
+        for i in details.get("vin", []):
+            if (len(i["tokens"]) > 0):
+                has_token = True
+                break
+        if details["is_stake"] or details["is_cold_stake"]:
+            if block_vote is not None:
+                has_block_vote = True
+
+        txInfo = {
+            "txid" : details["txid"],
+            "blockhash" : blk["hash"],
+            "blockindex" : blk["height"],
+            "timestamp" : details["timestamp"],
+            "has_token" : has_token,
+            "has_block_vote": has_block_vote,
+            "is_cold_stake" : details["is_cold_stake"],
+            "total" : details["total"],
+            "vout" : details["vout"],
+            "vin" : details["vin"],
+            # not really needed. It is here for compatibility
+            # with sync.js
+            "__v" : 0
+        }
+        transactions.append(txInfo)
+    return transactions
+
+
+class TTLCache(object):
+    """LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+
+class Metrics(object):
+    """Counters, gauges and timings of the sync. Names follow the
+    Prometheus conventions, a label is a (name, value) pair."""
+
+    PREFIX = "explorer_sync_"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = collections.OrderedDict()
+            self._gauges = collections.OrderedDict()
+            # count, sum, max and last observation
+            self._timings = collections.OrderedDict()
+
+    def inc(self, name, value=1, label=None):
+        with self._lock:
+            key = (name, label)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, label=None):
+        with self._lock:
+            self._gauges[(name, label)] = value
+
+    def get(self, name, default=None, label=None):
+        with self._lock:
+            return self._gauges.get((name, label), default)
+
+    def observe(self, name, seconds, label=None):
+        with self._lock:
+            timing = self._timings.setdefault((name, label), [0, 0.0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3] = seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, label=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, label)
+
+    def _key(self, name, label):
+        if label is None:
+            return name
+        return "%s{%s=%s}" % (name, label[0], label[1])
+
+    def snapshot(self):
+        with self._lock:
+            ret = {"timestamp": time.time()}
+            for (name, label), value in self._counters.items():
+                ret[self._key(name, label)] = value
+            for (name, label), value in self._gauges.items():
+                ret[self._key(name, label)] = value
+            for (name, label), timing in self._timings.items():
+                ret[self._key(name, label)] = {
+                    "count": timing[0],
+                    "sum": timing[1],
+                    "max": timing[2],
+                    "last": timing[3],
+                }
+            return ret
+
+    def _prometheus_key(self, name, label, suffix=""):
+        name = self.PREFIX + name + suffix
+        if label is None:
+            return name
+        return '%s{%s="%s"}' % (name, label[0], label[1])
+
+    def prometheus(self):
+        # the samples of a family have to follow its TYPE line, whatever
+        # order their labels were first seen in
+        families = collections.OrderedDict()
+
+        def add(kind, name, label, value, suffix=""):
+            family = name if kind == "summary" else name + suffix
+            if family not in families:
+                families[family] = ["# TYPE %s%s %s" % (
+                    self.PREFIX, family, kind)]
+            families[family].append("%s %s" % (
+                self._prometheus_key(name, label, suffix), value))
+
+        with self._lock:
+            for (name, label), value in self._counters.items():
+                add("counter", name, label, value)
+            for (name, label), value in self._gauges.items():
+                add("gauge", name, label, value)
+            for (name, label), timing in self._timings.items():
+                add("summary", name, label, timing[0], "_count")
+                add("summary", name, label, timing[1], "_sum")
+                add("gauge", name, label, timing[2], "_max")
+                add("gauge", name, label, timing[3], "_last")
+        lines = []
+        for family in families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+class MetricsServer(object):
+    """Serves metrics on a local port from a background thread"""
+
+    def __init__(self, port, registry=metrics):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry.prometheus()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(registry.snapshot(), sort_keys=True)
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _code_key(fn):
+    code = fn.__code__
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SyncProfiler(object):
+    """Profiles the sync loop for a number of flushes. The stats of every
+    flush are dumped to the output directory, a summary of the top
+    functions and of the time spent per stage is written after the last
+    one."""
+
+    STAGES = ("rpc wait", "decode", "key cleaning", "mongo writes", "other")
+
+    def __init__(self, path, flushes=5, memory=False, top=40):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._flushes = flushes
+        self._memory = memory
+        self._top = top
+        self._count = 0
+        self._profile = None
+        self._stats = None
+        if memory:
+            tracemalloc.start()
+
+    @property
+    def active(self):
+        return self._count < self._flushes
+
+    def resume(self):
+        if not self.active:
+            return
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def pause(self):
+        if self._profile is not None:
+            self._profile.disable()
+
+    def flushed(self, height):
+        """Dump the stats gathered since the previous flush"""
+        if self._profile is None:
+            return
+        self._profile.disable()
+        self._count += 1
+        name = os.path.join(
+            self._path, "flush-%04d-%d" % (self._count, height))
+        self._profile.dump_stats(name + ".prof")
+        stats = pstats.Stats(self._profile)
+        self._profile = None
+        if self._stats is None:
+            self._stats = stats
+        else:
+            self._stats.add(stats)
+        with open(name + ".txt", "w") as f:
+            self._write_summary(stats, f)
+        if self._memory:
+            snapshot = tracemalloc.take_snapshot()
+            with open(name + ".mem.txt", "w") as f:
+                for stat in snapshot.statistics("lineno")[:self._top]:
+                    f.write("%s\n" % stat)
+        if self.active:
+            self.resume()
+            return
+        if self._memory:
+            tracemalloc.stop()
+        summary = os.path.join(self._path, "summary.txt")
+        with open(summary, "w") as f:
+            self._write_summary(self._stats, f)
+        for stage, seconds in self.stage_times(self._stats).items():
+            logger.info("Profile: %s %.3fs" % (stage, seconds))
+        logger.info("Profile summary written to %s" % summary)
+
+    def _write_summary(self, stats, f):
+        f.write("time per stage:\n")
+        for stage, seconds in self.stage_times(stats).items():
+            f.write("  %-13s %10.3fs\n" % (stage, seconds))
+        f.write("\n")
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(self._top)
+        stats.stream = sys.stdout
+
+    def _roots(self):
+        return {
+            _code_key(Daemon.call_method): "rpc wait",
+            _code_key(Daemon.call_batch): "rpc wait",
+            _code_key(BlockPrefetcher.get): "rpc wait",
+            _code_key(TokenMetadataClient._request): "rpc wait",
+            _code_key(Daemon.get_block_transactions): "decode",
+            _code_key(Daemon._prepare_block): "decode",
+            _code_key(Daemon.get_block_vote): "decode",
+            _code_key(decode_block): "decode",
+            _code_key(sanitize): "key cleaning",
+            _code_key(_clean_key): "key cleaning",
+            _code_key(Daemon._commit_batch): "mongo writes",
+            _code_key(Database.update_richlist): "mongo writes",
+        }
+
+    def stage_times(self, stats):
+        """Split the time of every function between the stages its
+        callers belong to, in proportion to the time spent through each
+        caller"""
+        roots = self._roots()
+        calls = stats.stats
+        shares = {}
+
+        def share(func, seen):
+            """Stage fractions of func, and whether they are final or
+            depend on the recursive calls cut short by seen"""
+            if func in shares:
+                return shares[func], True
+            if func in roots:
+                return {roots[func]: 1.0}, True
+            callers = calls[func][4]
+            if not callers:
+                return {"other": 1.0}, True
+            # recursive calls are followed up to the outermost caller
+            seen.add(func)
+            parts = []
+            final = True
+            for caller, timing in callers.items():
+                if caller not in calls:
+                    continue
+                if caller in seen:
+                    final = False
+                    continue
+                part, part_final = share(caller, seen)
+                final = final and part_final
+                if part:
+                    parts.append((part, timing[3]))
+            seen.discard(func)
+            total = sum(t for _, t in parts)
+            if total <= 0:
+                total = len(parts)
+                parts = [(part, 1) for part, _ in parts]
+            ret = {}
+            for part, t in parts:
+                for stage, fraction in part.items():
+                    ret[stage] = ret.get(stage, 0) + fraction * t / total
+            if final or not seen:
+                shares[func] = ret
+            return ret, final
+
+        times = collections.OrderedDict((stage, 0.0) for stage in self.STAGES)
+        for func, timing in calls.items():
+            part = share(func, set())[0] or {"other": 1.0}
+            for stage, fraction in part.items():
+                times[stage] += timing[2] * fraction
+        return times
+
+
+class TokenMetadataClient(object):
+    """Client for the tokenmetadata calls of the ntp1api.
+
+    Requests run on a bounded pool of threads, each keeping its own
+    connection alive. Answers are cached by token id and by token id
+    plus utxo. A token that fails is backed off exponentially and
+    reported as unavailable in the meantime, the sync never waits on
+    it, and asked for again by retry_pending() once the backoff is
+    over. Tokens the api keeps rejecting are recorded in the
+    invalid_tokens collection and never asked for again."""
+
+    BACKOFF_BASE = 10
+    BACKOFF_MAX = 3600
+    # rejections before a token is considered invalid
+    MAX_FAILURES = 10
+
+    def __init__(self, url, collection, workers=8, cache_size=10000,
+                 cache_ttl=3600, timeout=5):
+        parsed = urllib.parse.urlparse(url)
+        self._https = parsed.scheme == "https"
+        self._netloc = parsed.netloc
+        self._path = parsed.path.rstrip("/") + "/tokenmetadata/"
+        self._timeout = timeout
+        self._collection = collection
+        for token_id in invalid_token_ids:
+            collection.update_one(
+                {"_id": token_id},
+                {"$setOnInsert": {"reason": "known invalid"}}, upsert=True)
+        self._invalid = set(i["_id"] for i in collection.find({}, {"_id": 1}))
+        self._cache = TTLCache(cache_size, cache_ttl)
+        self._backoff = {}
+        # tokens whose metadata could not be had so far
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def is_invalid(self, token_id):
+        return token_id in self._invalid
+
+    def mark_invalid(self, token_id, reason):
+        logger.warning("Marking token %s as invalid: %s" % (token_id, reason))
+        self._invalid.add(token_id)
+        with self._lock:
+            self._pending.discard(token_id)
+        self._collection.update_one(
+            {"_id": token_id},
+            {"$set": {"reason": reason, "timestamp": int(time.time())}},
+            upsert=True)
+
+    def _request(self, path):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self._https:
+                conn = http.client.HTTPSConnection(
+                    self._netloc, timeout=self._timeout)
+            else:
+                conn = http.client.HTTPConnection(
+                    self._netloc, timeout=self._timeout)
+            self._local.conn = conn
+        start = time.time()
+        try:
+            conn.request("GET", self._path + path)
+            resp = conn.getresponse()
+            body = resp.read()
+        except Exception:
+            # the next request opens a new connection
+            conn.close()
+            self._local.conn = None
+            raise
+        finally:
+            metrics.observe("token_api_seconds", time.time() - start)
+        if resp.status != 200:
+            raise TokenMetadataError(
+                "HTTP %d for %s" % (resp.status, path), resp.status)
+        return json.loads(body)
+
+    def _fetch(self, token_id, utxo):
+        if utxo is None:
+            metadata = self._request(token_id)
+            if metadata.get("firstBlock", 0) < 0:
+                raise TokenMetadataError("Invalid first block")
+            if not metadata.get("someUtxo"):
+                raise TokenMetadataError("No UTXO")
+            return metadata
+        try:
+            return self._request(token_id + "/" + utxo)
+        except TokenMetadataError as err:
+            if err.code != 500 or initial_sync_done:
+                raise
+            # if we get an HTTP 500 during initial sync we cannot get
+            # extended metadata for this UTXO, use someUtxo
+            metadata = self.get(token_id)
+            if metadata is None or metadata["someUtxo"] == utxo:
+                raise
+            logger.warning("Using someUtxo due to HTTP 500 " + metadata["someUtxo"])
+            return self._request(token_id + "/" + metadata["someUtxo"])
+
+    def _failed(self, key, token_id, err):
+        metrics.inc("token_api_failures_total")
+        with self._lock:
+            failures = self._backoff.get(key, (0, 0))[0] + 1
+            delay = min(self.BACKOFF_BASE * 2 ** (failures - 1),
+                        self.BACKOFF_MAX)
+            self._backoff[key] = (failures, time.time() + delay)
+            if key == token_id:
+                self._pending.add(token_id)
+        # connection problems and server errors are never held
+        # against the token
+        rejected = (isinstance(err, TokenMetadataError) and
+                    (err.code is None or err.code < 500))
+        if rejected and failures >= self.MAX_FAILURES:
+            self.mark_invalid(token_id, str(err))
+            return
+        logger.warning(
+            "Error getting metadata for %s (%d failures), asking again "
+            "with the first batch after %ds: %s" % (
+                token_id, failures, delay, err))
+
+    def get(self, token_id, utxo=None):
+        """Metadata of token_id, at utxo if one is given. Returns None
+        if the metadata is not available right now"""
+        if token_id in self._invalid:
+            return None
+        key = token_id if utxo is None else (token_id, utxo)
+        metadata = self._cache.get(key)
+        if metadata is not None:
+            return metadata
+        with self._lock:
+            backoff = self._backoff.get(key)
+        if backoff is not None:
+            if backoff[1] > time.time():
+                return None
+            metrics.inc("token_api_retries_total")
+        try:
+            metadata = self._fetch(token_id, utxo)
+        except Exception as err:
+            self._failed(key, token_id, err)
+            return None
+        with self._lock:
+            self._backoff.pop(key, None)
+            self._pending.discard(key)
+        self._cache.put(key, metadata)
+        return metadata
+
+    def get_many(self, token_ids):
+        """Fetch the metadata of several tokens concurrently"""
+        futures = [(i, self._pool.submit(self.get, i)) for i in token_ids]
+        return dict((i, f.result()) for i, f in futures)
+
+    def retry_pending(self):
+        """Ask again for the tokens that failed before and are done
+        backing off. Returns the metadata of the ones that answered"""
+        now = time.time()
+        with self._lock:
+            due = [i for i in self._pending
+                   if self._backoff.get(i, (0, 0))[1] <= now]
+        metadata = self.get_many(due)
+        return dict((i, m) for i, m in metadata.items() if m is not None)
+
+
 class Database(object):
 
-    def __init__(self, cfg, coin):
+    # the address fields shown by the richlist
+    RICHLIST_FIELDS = {"_id": 0, "a_id": 1, "balance": 1, "received": 1,
+                       "sent": 1}
+    RICHLIST_SIZES = (("balance", 102), ("received", 101))
+    # past this many addresses written since the last update, reading
+    # them costs more than recomputing the richlist
+    RICHLIST_MAX_TOUCHED = 5000
+    # upper bounds of the balance bands of the distribution, in units:
+    # below 0.001 coins, below 0.01 coins and so on up to a billion
+    # coins. Addresses holding nothing are left out.
+    DISTRIBUTION_BANDS = [10 ** i for i in range(5, 18)]
+    # richlist ranks summed up by the distribution, the first two
+    # entries are the burn and the binance addresses and are skipped
+    DISTRIBUTION_TOP = (("t_1_25", 2, 25), ("t_26_50", 25, 50),
+                        ("t_51_75", 50, 75), ("t_76_100", 75, 100))
+
+    def __init__(self, cfg, coin, maintain=True):
+        """maintain creates the collections and indexes and fills in
+        collections added since the database was first synced. Left to
+        the main process, rebuild workers connect without it."""
         self._coin = coin
         db_cfg = self._validate_db_cfg(cfg["dbsettings"])
         self._db_uri = 'mongodb://%s:%s@%s:%s/%s' % (
             db_cfg[0], db_cfg[1], db_cfg[2], db_cfg[3], db_cfg[4])
         self._db_conn = pymongo.MongoClient(self._db_uri)
         self.db = self._db_conn[db_cfg[4]]
-        self._ensure_collections_and_indexes()
-        self._txcount = cfg.get("txcount", 200)
-        global ntp1_api_url
-        ntp1_api_url = cfg.get("ntp1api").get("url")
+        if maintain:
+            self._ensure_collections_and_indexes()
+        ntp1_cfg = cfg.get("ntp1api")
+        self.token_metadata = TokenMetadataClient(
+            ntp1_cfg.get("url"), self.db.invalid_tokens,
+            workers=ntp1_cfg.get("workers", 8),
+            cache_size=ntp1_cfg.get("cache_size", 10000),
+            cache_ttl=ntp1_cfg.get("cache_ttl", 3600),
+            timeout=ntp1_cfg.get("timeout", 5))
+        # the richlist as last stored, None until it is recomputed
+        self._richlist = None
+        # addresses written since the richlist was last updated
+        self._touched = set()
+        if not maintain:
+            return
+        if self.db.distribution.find_one({"coin": self._coin}) is None:
+            self.recompute_distribution()
+        if self.db.token_balances.find_one() is None and \
+                self.db.addresses.find_one(
+                    {"tokens.0": {"$exists": True}}, {"_id": 1}) is not None:
+            self.recompute_token_balances()
+        if self.db.address_txs.find_one() is None and \
+                self.db.txes.find_one({}, {"_id": 1}) is not None:
+            self.recompute_address_history()
+        if self.db.token_transfers.find_one() is None and \
+                self.db.txes.find_one(
+                    {"has_token": True}, {"_id": 1}) is not None:
+            self.recompute_token_transfers()
 
     def _validate_db_cfg(self, cfg):
         database = cfg.get("database")
@@ -114,374 +988,436 @@ class Database(object):
             [("height", pymongo.DESCENDING)]).limit(1)
         return record[0]
 
-    def _process_vout(self, vouts, txid, addrs):
-        if type(addrs) is not dict:
-            raise ValueError("Invalid addrs dics")
-        for out in vouts:
-            address = out["addresses"]
-            amount = out["amount"]
-            if addrs.get(address) is None:
-                tokens = []
-                for out_token in out.get("tokens", []):
-                    tokens.append({
-                        "id": out_token["id"],
-                        "received": int(out_token.get("amount", "0")),
-                        "sent": 0,
-                        "meta": out_token.get("meta", {})
-                    })
-                addrs[address] = {
-                    "received": amount,
-                    "sent": 0,
-                    "tokens": tokens,
-                    "txs": [
-                        {
-                            "type": "vout",
-                            "addresses": txid
-                        }
-                    ]
-                }
-            else:
-                details = addrs[address]
-                details["received"] += amount
-                details["txs"].append({
-                    "type": "vout",
-                    "addresses": txid
-                })
-                # process tokens
-                for out_token in out.get("tokens", []):
-                    token_exists = False
-                    for addr_token in details["tokens"]:
-                        if addr_token["id"] == out_token["id"]:
-                            addr_token["received"] = addr_token.get("received", 0) + int(out_token.get("amount", "0"))
-                            token_exists = True
-                            break
-                    if not token_exists:
-                        details["tokens"].append({
-                            "id": out_token["id"],
-                            "received": int(out_token.get("amount", "0")),
-                            "meta": out_token.get("meta", {})
-                        })
-                addrs[address] = details
-            # add utxos with metadata to this token
-            for out_token in out.get("tokens", []):
-                self.add_metadata_utxo_to_token(out_token["id"], txid)
-        return addrs
-
-    def _process_vin(self, vins, txid, addrs):
-        if type(addrs) is not dict:
-            raise ValueError("Invalid addrs dics")
-        for vin in vins:
-            address = vin["addresses"]
-            amount = vin["amount"]
-            if addrs.get(address) is None:
-                tokens = []
-                for vin_token in vin.get("tokens", []):
-                    tokens.append({
-                        "id": vin_token["id"],
-                        "sent": int(vin_token.get("amount", "0")),
-                        "received": 0,
-                        "meta": vin_token.get("meta", {})
-                    })
-                addrs[address] = {
-                    "sent": amount,
-                    "received": 0,
-                    "tokens": tokens,
-                    "txs": [
-                        {
-                            "type": "vin",
-                            "addresses": txid
-                        }
-                    ]
-                }
-            else:
-                details = addrs[address]
-                details["sent"] += amount
-                details["txs"].append({
-                    "type": "vin",
-                    "addresses": txid
-                })
-                # process tokens
-                for vin_token in vin.get("tokens", []):
-                    token_exists = False
-                    for addr_token in details["tokens"]:
-                        if addr_token["id"] == vin_token["id"]:
-                            addr_token["sent"] = addr_token.get("sent", 0) + int(vin_token.get("amount", "0"))
-                            token_exists = True
-                            break
-                    if not token_exists:
-                        details["tokens"].append({
-                            "id": vin_token["id"],
-                            "sent": int(vin_token.get("amount", "0")),
-                            "meta": vin_token.get("meta", {})
-                        })
-                addrs[address] = details
-        return addrs
-
     def get_address_info(self, address):
         addr = self.db.addresses.find_one({"a_id": address})
         if addr is None:
             raise ValueError("No such address %s" % address)
         return addr
 
-    def keyCleaner(self, d):
-        if isinstance(d, (str, int, float)):
-            return d
-        if isinstance(d, dict):
-            new = d.__class__()
-            for k, v in d.items():
-                new_key = k.replace('.','_')
-                if new_key.startswith('$'):
-                    new_key = '_' + new_key[:1]
-                new[new_key] = self.keyCleaner(v)
-        elif isinstance(d, (list, set, tuple)):
-            new = d.__class__(self.keyCleaner(v) for v in d)
-        else:
-            return d
-        return new
-
     def _prepare_ins_outs(self, transactions):
-        addrs = {}
-        for tx in transactions:
-            vout = tx["vout"]
-            vin = tx["vin"]
-            addrs = self._process_vout(vout, tx["txid"], addrs)
-            addrs = self._process_vin(vin, tx["txid"], addrs)
-        return addrs
-
-    def update_token(self, token_id, txid):
-        if token_id in invalid_token_ids: return
-
-        # insert/update metadata in the db
-        token = self.db.tokens.find_one({"t_id": token_id})
-        if token is None:
-            tx = self.db.txes.find_one({"txid": txid})
-            logger.info("Adding new token to the db: "+token_id)
-            # build metadata of issuance
-            found = False
-            meta_of_issuance = {}
-            issuance_address = ""
-            issuance_txid = ""
-            first_block = 0
-            num_transfers = 0
-            total_supply = 0
-            aggregation_policy = ""
-            lock_status = ""
-            divisibility = 0
-            for vout in tx.get("vout", []):
-                for t in vout.get("tokens", []):
-                    if token_id == t.get("id", ""):
-                        found = True
-                        meta_of_issuance["data"] = t.get("meta", {})
-                        issuance_address = vout.get("addresses", "")
-                        issuance_txid = t.get("issueTxid", "")
-                        if issuance_txid != txid:
-                            logger.warning("Issuance TXID does not match first txn token was seen!")
-                            logger.warning("Token ID: " + token_id)
-                            logger.warning("Issuance TXID: " + issuance_txid)
-                            logger.warning("This TXID: " + txid)
-                            logger.warning("This Amount: " + t.get("amount", 0))
-                        first_block = tx.get("blockindex", 0)
-                        # only locked supply is supported by the explorer right now
-                        if t.get("lockStatus", "") == True:
-                            total_supply = t.get("amount", 0)
-                        aggregation_policy = t.get("aggregationPolicy", "")
-                        lock_status = t.get("lockStatus", "")
-                        divisibility = t.get("divisibility", 0)
-                        break
-                    if found:
-                        break
-                if found:
+        return aggregate_addresses(transactions)
+
+    def _token_issuance(self, token_id, tx):
+        """Build the tokens entry from the first tx the token is seen in"""
+        txid = tx["txid"]
+        meta_of_issuance = {}
+        issuance_address = ""
+        issuance_txid = ""
+        first_block = 0
+        total_supply = 0
+        aggregation_policy = ""
+        lock_status = ""
+        divisibility = 0
+        found = False
+        for vout in tx.get("vout", []):
+            for t in vout.get("tokens", []):
+                if token_id == t.get("id", ""):
+                    found = True
+                    meta_of_issuance["data"] = t.get("meta", {})
+                    issuance_address = vout.get("addresses", "")
+                    issuance_txid = t.get("issueTxid", "")
+                    if issuance_txid != txid:
+                        logger.warning("Issuance TXID does not match first txn token was seen!")
+                        logger.warning("Token ID: " + token_id)
+                        logger.warning("Issuance TXID: " + issuance_txid)
+                        logger.warning("This TXID: " + txid)
+                        logger.warning("This Amount: " + str(t.get("amount", 0)))
+                    first_block = tx.get("blockindex", 0)
+                    # only locked supply is supported by the explorer right now
+                    if t.get("lockStatus", "") == True:
+                        total_supply = t.get("amount", 0)
+                    aggregation_policy = t.get("aggregationPolicy", "")
+                    lock_status = t.get("lockStatus", "")
+                    divisibility = t.get("divisibility", 0)
                     break
-
-
-            self.db.tokens.insert_one(
-                {
-                    "t_id": token_id,
-                    "meta_of_issuance": meta_of_issuance,
-                    "issuance_address": issuance_address,
-                    "issuance_txid": issuance_txid,
-                    "first_block": first_block,
-                    "num_transfers": num_transfers,
-                    "total_supply": total_supply,
-                    "aggregation_policy": aggregation_policy,
-                    "lock_status": lock_status,
-                    "divisibility": divisibility
-                }
-            )
-        else:
-            #logger.info("Updating token stats in the db: "+token_id)
-            self.db.tokens.update_one(
-                {"t_id": token_id},
-                {
-                    "$inc": {
-                        "num_transfers": 1
-                    }
-                }
-            )
-
-    def add_metadata_utxo_to_token(self, token_id, txid):
-        if token_id in invalid_token_ids: return
-        self.update_token(token_id, txid)
-        token = self.db.tokens.find_one({"t_id": token_id})
-        if token is None:
-            self.update_token(token_id, txid)
-            token = self.db.tokens.find_one({"t_id": token_id})
-        tx = self.db.txes.find_one({"txid": txid})
-        metadata_size = 0
-        serialized_metadata = ''
-        for out in tx.get("vout", []):
-            for out_token in out.get("tokens", {}):
-                if out_token.get("id", "") == token_id:
-                    meta_of_utxo = out_token.get("meta_of_utxo", {})
-                    if meta_of_utxo is None:
-                        return
-                    serialized_metadata = json.dumps(meta_of_utxo,separators=(',', ':'))
-                    metadata_size = len(serialized_metadata.encode())
-                    if metadata_size > 2: # {} null object
-                        break
-            if metadata_size > 2:
+            if found:
                 break
-        if metadata_size == 2: # empty obj, return
+        return {
+            "t_id": token_id,
+            "meta_of_issuance": meta_of_issuance,
+            "issuance_address": issuance_address,
+            "issuance_txid": issuance_txid,
+            "first_block": first_block,
+            "num_transfers": 0,
+            "total_supply": total_supply,
+            "aggregation_policy": aggregation_policy,
+            "lock_status": lock_status,
+            "divisibility": divisibility
+        }
+
+    def _metadata_utxo(self, tx, out_token):
+        meta_of_utxo = out_token.get("meta_of_utxo", {})
+        if meta_of_utxo is None:
+            return
+        serialized_metadata = json.dumps(
+            sanitize(meta_of_utxo), separators=(',', ':'))
+        metadata_size = len(serialized_metadata.encode())
+        if metadata_size <= 2: # {} null object
             return
         z = zlib.compress(serialized_metadata.encode())
-        utxo = {"txid": txid,
+        return {"txid": tx["txid"],
                 "timestamp": tx.get("timestamp", 0),
                 "metadata_size": metadata_size,
                 "metadata_size_comp": len(z)}
-        utxos = []
-        if token is not None:
-            utxos = token.get("metadata_utxos", [])
-        else:
-            # token is None, add debug logging
-            logger.warn("Token not found in add_metadata_utxo_to_token")
-            logger.warn("TokenID: " + token_id)
-            logger.warn("TXID: " + txid)
-        if utxo in utxos:
-            return
-        else:
-            utxos.append(utxo)
-            # limit utxo array size to 5000
-            if len(utxos) > 5000:
-                utxos = utxos[-5000:]
-            self.db.tokens.update_one(
-                {"t_id": token_id},
-                {
-                    "$set": {
-                        "metadata_utxos": utxos
-                    }
-                }
-            )
 
-    def update_addresses(self, transactions):
-        addrs = self._prepare_ins_outs(transactions)
-        for addr in addrs:
-            info = self.db.addresses.find_one({"a_id": addr})
-            if info:
-                sent = info.get("sent", 0) + addrs[addr].get("sent", 0)
-                received = info.get("received", 0) + addrs[addr].get("received", 0)
-                txs = info.get("txs", [])
-                for tx in addrs[addr].get("txs", []):
-                    already_exists = False
-                    for txi in txs:
-                        if txi["addresses"] == tx["addresses"]:
-                            already_exists = True
-                            break
-                    if already_exists:
+    def token_deltas(self, transactions):
+        """Fold the token outputs of transactions into per token changes.
+        Each output counts as a transfer, except the first one ever seen,
+        which creates the token."""
+        tokens = collections.OrderedDict()
+        for tx in transactions:
+            for out in tx.get("vout", []):
+                for out_token in out.get("tokens", []):
+                    token_id = out_token["id"]
+                    if self.token_metadata.is_invalid(token_id):
                         continue
-                    txs.append(tx)
-                # remove duplicates
-                seen = set()
-                txns = [x for x in txs if [(x['addresses']) not in seen, seen.add((x['addresses']))][0]]
-                balance = received - sent
-                addr_tokens = info.get("tokens", [])
-                for tx_token in addrs[addr].get("tokens", []):
-                    token_exists = False
-                    for addr_token in addr_tokens:
-                        if tx_token["id"] == addr_token["id"]:
-                            addr_token["sent"] =  addr_token.get("sent", 0) + tx_token.get("sent", 0)
-                            addr_token["received"] = addr_token.get("received", 0) + tx_token.get("received", 0)
-                            addr_token["amount"] = addr_token["received"] - addr_token["sent"]
-                            # self.update_token(tx_token["id"]);
-                            token_exists = True
-                            break
-                    if not token_exists:
-                        addr_token = {}
-                        addr_token["id"] = tx_token["id"]
-                        addr_token["sent"] = tx_token.get("sent", 0)
-                        addr_token["received"] = tx_token.get("received", 0)
-                        addr_token["amount"] = addr_token["received"] - addr_token["sent"]
-                        addr_token["meta"] = tx_token["meta"]
-                        addr_token = self.keyCleaner(addr_token)
-                        addr_tokens.append(addr_token)
-                        # self.update_token(tx_token["id"]);
-
-                self.db.addresses.update_one(
-                    {"a_id": addr},
-                    {
-                        "$set": {
-                            "sent": sent,
-                            "received": received,
-                            "balance": balance,
-                            "tokens": addr_tokens,
-                            "txs": txns[-self._txcount:],
+                    token = tokens.get(token_id)
+                    if token is None:
+                        token = tokens[token_id] = {
+                            "tx": tx,
+                            "transfers": 0,
+                            "txids": set(),
+                            "utxos": [],
                         }
-                    })
-            else:
-                addr_tokens = []
-                for tx_token in addrs[addr].get("tokens", []):
-                    addr_token = {}
-                    addr_token["id"] = tx_token["id"]
-                    addr_token["sent"] = tx_token.get("sent", 0)
-                    addr_token["received"] = tx_token.get("received", 0)
-                    addr_token["amount"] = addr_token["received"] - addr_token["sent"]
-                    addr_token["meta"] = tx_token["meta"]
-                    addr_token = self.keyCleaner(addr_token)
-                    addr_tokens.append(addr_token)
-                    # self.update_token(tx_token["id"]);
-                sent = addrs[addr].get("sent", 0)
-                received = addrs[addr].get("received", 0)
-                txs = addrs[addr].get("txs", [])
-                # remove duplicates
-                seen = set()
-                txns = [x for x in txs if [(x['addresses']) not in seen, seen.add((x['addresses']))][0]]
-                balance = received - sent
-                self.db.addresses.insert_one(
-                    {
-                        "a_id": addr,
-                        "sent": sent,
-                        "received": received,
-                        "balance": balance,
-                        "tokens": addr_tokens,
-                        "txs": txns[-self._txcount:],
+                    token["transfers"] += 1
+                    # all outputs of a tx share the same utxo metadata
+                    if tx["txid"] in token["txids"]:
+                        continue
+                    token["txids"].add(tx["txid"])
+                    utxo = self._metadata_utxo(tx, out_token)
+                    if utxo is not None:
+                        token["utxos"].append(utxo)
+        return tokens
+
+    def fold_token_deltas(self, deltas):
+        """Combine the token_deltas() of consecutive blocks"""
+        folded = collections.OrderedDict()
+        for tokens in deltas:
+            for token_id, token in tokens.items():
+                into = folded.get(token_id)
+                if into is None:
+                    folded[token_id] = {
+                        "tx": token["tx"],
+                        "transfers": token["transfers"],
+                        "txids": set(token["txids"]),
+                        "utxos": list(token["utxos"]),
                     }
-                )
+                    continue
+                into["transfers"] += token["transfers"]
+                into["txids"].update(token["txids"])
+                into["utxos"].extend(token["utxos"])
+        return folded
+
+    def update_tokens(self, transactions):
+        return self.apply_token_deltas(self.token_deltas(transactions))
+
+    def known_tokens(self, token_ids):
+        return set(i["t_id"] for i in self.db.tokens.find(
+            {"t_id": {"$in": list(token_ids)}}, {"t_id": 1}))
+
+    def apply_token_deltas(self, tokens, batch=None):
+        """Write token changes with one operation per token. Tokens
+        already marked with batch were written by an earlier attempt
+        at the same batch and are left alone."""
+        self.fill_token_metadata(self.token_metadata.retry_pending())
+        if len(tokens) == 0:
+            return 0
+
+        known = set()
+        for info in self.db.tokens.find(
+                {"t_id": {"$in": list(tokens)}}, {"t_id": 1, "batch": 1}):
+            known.add(info["t_id"])
+            if batch is not None and info.get("batch") == batch:
+                del tokens[info["t_id"]]
+        metadata = self.token_metadata.get_many(
+            [i for i in tokens if i not in known])
+        ops = []
+        for token_id, token in tokens.items():
+            # limit utxo array size to 5000
+            utxos = token["utxos"][-5000:]
+            if token_id in known:
+                update = {"$inc": {"num_transfers": token["transfers"]}}
+                if len(utxos) > 0:
+                    update["$push"] = {
+                        "metadata_utxos": {"$each": utxos, "$slice": -5000}}
+                if batch is not None:
+                    update["$set"] = {"batch": batch}
+                ops.append(pymongo.UpdateOne({"t_id": token_id}, update))
+            else:
+                logger.info("Adding new token to the db: "+token_id)
+                doc = self._token_issuance(token_id, token["tx"])
+                doc["num_transfers"] = token["transfers"] - 1
+                # fall back to the api if the node did not give us
+                # the metadata of issuance
+                api_meta = metadata.get(token_id)
+                if not doc["meta_of_issuance"].get("data") and api_meta:
+                    meta_of_iss = api_meta.get("metadataOfIssuance") or {}
+                    doc["meta_of_issuance"] = {
+                        "data": meta_of_iss.get("data", {})}
+                if len(utxos) > 0:
+                    doc["metadata_utxos"] = utxos
+                if batch is not None:
+                    doc["batch"] = batch
+                ops.append(pymongo.InsertOne(sanitize(doc)))
+        if len(ops) > 0:
+            with metrics.timer("flush_seconds", ("stage", "tokens")):
+                self.db.tokens.bulk_write(ops, ordered=False)
+        return len(tokens)
+
+    def fill_token_metadata(self, metadata):
+        """Fill in the metadata of issuance from the api answers in
+        metadata, for tokens the node gave none and the api had none
+        for when they were created"""
+        ops = []
+        for token_id, api_meta in metadata.items():
+            meta_of_iss = api_meta.get("metadataOfIssuance") or {}
+            if not meta_of_iss.get("data"):
+                continue
+            ops.append(pymongo.UpdateOne(
+                {"t_id": token_id,
+                 "meta_of_issuance.data": {"$in": [None, {}]}},
+                {"$set": {"meta_of_issuance": sanitize(
+                    {"data": meta_of_iss["data"]})}}))
+        if len(ops) > 0:
+            self.db.tokens.bulk_write(ops, ordered=False)
+
+    def address_deltas(self, transactions):
+        """Per address changes made by transactions: amounts sent and
+        received and per token amounts"""
+        return self._prepare_ins_outs(transactions)
+
+    def fold_address_deltas(self, deltas):
+        """Combine the address_deltas() of consecutive blocks"""
+        folded = {}
+        for addrs in deltas:
+            for addr, delta in addrs.items():
+                into = folded.get(addr)
+                if into is None:
+                    into = folded[addr] = AddressDelta()
+                into.merge(delta)
+        return folded
+
+    def update_addresses(self, transactions):
+        return self.apply_address_deltas(self.address_deltas(transactions))
+
+    def apply_address_deltas(self, addrs, batch=None):
+        """Write address changes with a single unordered bulk_write.
+        Addresses already marked with batch were written by an earlier
+        attempt at the same batch and are left alone."""
+        if len(addrs) == 0:
+            return 0
+        start = time.time()
+        # the only thing we need to know up front is which token
+        # entries already exist, everything else is a blind $inc
+        known_tokens = {}
+        applied = set()
+        balances = {}
+        for info in self.db.addresses.find(
+                {"a_id": {"$in": list(addrs)}},
+                {"a_id": 1, "tokens.id": 1, "batch": 1, "balance": 1}):
+            known_tokens[info["a_id"]] = set(
+                t["id"] for t in info.get("tokens", []))
+            balances[info["a_id"]] = info.get("balance", 0)
+            if batch is not None and info.get("batch") == batch:
+                applied.add(info["a_id"])
+
+        ops = []
+        for addr, delta in addrs.items():
+            update = {
+                "$inc": {
+                    "sent": delta.sent,
+                    "received": delta.received,
+                    "balance": delta.received - delta.sent,
+                },
+            }
+            if batch is not None:
+                update["$set"] = {"batch": batch}
+            new_tokens = []
+            array_filters = []
+            existing = known_tokens.get(addr)
+            for token in delta.tokens.values():
+                if existing is None or token.id not in existing:
+                    new_tokens.append(sanitize(token.doc()))
+                    continue
+                f = "t%d" % len(array_filters)
+                update["$inc"]["tokens.$[%s].sent" % f] = token.sent
+                update["$inc"]["tokens.$[%s].received" % f] = token.received
+                update["$inc"]["tokens.$[%s].amount" % f] = \
+                    token.received - token.sent
+                array_filters.append({"%s.id" % f: token.id})
+            if existing is None:
+                # new address, it holds nothing but the new tokens
+                update["$push"] = {"tokens": {"$each": new_tokens}}
+                ops.append(pymongo.UpdateOne(
+                    {"a_id": addr}, update, upsert=True))
+                continue
+            if addr not in applied:
+                ops.append(pymongo.UpdateOne(
+                    {"a_id": addr}, update,
+                    array_filters=array_filters or None))
+            # new and existing token entries live in the same array and
+            # cannot be touched by a single update. Only pushed if none
+            # of them is there yet, which makes it safe to repeat.
+            if len(new_tokens) > 0:
+                ops.append(pymongo.UpdateOne(
+                    {"a_id": addr,
+                     "tokens.id": {"$nin": [t["id"] for t in new_tokens]}},
+                    {"$push": {"tokens": {"$each": new_tokens}}}))
+        if len(ops) > 0:
+            self.db.addresses.bulk_write(ops, ordered=False)
+        metrics.observe("flush_seconds", time.time() - start,
+                        ("stage", "addresses"))
+        moves = []
+        for addr, delta in addrs.items():
+            balance = balances.get(addr, 0)
+            change = delta.received - delta.sent
+            if addr in applied:
+                moves.append((balance - change, balance))
+            else:
+                moves.append((balance, balance + change))
+        with metrics.timer("flush_seconds", ("stage", "distribution")):
+            self.update_distribution(moves, batch)
+        with metrics.timer("flush_seconds", ("stage", "token_balances")):
+            self.apply_token_balances(
+                [(t.id, addr, t.sent, t.received)
+                 for addr, delta in addrs.items()
+                 for t in delta.tokens.values()], batch)
+        self._touched.update(addrs)
         return len(addrs)
 
+    def apply_token_balances(self, changes, batch=None):
+        """Apply (t_id, a_id, sent, received) changes to token_balances
+        and to the holder counts of the tokens. Balances already marked
+        with batch were written by an earlier attempt at the same batch
+        and are left alone, holder counts are marked the same way."""
+        if len(changes) == 0:
+            return
+        amounts = {}
+        applied = set()
+        for info in self.db.token_balances.find(
+                {"t_id": {"$in": list(set(i[0] for i in changes))},
+                 "a_id": {"$in": list(set(i[1] for i in changes))}},
+                {"_id": 0, "t_id": 1, "a_id": 1, "amount": 1, "batch": 1}):
+            key = (info["t_id"], info["a_id"])
+            amounts[key] = info.get("amount", 0)
+            if batch is not None and info.get("batch") == batch:
+                applied.add(key)
+        ops = []
+        holders = collections.Counter()
+        for t_id, a_id, sent, received in changes:
+            amount = amounts.get((t_id, a_id), 0)
+            change = received - sent
+            if (t_id, a_id) in applied:
+                old, new = amount - change, amount
+            else:
+                old, new = amount, amount + change
+                update = {"$inc": {
+                    "sent": sent,
+                    "received": received,
+                    "amount": change,
+                }}
+                if batch is not None:
+                    update["$set"] = {"batch": batch}
+                ops.append(pymongo.UpdateOne(
+                    {"t_id": t_id, "a_id": a_id}, update, upsert=True))
+            holders[t_id] += (new > 0) - (old > 0)
+        if len(ops) > 0:
+            self.db.token_balances.bulk_write(ops, ordered=False)
+        ops = []
+        for t_id, count in holders.items():
+            if count == 0:
+                continue
+            query = {"t_id": t_id}
+            update = {"$inc": {"num_holders": count}}
+            if batch is not None:
+                query["holders_batch"] = {"$ne": batch}
+                update["$set"] = {"holders_batch": batch}
+            ops.append(pymongo.UpdateOne(query, update))
+        if len(ops) > 0:
+            self.db.tokens.bulk_write(ops, ordered=False)
+
+    def recompute_address_history(self):
+        """Fill address_txs from the stored txes"""
+        self.db.address_txs.delete_many({})
+        txes = []
+        for tx in self.db.txes.find(
+                {}, {"txid": 1, "blockindex": 1, "blockhash": 1, "vin": 1,
+                     "vout": 1}):
+            txes.append(tx)
+            if len(txes) >= 1000:
+                self.insert_new(self.db.address_txs, address_history(txes))
+                txes = []
+        self.insert_new(self.db.address_txs, address_history(txes))
+
+    def recompute_token_transfers(self):
+        """Fill token_transfers from the stored txes"""
+        self.db.token_transfers.delete_many({})
+        txes = []
+        for tx in self.db.txes.find(
+                {"has_token": True},
+                {"txid": 1, "blockindex": 1, "blockhash": 1, "vin": 1,
+                 "vout": 1}):
+            txes.append(tx)
+            if len(txes) >= 1000:
+                self.insert_new(self.db.token_transfers, token_transfers(txes))
+                txes = []
+        self.insert_new(self.db.token_transfers, token_transfers(txes))
+
+    def recompute_token_balances(self):
+        """Fill token_balances and the holder counts from the tokens
+        held by the addresses"""
+        self.db.token_balances.delete_many({})
+        holders = collections.Counter()
+        docs = []
+        for info in self.db.addresses.find(
+                {"tokens.0": {"$exists": True}}, {"a_id": 1, "tokens": 1}):
+            for token in info["tokens"]:
+                amount = token.get("amount", 0)
+                docs.append({
+                    "t_id": token["id"],
+                    "a_id": info["a_id"],
+                    "sent": token.get("sent", 0),
+                    "received": token.get("received", 0),
+                    "amount": amount,
+                })
+                holders[token["id"]] += amount > 0
+            if len(docs) >= 10000:
+                self.db.token_balances.insert_many(docs, ordered=False)
+                docs = []
+        if len(docs) > 0:
+            self.db.token_balances.insert_many(docs, ordered=False)
+        self.db.tokens.update_many({}, {"$set": {"num_holders": 0}})
+        ops = [pymongo.UpdateOne({"t_id": t_id}, {"$set": {"num_holders": n}})
+               for t_id, n in holders.items() if n > 0]
+        if len(ops) > 0:
+            self.db.tokens.bulk_write(ops, ordered=False)
+
     def rollback_addresses(self, transactions):
         if type(transactions) is not list:
             raise ValueError("transactions object must be list")
+        self._richlist = None
         addrs = self._prepare_ins_outs(transactions)
-        for addr in addrs:
+        moves = []
+        token_changes = []
+        for addr, delta in addrs.items():
             info = self.db.addresses.find_one({"a_id": addr})
             if info is None:
                 continue
-            sent = info.get("sent", 0) - addrs[addr].get("sent", 0)
-            received = info.get("received", 0) - addrs[addr].get("received", 0)
+            token_changes.extend((t.id, addr, -t.sent, -t.received)
+                                 for t in delta.tokens.values())
+            sent = info.get("sent", 0) - delta.sent
+            received = info.get("received", 0) - delta.received
             # rollback token amounts
             db_tokens = info.get("tokens", [])
-            addr_tokens = addrs[addr].get("tokens", [])
             for db_token in db_tokens:
-                for addr_token in addr_tokens:
-                    if (addr_token["id"] == db_token["id"]):
-                        db_token_sent = db_token.get("sent", 0) - addr_token.get("sent", 0)
-                        db_token_received = db_token.get("received", 0) - addr_token.get("received", 0)
-                        db_token["sent"] = db_token_sent
-                        db_token["received"] = db_token_received
-                        db_token["amount"] = db_token["received"] - db_token["sent"]
-            for tx in addrs[addr].get("txs", []):
-                if tx in info.get("txs", []):
-                    info["txs"].remove(tx)
+                addr_token = delta.tokens.get(db_token["id"])
+                if addr_token is not None:
+                    db_token["sent"] = db_token.get("sent", 0) - addr_token.sent
+                    db_token["received"] = \
+                        db_token.get("received", 0) - addr_token.received
+                    db_token["amount"] = db_token["received"] - db_token["sent"]
             balance = received - sent
+            moves.append((info.get("balance", 0), balance))
             self.db.addresses.update_one(
                 {"a_id": addr},
                 {
@@ -490,43 +1426,441 @@ class Database(object):
                         "received": received,
                         "balance": balance,
                         "tokens": db_tokens,
-                        "txs": info["txs"],
+                    },
+                    "$unset": {"batch": ""},
+                })
+        self.update_distribution(moves)
+        self.apply_token_balances(token_changes)
+
+    def _undo_record(self, blk, addrs, tokens):
+        return {
+            "_id": blk["hash"],
+            "height": blk["height"],
+            "addresses": [{
+                "a_id": addr,
+                "sent": delta.sent,
+                "received": delta.received,
+                "tokens": [{
+                    "id": t.id,
+                    "sent": t.sent,
+                    "received": t.received,
+                } for t in delta.tokens.values()],
+            } for addr, delta in addrs.items()],
+            "tokens": [{
+                "t_id": token_id,
+                "transfers": token["transfers"],
+                "txids": [u["txid"] for u in token["utxos"]],
+                "created": False,
+            } for token_id, token in tokens.items()],
+        }
+
+    def update_balances(self, blks, transactions, journal=False, batch=None):
+        """Apply the token and address changes of a batch of blocks.
+        With journal, the changes of every block are also stored as an
+        undo record so that rollback() does not have to recompute them.
+        Documents written are marked with batch, see apply_*_deltas()"""
+        if not journal:
+            self.apply_token_deltas(self.token_deltas(transactions), batch)
+            return self.apply_address_deltas(
+                self.address_deltas(transactions), batch)
+        by_block = collections.OrderedDict((b["hash"], []) for b in blks)
+        for tx in transactions:
+            by_block[tx["blockhash"]].append(tx)
+        addr_deltas = [self.address_deltas(i) for i in by_block.values()]
+        token_deltas = [self.token_deltas(i) for i in by_block.values()]
+        undo = [self._undo_record(*i)
+                for i in zip(blks, addr_deltas, token_deltas)]
+        tokens = self.fold_token_deltas(token_deltas)
+        known = self.known_tokens(tokens)
+        for record in undo:
+            for token in record["tokens"]:
+                if token["t_id"] not in known:
+                    # the first block that has the token creates it
+                    token["created"] = True
+                    known.add(token["t_id"])
+        # stored before the deltas are applied, so that a retry of the
+        # batch never sees its own tokens as already known
+        with metrics.timer("flush_seconds", ("stage", "undo")):
+            self.insert_new(self.db.undo, sanitize(undo))
+        self.apply_token_deltas(tokens, batch)
+        return self.apply_address_deltas(
+            self.fold_address_deltas(addr_deltas), batch)
+
+    def apply_undo(self, undo):
+        """Revert the address and token changes of a block from its
+        undo record"""
+        balances = dict((i["a_id"], i.get("balance", 0))
+                        for i in self.db.addresses.find(
+                            {"a_id": {"$in": [a["a_id"]
+                                              for a in undo["addresses"]]}},
+                            {"a_id": 1, "balance": 1}))
+        moves = []
+        ops = []
+        for addr in undo["addresses"]:
+            if addr["a_id"] in balances:
+                balance = balances[addr["a_id"]]
+                moves.append(
+                    (balance, balance + addr["sent"] - addr["received"]))
+            update = {
+                "$inc": {
+                    "sent": -addr["sent"],
+                    "received": -addr["received"],
+                    "balance": addr["sent"] - addr["received"],
+                },
+                "$unset": {"batch": ""},
+            }
+            array_filters = []
+            for token in addr["tokens"]:
+                f = "t%d" % len(array_filters)
+                update["$inc"]["tokens.$[%s].sent" % f] = -token["sent"]
+                update["$inc"]["tokens.$[%s].received" % f] = \
+                    -token["received"]
+                update["$inc"]["tokens.$[%s].amount" % f] = \
+                    token["sent"] - token["received"]
+                array_filters.append({"%s.id" % f: token["id"]})
+            ops.append(pymongo.UpdateOne(
+                {"a_id": addr["a_id"]}, update,
+                array_filters=array_filters or None))
+        if len(ops) > 0:
+            self.db.addresses.bulk_write(ops, ordered=False)
+        self.update_distribution(moves)
+        self.apply_token_balances(
+            [(t["id"], addr["a_id"], -t["sent"], -t["received"])
+             for addr in undo["addresses"] for t in addr["tokens"]])
+        created = [i["t_id"] for i in undo["tokens"] if i["created"]]
+        if len(created) > 0:
+            self.db.token_balances.delete_many({"t_id": {"$in": created}})
+        ops = []
+        for token in undo["tokens"]:
+            if token["created"]:
+                ops.append(pymongo.DeleteOne({"t_id": token["t_id"]}))
+                continue
+            ops.append(pymongo.UpdateOne({"t_id": token["t_id"]}, {
+                "$inc": {"num_transfers": -token["transfers"]},
+                "$pull": {"metadata_utxos": {"txid": {"$in": token["txids"]}}},
+                "$unset": {"batch": ""},
+            }))
+        if len(ops) > 0:
+            self.db.tokens.bulk_write(ops, ordered=False)
+
+    def _merge_undo(self, records):
+        """Combine the undo records of several blocks into one"""
+        addrs = collections.OrderedDict()
+        tokens = collections.OrderedDict()
+        for record in records:
+            for addr in record["addresses"]:
+                into = addrs.get(addr["a_id"])
+                if into is None:
+                    into = addrs[addr["a_id"]] = {
+                        "a_id": addr["a_id"],
+                        "sent": 0,
+                        "received": 0,
+                        "tokens": collections.OrderedDict(),
                     }
+                into["sent"] += addr["sent"]
+                into["received"] += addr["received"]
+                for t in addr["tokens"]:
+                    token = into["tokens"].setdefault(
+                        t["id"], {"id": t["id"], "sent": 0, "received": 0})
+                    token["sent"] += t["sent"]
+                    token["received"] += t["received"]
+            for t in record["tokens"]:
+                token = tokens.setdefault(t["t_id"], {
+                    "t_id": t["t_id"],
+                    "transfers": 0,
+                    "txids": [],
+                    "created": False,
                 })
+                token["transfers"] += t["transfers"]
+                token["txids"].extend(t["txids"])
+                token["created"] = token["created"] or t["created"]
+        for addr in addrs.values():
+            addr["tokens"] = list(addr["tokens"].values())
+        return {
+            "addresses": list(addrs.values()),
+            "tokens": list(tokens.values()),
+        }
+
+    def rollback_blocks(self, blockhashes):
+        """Rollback the changes made by several blocks at once"""
+        if len(blockhashes) == 0:
+            return
+        # balances can go down, recomputed on the next update
+        self._richlist = None
+        undo = list(self.db.undo.find({"_id": {"$in": blockhashes}}))
+        if len(undo) > 0:
+            self.apply_undo(self._merge_undo(undo))
+        # synced before they came close enough to the tip to be journaled
+        journaled = set(i["_id"] for i in undo)
+        unjournaled = [i for i in blockhashes if i not in journaled]
+        recount = []
+        if len(unjournaled) > 0:
+            transactions = list(self.db.txes.find(
+                {"blockhash": {"$in": unjournaled}}))
+            self.rollback_addresses(transactions)
+            # no undo record to take the transfers back from
+            recount = self.db.token_transfers.distinct(
+                "t_id", {"blockhash": {"$in": unjournaled}})
+            if len(recount) > 0:
+                self.db.tokens.update_many(
+                    {"t_id": {"$in": recount}},
+                    {"$pull": {"metadata_utxos": {"txid": {
+                        "$in": [tx["txid"] for tx in transactions]}}}})
+        self.rollback_utxos(blockhashes)
+        self.db.txes.delete_many({"blockhash": {"$in": blockhashes}})
+        self.db.address_txs.delete_many({"blockhash": {"$in": blockhashes}})
+        self.db.token_transfers.delete_many(
+            {"blockhash": {"$in": blockhashes}})
+        self.recount_transfers(recount)
+        self.db.blocks.delete_many({"hash": {"$in": blockhashes}})
+        self.db.votes.delete_many({"block_hash": {"$in": blockhashes}})
+        self.db.undo.delete_many({"_id": {"$in": blockhashes}})
+
+    def recount_transfers(self, token_ids):
+        """Set num_transfers of tokens from their token_transfers. A
+        token left without any was created by a rolled back block and
+        goes away with it."""
+        ops = []
+        for token_id in token_ids:
+            count = self.db.token_transfers.count_documents({"t_id": token_id})
+            if count == 0:
+                ops.append(pymongo.DeleteOne({"t_id": token_id}))
+                self.db.token_balances.delete_many({"t_id": token_id})
+                continue
+            # the first transfer created the token
+            ops.append(pymongo.UpdateOne(
+                {"t_id": token_id}, {"$set": {"num_transfers": count - 1}}))
+        if len(ops) > 0:
+            self.db.tokens.bulk_write(ops, ordered=False)
 
     def rollback(self, blockhash):
         """Rollback changes made for a particular blockhash"""
-        txs = self.db.txes.find({"blockhash": blockhash})
-        transactions = []
-        if txs:
-            for i in txs:
-                transactions.append(i)
-        self.rollback_addresses(transactions)
-        self.db.txes.delete_many({"blockhash": blockhash})
-        self.db.blocks.delete_many({"hash": blockhash})
-        self.db.votes.delete_many({"block_hash": blockhash})
+        self.rollback_blocks([blockhash])
 
 
+    def insert_new(self, collection, docs):
+        """Unordered insert that skips the documents already stored,
+        which makes it safe to write a batch again after a crash"""
+        if len(docs) == 0:
+            return
+        try:
+            collection.insert_many(docs, ordered=False)
+        except BulkWriteError as err:
+            for error in err.details["writeErrors"]:
+                if error["code"] != 11000:  # duplicate key
+                    raise
+
     def update_transactions(self, transactions):
-        # convert to json and back to serialize all objs
-        transactions = json.dumps(transactions)
-        transactions = json.loads(transactions)
-        transactions = self.keyCleaner(transactions)
-        self.db.txes.insert_many(transactions)
+        # copies, the decoded documents are shared with the address and
+        # token changes, and insert_many() would add an _id to them
+        docs = [dict(tx, _id=tx["txid"]) for tx in transactions]
+        with metrics.timer("flush_seconds", ("stage", "txes")):
+            self.insert_new(self.db.txes, sanitize(docs))
+        with metrics.timer("flush_seconds", ("stage", "address_txs")):
+            self.insert_new(self.db.address_txs, address_history(transactions))
+        with metrics.timer("flush_seconds", ("stage", "token_transfers")):
+            self.insert_new(self.db.token_transfers,
+                            token_transfers(transactions))
+
+    def get_checkpoint(self):
+        return self.db.checkpoints.find_one({"_id": self._coin})
+
+    def start_checkpoint(self, batch, start, end, rebuild=False):
+        """Record the batch about to be written. Until it is marked
+        done, a restart writes the same range again as the same batch.
+        rebuild marks the ranges merged by a rebuild, which leaves the
+        txes of the ranges it did not merge yet behind."""
+        self.db.checkpoints.replace_one({"_id": self._coin}, {
+            "batch": batch,
+            "start": start,
+            "end": end,
+            "done": False,
+            "rebuild": rebuild,
+        }, upsert=True)
+
+    def finish_checkpoint(self, batch):
+        self.db.checkpoints.update_one(
+            {"_id": self._coin, "batch": batch}, {"$set": {"done": True}})
+
+    def get_mempool_txids(self):
+        return set(i["_id"] for i in self.db.mempool.find({}, {"_id": 1}))
+
+    def update_mempool(self, added, dropped):
+        if len(added) > 0:
+            for tx in added:
+                tx["_id"] = tx["txid"]
+                # lets the web tier find the unconfirmed txs of an address
+                tx["addresses"] = sorted(set(
+                    i["addresses"] for i in tx["vin"] + tx["vout"]))
+            self.insert_new(self.db.mempool, sanitize(added))
+        self.evict_mempool(dropped)
+
+    def evict_mempool(self, txids):
+        if len(txids) > 0:
+            self.db.mempool.delete_many({"_id": {"$in": list(txids)}})
+
+    def reset(self):
+        """Forget everything synced from the chain"""
+        for name in ("blocks", "txes", "address_txs", "addresses", "tokens",
+                     "token_balances", "token_transfers", "votes", "utxos",
+                     "undo", "mempool", "checkpoints"):
+            self.db[name].delete_many({})
+        self._richlist = None
+        self.db.richlists.update_one(
+            {"coin": self._coin}, {"$set": {"balance": [], "received": []}})
+        self.recompute_distribution()
+        self.db.coinstats.update_one(
+            {"coin": self._coin}, {"$set": {"last": 0, "count": 0}})
+
+    def get_utxos(self, keys):
+        if len(keys) == 0:
+            return {}
+        utxos = self.db.utxos.find({"_id": {"$in": keys}})
+        return dict((i["_id"], i) for i in utxos)
+
+    def discard_above(self, height):
+        """Forget the txes, outputs and votes stored for the blocks
+        above height without their address and token changes, as left
+        behind by the ranges of a rebuild that were never merged"""
+        self.db.txes.delete_many({"blockindex": {"$gt": height}})
+        self.db.address_txs.delete_many({"blockindex": {"$gt": height}})
+        self.db.token_transfers.delete_many({"height": {"$gt": height}})
+        self.db.votes.delete_many({"block_height": {"$gt": height}})
+        self.db.utxos.delete_many({"height": {"$gt": height}})
+
+    def update_utxos(self, created, spent):
+        """Insert the outputs created by a batch of blocks and mark
+        the already indexed outputs it spends"""
+        if len(created) > 0:
+            self.insert_new(self.db.utxos, sanitize(created))
+        if len(spent) > 0:
+            self.db.utxos.bulk_write([
+                pymongo.UpdateOne({"_id": key}, {"$set": {"spent": info}})
+                for key, info in spent.items()], ordered=False)
+
+    def prune_utxos(self, height):
+        """Spent outputs are only kept around to be able to roll back
+        the blocks that spent them"""
+        self.db.utxos.delete_many({"spent.height": {"$lt": height}})
+
+    def rollback_utxos(self, blockhashes):
+        self.db.utxos.delete_many({"blockhash": {"$in": blockhashes}})
+        self.db.utxos.update_many(
+            {"spent.blockhash": {"$in": blockhashes}},
+            {"$set": {"spent": None}})
+
+    def _top_addresses(self, field, size):
+        return list(self.db.addresses.find({}, self.RICHLIST_FIELDS).sort(
+            [(field, pymongo.DESCENDING)]).limit(size))
+
+    def _merge_richlist(self, entries, touched, field, size):
+        """Top size addresses by field, from the previous entries and
+        the touched addresses. None if an entry may have fallen behind
+        an address that is in neither"""
+        candidates = dict((i["a_id"], i) for i in entries)
+        candidates.update(touched)
+        ranked = sorted(candidates.values(), key=lambda i: i.get(field, 0),
+                        reverse=True)[:size]
+        # a full list holds every address above its last entry
+        if len(entries) == size and (
+                len(ranked) < size or
+                ranked[-1].get(field, 0) < entries[-1].get(field, 0)):
+            return None
+        return ranked
 
     def update_richlist(self):
-        balance = list(self.db.addresses.find().sort(
-            [("balance", pymongo.DESCENDING)]).limit(102))
-        received = list(self.db.addresses.find().sort(
-            [("received", pymongo.DESCENDING)]).limit(101))
-        self.db.richlists.update_one(
-            {"coin": self._coin},
-            {
-                "$set": {
-                    "balance": balance,
-                    "received": received,
-                }
-            }, upsert=True)
+        """Only the addresses written since the previous update are
+        checked against the richlist. A list is recomputed when one of
+        its entries may have dropped out, and both are after a
+        rollback."""
+        touched, self._touched = self._touched, set()
+        # recomputed next time if anything below fails
+        previous, self._richlist = self._richlist, None
+        if previous is not None and len(touched) > self.RICHLIST_MAX_TOUCHED:
+            previous = None
+        richlist = dict((field, None) for field, _ in self.RICHLIST_SIZES)
+        if previous is not None and len(touched) > 0:
+            docs = dict((i["a_id"], i) for i in self.db.addresses.find(
+                {"a_id": {"$in": list(touched)}}, self.RICHLIST_FIELDS))
+            for field, size in self.RICHLIST_SIZES:
+                richlist[field] = self._merge_richlist(
+                    previous[field], docs, field, size)
+        elif previous is not None:
+            richlist = previous
+        for field, size in self.RICHLIST_SIZES:
+            if richlist[field] is None:
+                richlist[field] = self._top_addresses(field, size)
+        if richlist != previous:
+            self.db.richlists.update_one(
+                {"coin": self._coin},
+                {
+                    "$set": {
+                        "balance": richlist["balance"],
+                        "received": richlist["received"],
+                    }
+                }, upsert=True)
+            self.db.distribution.update_one(
+                {"coin": self._coin},
+                {"$set": {"top": self._top_shares(richlist["balance"])}})
+        self._richlist = richlist
+
+    def _band(self, balance):
+        return bisect.bisect_right(self.DISTRIBUTION_BANDS, balance)
+
+    def _top_shares(self, entries):
+        """Balance held by each group of richlist ranks"""
+        return dict((name, sum(i.get("balance", 0) for i in entries[lo:hi]))
+                    for name, lo, hi in self.DISTRIBUTION_TOP)
+
+    def _distribution_changes(self, moves):
+        """$inc of the distribution for addresses whose balance went
+        from old to new, given as (old, new) pairs"""
+        inc = collections.Counter()
+        for old, new in moves:
+            if old == new:
+                continue
+            for balance, sign in ((old, -1), (new, 1)):
+                if balance <= 0:
+                    continue
+                band = "bands.%d." % self._band(balance)
+                inc[band + "holders"] += sign
+                inc[band + "balance"] += sign * balance
+                inc["holders"] += sign
+                inc["balance"] += sign * balance
+        return dict((k, v) for k, v in inc.items() if v != 0)
+
+    def update_distribution(self, moves, batch=None):
+        """Move the addresses of a batch between the balance bands. The
+        distribution is marked with batch, so that a repeated batch does
+        not count twice"""
+        inc = self._distribution_changes(moves)
+        if len(inc) == 0:
+            return
+        query = {"coin": self._coin}
+        update = {"$inc": inc}
+        if batch is not None:
+            query["batch"] = {"$ne": batch}
+            update["$set"] = {"batch": batch}
+        self.db.distribution.update_one(query, update)
+
+    def recompute_distribution(self):
+        """Count the holders of every balance band from the addresses"""
+        bounds = [0] + self.DISTRIBUTION_BANDS + [None]
+        bands = [{"min": lo, "max": hi, "holders": 0, "balance": 0}
+                 for lo, hi in zip(bounds, bounds[1:])]
+        for info in self.db.addresses.find(
+                {"balance": {"$gt": 0}}, {"_id": 0, "balance": 1}):
+            band = bands[self._band(info["balance"])]
+            band["holders"] += 1
+            band["balance"] += info["balance"]
+        richlist = self.db.richlists.find_one({"coin": self._coin}) or {}
+        self.db.distribution.replace_one({"coin": self._coin}, {
+            "coin": self._coin,
+            "bands": bands,
+            "holders": sum(i["holders"] for i in bands),
+            "balance": sum(i["balance"] for i in bands),
+            "top": self._top_shares(richlist.get("balance", [])),
+        }, upsert=True)
 
     def update_stats(self, stats):
         if type(stats) is not dict:
@@ -563,6 +1897,12 @@ class Database(object):
             self.db.create_collection("proposals")
         if "votes" not in names:
             self.db.create_collection("votes")
+        if "utxos" not in names:
+            self.db.create_collection("utxos")
+        if "undo" not in names:
+            self.db.create_collection("undo")
+        if "mempool" not in names:
+            self.db.create_collection("mempool")
         if "blocks" in names:
             self.db.blocks.create_index("height", unique=True)
             self.db.blocks.create_index("hash")
@@ -578,19 +1918,319 @@ class Database(object):
         if "tokens" in names:
             self.db.tokens.create_index("t_id")
         if "proposals" in names:
-            self.db.tokens.create_index("p_id")
-            self.db.tokens.create_index("start_block")
-            self.db.tokens.create_index("end_block")
+            self.db.proposals.create_index("p_id")
+            self.db.proposals.create_index("start_block")
+            self.db.proposals.create_index("end_block")
         if "votes" in names:
-            self.db.tokens.create_index("block_height")
-            self.db.tokens.create_index("block_hash")
-            self.db.tokens.create_index("proposal_id")
-            self.db.tokens.create_index("staker_addr")
+            self.db.votes.create_index("block_height")
+            self.db.votes.create_index("block_hash")
+            self.db.votes.create_index("proposal_id")
+            self.db.votes.create_index("staker_addr")
         if "peers" in names:
             self.db.peers.create_index("createdAt",expireAfterSeconds=86400)
+        if "utxos" in names:
+            self.db.utxos.create_index("address")
+            self.db.utxos.create_index("blockhash")
+            self.db.utxos.create_index("spent.blockhash")
+            self.db.utxos.create_index("spent.height")
+        if "undo" in names:
+            self.db.undo.create_index("height")
+        if "mempool" in names:
+            self.db.mempool.create_index("addresses")
+        # unique from the start, a batch written again after a crash
+        # relies on it to skip the history it already stored
+        self.db.address_txs.create_index(
+            [("a_id", pymongo.ASCENDING),
+             ("blockindex", pymongo.DESCENDING),
+             ("txid", pymongo.DESCENDING)], unique=True)
+        self.db.address_txs.create_index("blockhash")
+        # upserted by (t_id, a_id), top holders come from the second
+        self.db.token_balances.create_index(
+            [("t_id", pymongo.ASCENDING), ("a_id", pymongo.ASCENDING)],
+            unique=True)
+        self.db.token_balances.create_index(
+            [("t_id", pymongo.ASCENDING), ("amount", pymongo.DESCENDING)])
+        self.db.token_transfers.create_index(
+            [("t_id", pymongo.ASCENDING), ("height", pymongo.DESCENDING)])
+        self.db.token_transfers.create_index("blockhash")
+
+
+class UtxoSet(object):
+    """Outputs created and spent by blocks that were decoded but not
+    yet committed, on top of the utxos collection"""
+
+    def __init__(self, db):
+        self._db = db
+        self._created = {}
+        self._spent = {}
+        # outputs handed over to a commit that is still running
+        self._committing = {}
+
+    def clear(self):
+        self._created = {}
+        self._spent = {}
+        self._committing = {}
+
+    def add(self, utxos, blk):
+        for i in utxos:
+            i["blockhash"] = blk["hash"]
+            i["height"] = blk["height"]
+            # outputs spent later in the same block show up before
+            # the tx that created them was decoded
+            i["spent"] = self._spent.pop(i["_id"], None)
+            self._created[i["_id"]] = i
+
+    def spend(self, key, txid, blk):
+        info = {
+            "txid": txid,
+            "blockhash": blk["hash"],
+            "height": blk["height"],
+        }
+        if key in self._created:
+            self._created[key]["spent"] = info
+        else:
+            self._spent[key] = info
+
+    def lookup(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self._created:
+                found[key] = self._created[key]
+            elif key in self._committing:
+                found[key] = self._committing[key]
+            else:
+                missing.append(key)
+        found.update(self._db.get_utxos(missing))
+        return found
+
+    def take(self):
+        """Hand the pending changes over to a commit. They remain
+        visible to lookups until the commit has written them"""
+        created, spent = self._created, self._spent
+        self._committing = created
+        self._created = {}
+        self._spent = {}
+        return created, spent
+
+    def write(self, created, spent):
+        self._db.update_utxos(list(created.values()), spent)
+        self._committing = {}
+
+
+class BlockPrefetcher(object):
+    """Fetches the blocks of a height range ahead of the decoder using
+    a pool of threads, each with its own connection to the daemon.
+    Blocks are handed out in height order."""
+
+    def __init__(self, url, workers, start, end):
+        self._url = url
+        self._local = threading.local()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._depth = workers * 4
+        self._next = start
+        self._end = end
+        self._pending = collections.deque()
+        self._fill()
+
+    def _fill(self):
+        while len(self._pending) < self._depth and self._next <= self._end:
+            self._pending.append(
+                (self._next, self._pool.submit(self._fetch, self._next)))
+            self._next += 1
+
+    def _fetch(self, height, retried=False):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = AuthServiceProxy(self._url)
+        try:
+            with metrics.timer("rpc_seconds", ("method", "getblockhash")):
+                blkhash = conn.getblockhash(height)
+            # verbose=true showtxns=true
+            with metrics.timer("rpc_seconds", ("method", "getblock")):
+                return conn.getblock(blkhash, True, True)
+        except Exception:
+            self._local.conn = None
+            if retried:
+                raise
+            return self._fetch(height, True)
+
+    def get(self, height):
+        next_height, future = self._pending.popleft()
+        if next_height != height:
+            raise ValueError("Blocks requested out of order: %d != %d" % (
+                height, next_height))
+        blk = future.result()
+        self._fill()
+        return blk
+
+    def close(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=False)
+
+
+class FlushPolicy(object):
+    """Decides when the blocks decoded so far are committed: once the
+    batch holds max_txs transactions, once its decoded documents are
+    estimated to take max_bytes, or once it has been building for
+    max_seconds. Blocks are only counted against max_blocks if it is
+    set, the cost of a batch is in its transactions."""
+
+    # rough in-memory size of a decoded tx and of each of its ins/outs
+    TX_BYTES = 1000
+    IO_BYTES = 400
+
+    OPTIONS = ("max_blocks", "max_txs", "max_bytes", "max_seconds")
+
+    @classmethod
+    def from_config(cls, cfg):
+        """The policy set by the sync_flush section of settings.json"""
+        unknown = sorted(set(cfg) - set(cls.OPTIONS))
+        if len(unknown) > 0:
+            raise ValueError(
+                "Unknown sync_flush option(s) %s, expected any of %s" % (
+                    ", ".join(unknown), ", ".join(cls.OPTIONS)))
+        return cls(**cfg)
+
+    def __init__(self, max_blocks=None, max_txs=100000,
+                 max_bytes=512 * 1024 * 1024, max_seconds=300):
+        self.max_blocks = max_blocks
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.reset()
+
+    def reset(self):
+        self.blocks = 0
+        self.txs = 0
+        self.bytes = 0
+        self._started = None
+
+    def add(self, blk):
+        if self._started is None:
+            self._started = time.time()
+        self.blocks += 1
+        for tx in blk.get("tx", []):
+            self.txs += 1
+            self.bytes += self.TX_BYTES + self.IO_BYTES * (
+                len(tx.get("vin", [])) + len(tx.get("vout", [])))
+
+    def due(self):
+        return ((self.max_blocks is not None and
+                 self.blocks >= self.max_blocks) or
+                self.txs >= self.max_txs or
+                self.bytes >= self.max_bytes or
+                time.time() - self._started >= self.max_seconds)
+
+
+class TipPoller(object):
+    """Waits a fixed interval between syncs"""
+
+    def __init__(self, interval=10):
+        self._interval = interval
+
+    def wait(self):
+        """Block until there may be a new tip. Returns its hash when it
+        is known"""
+        time.sleep(self._interval)
+        return None
+
+    def close(self):
+        pass
+
+
+class TipLongPoller(TipPoller):
+    """Waits on the daemon's waitfornewblock call, which answers as
+    soon as the tip changes. Falls back to polling on daemons that do
+    not have it."""
+
+    def __init__(self, url, interval=10):
+        TipPoller.__init__(self, interval)
+        self._url = url
+        self._conn = None
+        self._supported = True
+        self._tip = None
+
+    def wait(self):
+        if not self._supported:
+            return TipPoller.wait(self)
+        if self._conn is None:
+            self._conn = AuthServiceProxy(
+                self._url, timeout=self._interval + 30)
+        try:
+            tip = self._conn.waitfornewblock(self._interval * 1000)
+        except JSONRPCException as err:
+            logger.warning(
+                "waitfornewblock is not available, polling instead: %s" %
+                err.error)
+            self._supported = False
+            return None
+        except Exception as err:
+            logger.warning("waitfornewblock failed: %s" % err)
+            self._conn = None
+            return TipPoller.wait(self)
+        # on timeout the call answers with the tip it was waiting on
+        last, self._tip = self._tip, tip.get("hash")
+        if last is None or self._tip == last:
+            return None
+        return self._tip
+
+
+class TipListener(TipPoller):
+    """Receives the hashes the daemon announces through -blocknotify
+    on a local UDP socket, e.g.
+
+        -blocknotify="sh -c 'echo %s | nc -u -w0 127.0.0.1 18669'"
+
+    Syncs anyway when nothing was announced for an interval."""
+
+    def __init__(self, port, interval=10):
+        TipPoller.__init__(self, interval)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", port))
+        self._sock.settimeout(interval)
+
+    def wait(self):
+        deadline = time.time() + self._interval
+        tip = None
+        while tip is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self._sock.settimeout(remaining)
+            try:
+                tip = self._block_hash(self._sock.recv(256))
+            except socket.timeout:
+                return None
+        # only the latest of the blocks announced during a sync matters
+        self._sock.setblocking(False)
+        try:
+            while True:
+                tip = self._block_hash(self._sock.recv(256)) or tip
+        except BlockingIOError:
+            pass
+        finally:
+            self._sock.settimeout(self._interval)
+        return tip
+
+    @staticmethod
+    def _block_hash(data):
+        """The hash in a datagram, None when it does not hold one"""
+        data = data.decode("ascii", "ignore").strip()
+        if BLOCK_HASH_RE.fullmatch(data) is None:
+            logger.debug("Ignoring block notification %r" % data[:64])
+            return None
+        return data.lower()
+
+    def close(self):
+        self._sock.close()
 
 
 class TxIn(object):
+    __slots__ = ("_in", "_vers")
 
     def __init__(self, txin, version):
         self._in = txin
@@ -614,10 +2254,12 @@ class TxIn(object):
 
 
 class Tx(object):
+    __slots__ = ("_tx", "_prevouts", "_height", "_vin", "_vout", "_time")
 
-    def __init__(self, tx, cli, height, timestamp):
+    def __init__(self, tx, height, timestamp, prevouts=None):
         self._tx = tx
-        self._cli = cli
+        # decoded outputs spent by this tx, keyed by (txid, n)
+        self._prevouts = prevouts or {}
         self._height = height
         self._vin = None
         self._vout = None
@@ -627,81 +2269,6 @@ class Tx(object):
     def tx_id(self):
         return self._tx["txid"]
 
-    def keyCleaner(self, d):
-        if isinstance(d, (str, int, float)):
-            return d
-        if isinstance(d, dict):
-            new = d.__class__()
-            for k, v in d.items():
-                new_key = k.replace('.','_')
-                if new_key.startswith('$'):
-                    new_key = '_' + new_key[:1]
-                new[new_key] = self.keyCleaner(v)
-        elif isinstance(d, (list, set, tuple)):
-            new = d.__class__(self.keyCleaner(v) for v in d)
-        else:
-            return d
-        return new
-
-    def _get_token_metadata(self, token_id, utxo=None, retries=0):
-        if token_id in invalid_token_ids: return {}
-        if retries > 10: return {}
-        try:
-            data1 = urllib.request.urlopen(ntp1_api_url + 'tokenmetadata/' + token_id)
-            metadata = json.loads(data1.read())
-            metadata = self.keyCleaner(metadata) # remove '.' or '$' from keys
-            someUtxo = metadata.get("someUtxo", "")
-            #logger.info("Getting metdata for token: "+token_id)
-        except Exception as err:
-            logger.warning("RETRY: Error getting initial metadata for: %s" % err)
-            logger.warning(token_id)
-            time.sleep(10)
-            retries += 1
-            self._get_token_metadata(token_id, utxo, retries)
-        finally:
-            try:
-                if data1: data1.close()
-            except NameError:
-                pass
-        if (someUtxo):
-            try:
-                #logger.info("At UTXO: "+someUtxo)
-                # get metadata at a specific utxo, if we do not have one, use someUtxo
-                if utxo is None:
-                  utxo = someUtxo
-                data2 = urllib.request.urlopen(ntp1_api_url + 'tokenmetadata/' + token_id + '/' + utxo)
-                metadata = json.loads(data2.read())
-                metadata = self.keyCleaner(metadata) # remove '.' or '$' from keys
-            except Exception as err:
-                logger.warning("RETRY: Error getting extended metadata: %s" % err)
-                logger.warning(token_id + "/" + utxo)
-                if err.code == 500 and not initial_sync_done:
-                    #if we get an HTTP 500 during initial sync we cannot get extended metadata for this UTXO, use someUtxo
-                    retries += 1
-                    logger.warning("Using someUtxo due to HTTP 500 " + someUtxo)
-                    self._get_token_metadata(token_id, someUtxo, retries)
-                else:
-                    time.sleep(10)
-                    retries += 1
-                    self._get_token_metadata(token_id, utxo, retries)
-            finally:
-                try:
-                    if data2: data2.close()
-                except NameError:
-                    pass
-            # check for a firstBlock of -1
-            if (metadata.get("firstBlock", 0) < 0):
-                logger.warning("RETRY: Invalid first block in token metadata: %s" % err)
-                time.sleep(10)
-                retries += 1
-                self._get_token_metadata(token_id, utxo, retries)
-            return metadata
-        else:
-            logger.warning("RETRY:  No UTXO, cannot get token info for: "+token_id)
-            time.sleep(10)
-            retries += 1
-            self._get_token_metadata(token_id, utxo, retries)
-
     def _output_is_valid(self, out):
         script = out.get("scriptPubKey", None)
         if script is None:
@@ -712,34 +2279,7 @@ class Tx(object):
         return True
 
     def _get_input_details(self, vinInfo):
-        vin = self._cli.get_transaction(vinInfo["txid"])
-        voutIdx = vinInfo.get("vout")
-        vouts = vin.get("vout")
-        if vouts is None:
-            return
-        for i in vouts:
-            n = i.get("n")
-            if n is not None and int(n) == int(vinInfo["vout"]):
-                scrypt = i.get("scriptPubKey")
-                if scrypt is None:
-                    return
-                addr = scrypt.get("addresses")
-                type = scrypt.get("type", "")
-                addr_index = 0
-                if type == "coldstake":
-                    addr_index = 1
-                if addr is None:
-                    addr = ["no address could be decoded",]
-                # explorer expects id, not tokenId
-                tokens = i.get("tokens", [])
-                for t in tokens:
-                    t["id"] = t.pop("tokenId")
-                return {
-                    "addresses": addr[addr_index],
-                    "amount": int(i["value"] * NUM_UNITS),
-                    "tokens": tokens,
-                }
-        return
+        return self._prevouts.get((vinInfo["txid"], int(vinInfo["vout"])))
 
     def _get_coinbase_vin(self):
         vout = self._tx.get("vout")
@@ -768,20 +2308,22 @@ class Tx(object):
                 continue
 
             details = self._get_input_details(tx.input())
+            # copies, the prevouts are shared with the utxo set
+            tokens = []
             for t in details["tokens"]:
                 tx_meta_of_iss = t.get("metadataOfIssuance", {})
                 if tx_meta_of_iss is not None:
                     tx_meta_data = tx_meta_of_iss.get("data", {})
-                    t["meta"] = tx_meta_data
+                    tokens.append(dict(t, meta=tx_meta_data))
                 else:
-                    t["meta"] = {}
+                    tokens.append(dict(t, meta={}))
             if addr_map.get(details["addresses"]) is None:
                 addr_map[details["addresses"]] = {}
                 addr_map[details["addresses"]]["amount"] = details["amount"]
-                addr_map[details["addresses"]]["tokens"] = details["tokens"]
+                addr_map[details["addresses"]]["tokens"] = tokens
             else:
                 addr_map[details["addresses"]]["amount"] += details["amount"]
-                addr_map[details["addresses"]]["tokens"].extend(details["tokens"])
+                addr_map[details["addresses"]]["tokens"].extend(tokens)
 
         ret = [{"addresses": x, "amount": addr_map[x]["amount"], "tokens": addr_map[x]["tokens"]} for x in addr_map]
         self._vin = ret
@@ -802,7 +2344,8 @@ class Tx(object):
         is_cold_stake = False
 
         if is_nonstandard:
-            vout.pop(0)
+            # the block from the daemon is left as it is
+            vout = vout[1:]
             if len(vout) == 0:
                 return ret
             addr_index = 0
@@ -832,8 +2375,9 @@ class Tx(object):
             else:
                 addr = addresses[addr_index]
 
-            vout_tokens = i.get("tokens", [])
-            for t in vout_tokens:
+            vout_tokens = []
+            for token in i.get("tokens", []):
+                t = dict(token)
                 # explorer expects id, not tokenId
                 t["id"] = t.pop("tokenId")
                 tx_meta_of_iss = t.get("metadataOfIssuance", {})
@@ -844,7 +2388,7 @@ class Tx(object):
                     t["meta"] = {}
                 tx_meta_of_utxo = self._tx.get("metadataOfUtxos", {})
                 t["meta_of_utxo"] = tx_meta_of_utxo
-
+                vout_tokens.append(t)
 
             if addrs.get(addr):
                 addrs[addr]["amount"] += int(i["value"] * NUM_UNITS)
@@ -907,16 +2451,18 @@ class Tx(object):
         if len(outs) and outs[0]["is_stake"] and not has_token_inputs:
             ins = []
 
+        # outputs() keeps its own, details() can be called again
+        vout = []
         for i in outs:
-            if i.get("is_stake") is not None:
-                is_stake = i["is_stake"]
-                del i["is_stake"]
-            if i.get("is_cold_stake") is not None:
-                is_cold_stake = i["is_cold_stake"]
-                del i["is_cold_stake"]
+            out = dict(i)
+            if out.get("is_stake") is not None:
+                is_stake = out.pop("is_stake")
+            if out.get("is_cold_stake") is not None:
+                is_cold_stake = out.pop("is_cold_stake")
+            vout.append(out)
         ret = {
             "vin": ins,
-            "vout": outs,
+            "vout": vout,
             "txid": self.tx_id(),
             "total": total,
             "is_coinbase": is_coinbase,
@@ -927,9 +2473,25 @@ class Tx(object):
         return ret
 
 
+# the Daemon of a rebuild worker process
+rebuild_daemon = None
+
+
+def _init_rebuild_worker(cfg_path):
+    global rebuild_daemon
+    # the backfills of the main process would wipe the collections
+    # the workers are writing
+    rebuild_daemon = Daemon(cfg_path, maintain=False)
+
+
+def _sync_range(start, end):
+    return rebuild_daemon.sync_range(start, end)
+
+
 class Daemon(object):
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, prefetch_workers=0, decode_workers=0,
+                 maintain=True):
         self._cfg_path = cfg
         self._explorer_cfg = get_explorer_config(self._cfg_path)
         self._cfg = self._explorer_cfg["wallet"]
@@ -938,7 +2500,24 @@ class Daemon(object):
         self._url = "http://%s:%s@%s:%s" % (self._user, self._password,
                                             self._addr, self._port)
         self._conn = AuthServiceProxy(self._url)
-        self._db = Database(self._explorer_cfg, self._explorer_cfg["coin"])
+        # fail on a mistyped option now rather than on the first sync
+        FlushPolicy.from_config(self._explorer_cfg.get("sync_flush", {}))
+        self._db = Database(self._explorer_cfg, self._explorer_cfg["coin"],
+                            maintain)
+        self._utxos = UtxoSet(self._db)
+        self._prefetch_workers = prefetch_workers
+        # a single thread, batches are always committed in order
+        self._committer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._decoder = None
+        if decode_workers > 0:
+            self._decoder = concurrent.futures.ProcessPoolExecutor(
+                max_workers=decode_workers)
+        # txids in the mempool collection, None when it is not followed
+        self._mempool_txids = None
+        self._metrics_file = None
+        self._profiler = None
+        # hash and time of the last block announced by the tip follower
+        self._announced = None
         self._set_cwd()
 
     def _get_explorer_working_directory(self):
@@ -961,11 +2540,15 @@ class Daemon(object):
     def call_method(self, method, *args):
         meth = getattr(self._conn, method)
         retried = getattr(self, "_retried", False)
+        label = ("method", method)
+        metrics.inc("rpc_calls_total", 1, label)
         try:
-            ret = meth(*args)
+            with metrics.timer("rpc_seconds", label):
+                ret = meth(*args)
             self._retried = False
             return ret
         except Exception as e:
+            metrics.inc("rpc_errors_total", 1, label)
             if retried:
                 print(e)
                 sys.exit(1)
@@ -986,14 +2569,100 @@ class Daemon(object):
         blkDetails = self.call_method("getblock", blkHash, True, True)
         return blkDetails
 
+    def fetch_block(self, blkHash):
+        """getblock for an announced hash the daemon may not know, or no
+        longer have on its chain. Returns None instead of retrying into
+        an exit when the call fails."""
+        label = ("method", "getblock")
+        metrics.inc("rpc_calls_total", 1, label)
+        try:
+            with metrics.timer("rpc_seconds", label):
+                return self._conn.getblock(blkHash, True, True)
+        except Exception as err:
+            metrics.inc("rpc_errors_total", 1, label)
+            if not isinstance(err, JSONRPCException):
+                self._conn = AuthServiceProxy(self._url)
+            logger.warning("Could not get announced block %s: %s" % (
+                blkHash, err))
+            return None
+
+    def get_block_hashes(self, heights):
+        hashes = []
+        for i in range(0, len(heights), RPC_BATCH_SIZE):
+            chunk = heights[i:i + RPC_BATCH_SIZE]
+            hashes.extend(self.call_batch(
+                "getblockhash", [(height,) for height in chunk]))
+        return hashes
+
     def get_block_at_height(self, height):
         blkhash = self.get_block_hash(height)
         return self.get_block(blkhash)
 
+    def call_batch(self, method, params):
+        """Call method once for every argument list in params, using
+        a single JSON-RPC batch request"""
+        if len(params) == 0:
+            return []
+        retried = getattr(self, "_retried", False)
+        label = ("method", method)
+        metrics.inc("rpc_calls_total", len(params), label)
+        try:
+            with metrics.timer("rpc_seconds", label):
+                ret = self._conn.batch_([[method] + list(p) for p in params])
+            self._retried = False
+            return ret
+        except Exception as e:
+            metrics.inc("rpc_errors_total", 1, label)
+            if retried:
+                print(e)
+                sys.exit(1)
+            self._retried = True
+            self._conn = AuthServiceProxy(self._url)
+            return self.call_batch(method, params)
+
     def get_transaction(self, txid):
         tx = self.call_method("getrawtransaction", txid, 1)
         return tx
 
+    def get_transactions(self, txids):
+        txs = []
+        for i in range(0, len(txids), RPC_BATCH_SIZE):
+            chunk = txids[i:i + RPC_BATCH_SIZE]
+            txs.extend(self.call_batch(
+                "getrawtransaction", [(txid, 1) for txid in chunk]))
+        return txs
+
+    def fetch_transactions(self, txids):
+        """getrawtransaction for txids that may have left the mempool
+        since they were listed. The ones the daemon no longer knows are
+        left out. Unlike call_batch(), errors are raised, never retried
+        into an exit."""
+        txs = []
+        label = ("method", "getrawtransaction")
+        for i in range(0, len(txids), RPC_BATCH_SIZE):
+            chunk = txids[i:i + RPC_BATCH_SIZE]
+            metrics.inc("rpc_calls_total", len(chunk), label)
+            try:
+                with metrics.timer("rpc_seconds", label):
+                    txs.extend(self._conn.batch_(
+                        [["getrawtransaction", txid, 1] for txid in chunk]))
+                continue
+            except JSONRPCException:
+                metrics.inc("rpc_errors_total", 1, label)
+            except Exception:
+                metrics.inc("rpc_errors_total", 1, label)
+                self._conn = AuthServiceProxy(self._url)
+                raise
+            # the batch fails as a whole, find out which ones are gone
+            for txid in chunk:
+                metrics.inc("rpc_calls_total", 1, label)
+                try:
+                    txs.append(self._conn.getrawtransaction(txid, 1))
+                except JSONRPCException as err:
+                    metrics.inc("rpc_errors_total", 1, label)
+                    logger.debug("Skipping tx %s: %s" % (txid, err))
+        return txs
+
     def _get_coin_supply_coinbase(self):
         sent = self._db.get_address_info("coinbase")["sent"]
         return sent / NUM_UNITS
@@ -1018,62 +2687,207 @@ class Daemon(object):
         return float(meth())
 
     def rollback_to_height(self, height):
+        """Rollback the blocks from height up to the last synced one"""
         stats = self._db.get_stats()
-        rollback_height = stats["last"]
-        tip_blk = self.get_block_at_height(rollback_height)
-        prev_hash = tip_blk["hash"]
-        while rollback_height > height:
-            prev_blk = self.get_block(prev_hash)
-            self._db.rollback(prev_hash)
-            prev_hash = prev_blk["previousblockhash"]
-            rollback_height = prev_blk["height"]
-            if rollback_height % 100 == 0:
-                logger.info("Rolled back to block: " + str(rollback_height))
+        heights = list(range(stats["last"], height - 1, -1))
+        for i in range(0, len(heights), 1000):
+            chunk = heights[i:i + 1000]
+            self._db.rollback_blocks(self.get_block_hashes(chunk))
+            logger.info("Rolled back to block: " + str(chunk[-1]))
         coin_supply = self.get_coin_supply()
-        self._update_stats(rollback_height - 1, coin_supply)
+        self._update_stats(height - 1, coin_supply)
+
+    def find_fork_point(self):
+        """Return the highest block of the blocks collection that is
+        still part of the node's chain, None if every retained block was
+        orphaned. Hashes are compared in growing batches starting from
+        the top, most reorgs are only a block or two deep."""
+        chain_height = self.blockchain_height()
+        blocks = self._db.db.blocks.find(
+            {"height": {"$lte": chain_height}}, {"hash": 1, "height": 1}
+        ).sort([("height", pymongo.DESCENDING)])
+        size = 8
+        chunk = []
+        for blk in blocks:
+            chunk.append(blk)
+            if len(chunk) < size:
+                continue
+            fork = self._first_in_chain(chunk)
+            if fork is not None:
+                return fork
+            chunk = []
+            size = min(size * 4, RPC_BATCH_SIZE * 5)
+        return self._first_in_chain(chunk)
+
+    def _first_in_chain(self, blocks):
+        hashes = self.get_block_hashes([blk["height"] for blk in blocks])
+        for blk, node_hash in zip(blocks, hashes):
+            if blk["hash"] == node_hash:
+                return blk
+        return None
+
+    def rewind(self, coin_supply):
+        """Rollback every synced block that is no longer part of the
+        node's chain in one go. Returns the last block that was kept"""
+        fork = self.find_fork_point()
+        if fork is None:
+            return None
+        orphaned = [blk["hash"] for blk in self._db.db.blocks.find(
+            {"height": {"$gt": fork["height"]}}, {"hash": 1})]
+        logger.info("Rolling back %d blocks to fork point %d" % (
+            len(orphaned), fork["height"]))
+        self._db.rollback_blocks(orphaned)
+        self._update_stats(fork["height"], coin_supply)
+        return self._db.db.blocks.find_one({"hash": fork["hash"]})
+
+
+    def _batch_in_chain(self, checkpoint, chain_height):
+        """Whether the blocks of a checkpointed batch are still part of
+        the node's chain. The batch id ends with the hash of its last
+        block, which is only on the chain along with the blocks below."""
+        if checkpoint["end"] > chain_height:
+            return False
+        blkhash = checkpoint["batch"].split("-", 1)[1]
+        return self.get_block_hash(checkpoint["end"]) == blkhash
+
+    def _rollback_batch(self, checkpoint, coin_supply):
+        """Roll back an interrupted batch whose blocks were orphaned.
+        Any part of it may have been written, so it is written in full
+        again from the orphaned blocks, which the node keeps by hash,
+        then rewound like any other batch."""
+        blkhash = checkpoint["batch"].split("-", 1)[1]
+        orphaned = []
+        while True:
+            blk = self.fetch_block(blkhash)
+            if blk is None:
+                logger.error(
+                    "Block %s of batch %s is gone, the batch cannot be "
+                    "rolled back. Resync from height %d" % (
+                        blkhash, checkpoint["batch"], checkpoint["start"]))
+                sys.exit(1)
+            orphaned.append(blk)
+            if blk["height"] <= checkpoint["start"]:
+                break
+            blkhash = blk["previousblockhash"]
+        orphaned.reverse()
+        self._utxos.clear()
+        txes = []
+        votes = []
+        for blk in orphaned:
+            txes.extend(self.get_block_transactions(blk))
+            blk_vote = self.get_block_vote(blk)
+            if blk_vote is not None:
+                votes.append(blk_vote)
+        # written the way it was the first time, a batch that was
+        # journaled wrote its undo records before anything else
+        journal = self._db.db.undo.find_one(
+            {"_id": {"$in": [blk["hash"] for blk in orphaned]}},
+            {"_id": 1}) is not None
+        self._commit_batch(
+            [self._prepare_block(blk) for blk in orphaned], txes, votes,
+            self._utxos.take(), checkpoint["end"], coin_supply, journal)
+        self.rewind(coin_supply)
+
+    def resolve_prevouts(self, trx, blk, fetch=None):
+        """Decode every output spent by the transactions in trx.
+        Outputs created in the same block are read from trx, then the
+        utxo index is consulted and only the funding transactions
+        that were never indexed are fetched from the daemon, with
+        fetch if given. The outputs are marked as spent by blk, unless
+        it is None."""
+        spent = {}
+        for tx in trx:
+            for i in tx.get("vin", []):
+                txin = TxIn(i, tx["version"])
+                if txin.is_coinbase() or txin.is_valid() is False:
+                    continue
+                prev = txin.input()
+                spent[(prev["txid"], int(prev["vout"]))] = tx["txid"]
+        if len(spent) == 0:
+            return {}
+
+        in_block = dict((tx["txid"], tx) for tx in trx)
+        indexed = self._utxos.lookup(
+            [utxo_key(*i) for i in spent if i[0] not in in_block])
+        prevouts = {}
+        funding = {}
+        for (txid, n), spender in spent.items():
+            if blk is not None:
+                self._utxos.spend(utxo_key(txid, n), spender, blk)
+            if txid in in_block:
+                funding[txid] = in_block[txid]
+                continue
+            utxo = indexed.get(utxo_key(txid, n))
+            if utxo is not None:
+                prevouts[(txid, n)] = {
+                    "addresses": utxo["address"],
+                    "amount": utxo["amount"],
+                    "tokens": [dict(t) for t in utxo["tokens"]],
+                }
+            else:
+                funding[txid] = None
+        missing = [txid for txid in funding if funding[txid] is None]
+        for tx in (fetch or self.get_transactions)(missing):
+            funding[tx["txid"]] = tx
 
+        for (txid, n) in spent:
+            if funding.get(txid) is None:
+                continue
+            for out in funding[txid].get("vout", []):
+                if out.get("n") is not None and int(out["n"]) == n:
+                    prevouts[(txid, n)] = decode_prevout(out)
+                    break
+        return prevouts
 
-    def get_block_transactions(self, blk):
-        transactions = []
+    def index_block(self, blk):
+        """Resolve the outputs spent by blk and record the ones it
+        creates. Returns the prevouts decode_block needs"""
         trx = blk.get("tx", [])
-        block_vote = blk.get("votevalue", None)
-        if len(trx) == 0:
-            return transactions
-
+        prevouts = self.resolve_prevouts(trx, blk)
         for tx in trx:
-            tpayTx = Tx(tx, self, blk["height"], blk["time"])
-            details = tpayTx.details()
-            has_token = False
-            has_block_vote = False
-            for o in details.get("vout", []):
-                if (len(o["tokens"]) > 0):
-                    has_token = True
-                    break
-            for i in details.get("vin", []):
-                if (len(i["tokens"]) > 0):
-                    has_token = True
-                    break
-            if details["is_stake"] or details["is_cold_stake"]:
-                if block_vote is not None:
-                    has_block_vote = True
-
-            txInfo = {
-                "txid" : details["txid"],
-                "blockhash" : blk["hash"],
-                "blockindex" : blk["height"],
-                "timestamp" : details["timestamp"],
-                "has_token" : has_token,
-                "has_block_vote": has_block_vote,
-                "is_cold_stake" : details["is_cold_stake"],
-                "total" : details["total"],
-                "vout" : details["vout"],
-                "vin" : details["vin"],
-                # not really needed. It is here for compatibility
-                # with sync.js
-                "__v" : 0
-            }
-            transactions.append(txInfo)
-        return transactions
+            self._utxos.add(tx_utxos(tx), blk)
+        return prevouts
+
+    def get_block_transactions(self, blk):
+        return decode_block(blk, self.index_block(blk))
+
+    @staticmethod
+    def _prevouts_known(tx, prevouts):
+        for i in tx.get("vin", []):
+            txin = TxIn(i, tx["version"])
+            if txin.is_coinbase() or txin.is_valid() is False:
+                continue
+            prev = txin.input()
+            if (prev["txid"], int(prev["vout"])) not in prevouts:
+                return False
+        return True
+
+    def sync_mempool(self):
+        """Bring the mempool collection in line with the daemon's
+        mempool. Only the txs that were not seen before are fetched
+        and decoded."""
+        if self._mempool_txids is None:
+            self._mempool_txids = self._db.get_mempool_txids()
+        pool = set(self.call_method("getrawmempool"))
+        known = self._mempool_txids
+        dropped = known - pool
+        # txs can be mined or evicted after getrawmempool listed them,
+        # the ones that went missing are tried again next time
+        trx = self.fetch_transactions([i for i in pool if i not in known])
+        prevouts = self.resolve_prevouts(trx, None, self.fetch_transactions)
+        trx = [tx for tx in trx if self._prevouts_known(tx, prevouts)]
+        added = decode_block({
+            "tx": trx,
+            "hash": "-",
+            "height": -1,
+            "time": int(time.time()),
+        }, prevouts)
+        self._db.update_mempool(added, dropped)
+        self._mempool_txids = (known - dropped) | set(
+            tx["txid"] for tx in trx)
+        if len(added) > 0 or len(dropped) > 0:
+            logger.info("Mempool: %d txs, %d new, %d dropped" % (
+                len(self._mempool_txids), len(added), len(dropped)))
 
     def get_block_vote(self, blk):
         block_vote = blk.get("votevalue", None)
@@ -1114,6 +2928,7 @@ class Daemon(object):
                             break
 
         return {
+            "_id": block_hash,
             "block_height": block_height,
             "block_hash": block_hash,
             "proposal_id": proposal_id,
@@ -1136,26 +2951,37 @@ class Daemon(object):
         else:
             prevhash = block["previousblockhash"]
         return {
+            "_id": block["hash"],
             "height": block["height"],
             "hash": block["hash"],
             "prevhash": prevhash,
+            "time": block["time"],
             "tx": [i["txid"] for i in block["tx"]],
         }
 
 
     def _ensure_blocks_collection_in_sync(self, last_height):
         """We added this collection. The explorer app
-        does not have it. So we sync blocks up to the
-        height the explorer managed to sync previously"""
+        does not have it, and neither does a rebuild write it.
+        So we sync blocks up to the height the explorer
+        managed to sync previously, unless the last one is
+        already there"""
         if last_height <= 1:
             return
+        if self._db.db.blocks.find_one(
+                {"height": last_height}, {"_id": 1}) is not None:
+            # kept by the sync, the checkpoint and find_fork_point()
+            # resume from it
+            return
+        # the hashes written below are the node's, blocks orphaned
+        # since they were synced would go unnoticed
+        last_height = self._rewind_synced_txes(last_height)
 
         if last_height < 5000:
             start_block = 1
         else:
             start_block = last_height - 5000
 
-        self._db.db.blocks.remove({})
         toInsert = []
         next_block_hash = None
 
@@ -1171,9 +2997,39 @@ class Daemon(object):
                 logger.info(
                     "Flushing at height %s. "
                     "Chain height: %s" % (block["height"], last_height))
-                self._db.db.blocks.insert_many(toInsert)
+                # the blocks stored before are kept
+                self._db.insert_new(self._db.db.blocks, toInsert)
                 toInsert = []
 
+    def _rewind_synced_txes(self, last_height):
+        """Rollback the blocks up to last_height that were orphaned
+        while the sync was not running, going by the block hashes
+        stored with their txes. For when the blocks collection has no
+        hashes to compare. Returns the last block that was kept."""
+        fork = last_height
+        while fork > 0:
+            synced = self._db.db.txes.find_one(
+                {"blockindex": fork}, {"blockhash": 1})
+            if (synced is None or
+                    synced["blockhash"] == self.get_block_hash(fork)):
+                break
+            fork -= 1
+        if fork == last_height:
+            return last_height
+        orphaned = self._db.db.txes.distinct(
+            "blockhash", {"blockindex": {"$gt": fork}})
+        logger.info("Rolling back %d blocks orphaned since they were "
+                    "synced to fork point %d" % (len(orphaned), fork))
+        metrics.inc("reorgs_total")
+        self._db.rollback_blocks(orphaned)
+        try:
+            coin_supply = self.get_coin_supply()
+        except Exception as err:
+            logger.warning("Failed to get coin supply: %s" % err)
+            coin_supply = 0
+        self._update_stats(fork, coin_supply)
+        return fork
+
     def _update_stats(self, height, supply):
         stats = {
             "supply": supply,
@@ -1182,88 +3038,423 @@ class Daemon(object):
         }
         self._db.update_stats(stats)
 
-    def _process_blocks(self):
+    def _commit_batch(self, blks, txes, votes, utxos, height, coin_supply,
+                      journal=False):
+        """Write a batch of blocks. Every step can be repeated, so a
+        batch interrupted by a crash is simply written again"""
+        logger.info("commiting to database at block %r" % height)
+        # the hash keeps the blocks that replace orphaned ones from
+        # passing for a batch that was already written
+        batch = "%d-%s" % (blks[0]["height"], blks[-1]["hash"])
+        start = time.time()
+        self._db.start_checkpoint(batch, blks[0]["height"], height)
+        with metrics.timer("flush_seconds", ("stage", "blocks")):
+            self._db.insert_new(self._db.db.blocks, blks)
+        self._db.update_transactions(txes)
+        with metrics.timer("flush_seconds", ("stage", "utxos")):
+            self._utxos.write(*utxos)
+        with metrics.timer("flush_seconds", ("stage", "votes")):
+            self._db.insert_new(self._db.db.votes, votes)
+        # timed per collection by the database
+        addrs_touched = self._db.update_balances(
+            blks, txes, journal, batch)
+        if self._mempool_txids:
+            confirmed = self._mempool_txids.intersection(
+                tx["txid"] for tx in txes)
+            self._db.evict_mempool(confirmed)
+            self._mempool_txids -= confirmed
+        with metrics.timer("flush_seconds", ("stage", "richlist")):
+            self._db.update_richlist()
+        # the batch counts as synced from here on
+        self._update_stats(height, coin_supply)
+        self._db.finish_checkpoint(batch)
+        metrics.observe("flush_seconds", time.time() - start, ("stage", "total"))
+        metrics.inc("flushes_total")
+        metrics.inc("blocks_synced_total", len(blks))
+        metrics.inc("txs_synced_total", len(txes))
+        metrics.inc("addresses_touched_total", addrs_touched)
+        metrics.set("synced_height", height)
+        metrics.set("tip_lag_blocks",
+                    metrics.get("chain_height", height) - height)
+        if initial_sync_done:
+            self._record_latency(blks)
+        if self._metrics_file:
+            metrics.write(self._metrics_file)
+        if len(blks) > 1:
+            logger.info(
+                "Partial stats: Number of addresses touched: %d. "
+                "Number of transactions: %d. "  % (
+                    addrs_touched, len(txes)))
+        return addrs_touched
+
+    def _record_latency(self, blks):
+        """Log how long after its timestamp, and after it was announced,
+        each block that followed the tip got committed"""
+        now = time.time()
+        announced = self._announced
+        for blk in blks:
+            latency = "Block %d synced %.1fs after its timestamp" % (
+                blk["height"], now - blk["time"])
+            metrics.observe("block_latency_seconds", now - blk["time"])
+            if announced is not None and announced[0] == blk["hash"]:
+                latency += ", %.3fs after it was announced" % (
+                    now - announced[1])
+                metrics.observe("announce_latency_seconds",
+                                now - announced[1])
+            logger.info(latency)
+
+    def _process_blocks(self, tip_hash=None, announced=None):
+        """Sync every block up to the tip. tip_hash is the hash of the
+        tip when it was announced, announced the time it was."""
         stats = self._db.get_stats()
-        chain_height = self.blockchain_height()
+        tip = None
+        self._announced = None
+        if tip_hash is not None:
+            tip = self.fetch_block(tip_hash)
+            self._announced = (tip_hash, announced)
+        if tip is not None:
+            chain_height = tip["height"]
+        else:
+            chain_height = self.blockchain_height()
         global initial_sync_done
         if int(stats["last"]) == int(chain_height):
             return
 
         diff = int(chain_height) - int(stats["last"])
-        last_blk = self._db.get_last_recorded_block()
-        last_height = stats["last"]
-        next_block_hash = None
-        if last_height > (chain_height - 100):
-            initial_sync_done = True
-        logger.info("Last height is %d" % last_height)
+        # a batch that was interrupted is written again with the same
+        # range, so that it keeps its batch id
         try:
             coin_supply = self.get_coin_supply()
         except Exception as err:
             logger.warning("Failed to get coin supply: %s" % err)
             coin_supply = 0
+        resume_end = None
+        checkpoint = self._db.get_checkpoint()
+        if checkpoint is not None and checkpoint.get("rebuild"):
+            # stored by the ranges of a rebuild that were never merged
+            self._db.discard_above(stats["last"])
+        if (checkpoint is not None and not checkpoint["done"] and
+                checkpoint["end"] > stats["last"]):
+            if self._batch_in_chain(checkpoint, chain_height):
+                logger.warning(
+                    "Batch %s was interrupted, writing it again" %
+                    checkpoint["batch"])
+                resume_end = checkpoint["end"]
+            else:
+                logger.warning(
+                    "Batch %s was interrupted and its blocks were "
+                    "orphaned since, rolling it back" % checkpoint["batch"])
+                metrics.inc("reorgs_total")
+                self._rollback_batch(checkpoint, coin_supply)
+                stats = self._db.get_stats()
+        # an interrupted batch may have stored blocks past the last one
+        # that was synced
+        last_blk = self._db.db.blocks.find_one({"height": stats["last"]})
+        last_height = stats["last"]
+        next_block_hash = None
+        if last_height > (chain_height - 100):
+            initial_sync_done = True
+        logger.info("Last height is %d" % last_height)
         blks = []
         txes = []
         votes = []
+        self._utxos.clear()
         partial_addrs = 0
         if last_height > 1:
             last_height += 1
+        if resume_end is not None:
+            last_height = checkpoint["start"]
         total_addrs = 0
         total_blks = 0
         total_txes = 0
-        while last_height <= chain_height:
-            if next_block_hash is not None:
-                blk = self.get_block(next_block_hash)
-            else:
-                blk = self.get_block_at_height(last_height)
-            prev_blk = blk.get("previousblockhash")
-            next_block_hash = blk.get("nextblockhash", None)
-            if last_blk and last_blk["hash"] != prev_blk:
-                # chain reorg detected
-                logger.info(
-                    "Reorg detected: %s != %s. Rolling back "
-                    "block %s" % (last_blk["hash"],
-                    prev_blk, last_blk["height"]))
-                self._db.rollback(last_blk["hash"])
-                self._update_stats(last_blk["height"] - 1, coin_supply)
-                raise ReorgException("Chain reorg detected")
-            blks.append(self._prepare_block(blk))
-            txes.extend(self.get_block_transactions(blk))
-            blk_vote = self.get_block_vote(blk)
-            if blk_vote is not None:
-                votes.append(blk_vote)
-            if last_height % 1000 == 0 or last_height == chain_height:
-                logger.info("commiting to database at block %r" % blk["height"])
-                self._db.db.blocks.insert_many(blks)
-                self._db.update_transactions(txes)
-                if len(votes) > 0:
-                    self._db.db.votes.insert_many(votes)
-                addrs_touched = self._db.update_addresses(txes)
-                self._update_stats(blk["height"], coin_supply)
-                self._db.update_richlist()
-                total_addrs += addrs_touched
-                total_txes += len(txes)
-                total_blks += len(blks)
-                if len(blks) == 1000:
+        prefetcher = None
+        if self._prefetch_workers > 0:
+            prefetcher = BlockPrefetcher(
+                self._url, self._prefetch_workers, last_height, chain_height)
+        commit = None
+        # worker processes only pay off while catching up
+        decoder = None
+        if not initial_sync_done:
+            decoder = self._decoder
+        decoded = []
+        policy = FlushPolicy.from_config(
+            self._explorer_cfg.get("sync_flush", {}))
+        profiler = self._profiler
+        if profiler is not None and profiler.active:
+            # commits have to run on the profiled thread
+            profiler.resume()
+        else:
+            profiler = None
+        metrics.set("chain_height", chain_height)
+        metrics.set("tip_lag_blocks", chain_height - stats["last"])
+        last_flush = time.time()
+        try:
+            while last_height <= chain_height:
+                if prefetcher is not None:
+                    blk = prefetcher.get(last_height)
+                elif tip is not None and tip["height"] == last_height:
+                    blk = tip
+                elif next_block_hash is not None:
+                    blk = self.get_block(next_block_hash)
+                else:
+                    blk = self.get_block_at_height(last_height)
+                prev_blk = blk.get("previousblockhash")
+                next_block_hash = blk.get("nextblockhash", None)
+                if last_blk and last_blk["hash"] != prev_blk:
+                    # chain reorg detected
+                    if commit is not None:
+                        total_addrs += commit.result()
+                        commit = None
                     logger.info(
-                        "Partial stats: Number of addresses touched: %d. "
-                        "Number of transactions: %d. "  % (
-                            addrs_touched, len(txes)))
-                blks = []
-                txes = []
-                votes = []
-            if last_height % 4000 == 0:
-                logger.info(
-                    "Prunning blocks collection older "
-                    "than: %d" % (last_height - 5000))
-                self._db.db.blocks.remove(
-                    {"height": {"$lt": last_height - 5000}})
-            last_blk = blk
-            last_height += 1
+                        "Reorg detected: %s != %s at block %s" % (
+                            last_blk["hash"], prev_blk, last_blk["height"]))
+                    metrics.inc("reorgs_total")
+                    # blocks that were not committed yet are dropped and
+                    # fetched again from the fork point
+                    blks = []
+                    txes = []
+                    votes = []
+                    decoded = []
+                    policy.reset()
+                    self._utxos.clear()
+                    if resume_end is not None:
+                        # orphaned before it could be written again
+                        self._rollback_batch(checkpoint, coin_supply)
+                    fork_blk = self.rewind(coin_supply)
+                    if fork_blk is None:
+                        last_blk = self._db.get_last_recorded_block()
+                        if last_blk is not None:
+                            logger.warning(
+                                "No fork point in the blocks collection. "
+                                "Rolling back block %s" % last_blk["height"])
+                            self._db.rollback(last_blk["hash"])
+                            self._update_stats(
+                                last_blk["height"] - 1, coin_supply)
+                        raise ReorgException("Chain reorg detected")
+                    last_blk = fork_blk
+                    last_height = fork_blk["height"] + 1
+                    next_block_hash = None
+                    tip = None
+                    resume_end = None
+                    chain_height = self.blockchain_height()
+                    metrics.set("chain_height", chain_height)
+                    if prefetcher is not None:
+                        prefetcher.close()
+                        prefetcher = BlockPrefetcher(
+                            self._url, self._prefetch_workers,
+                            last_height, chain_height)
+                    continue
+                blks.append(self._prepare_block(blk))
+                if decoder is not None:
+                    decoded.append(decoder.submit(
+                        decode_block, blk, self.index_block(blk)))
+                else:
+                    txes.extend(self.get_block_transactions(blk))
+                blk_vote = self.get_block_vote(blk)
+                if blk_vote is not None:
+                    votes.append(blk_vote)
+                policy.add(blk)
+                metrics.set("batch_blocks", policy.blocks)
+                metrics.set("batch_txs", policy.txs)
+                metrics.set("batch_bytes", policy.bytes)
+                if resume_end is not None:
+                    flush = last_height == min(resume_end, chain_height)
+                else:
+                    flush = policy.due() or last_height == chain_height
+                if flush:
+                    resume_end = None
+                    logger.debug(
+                        "Flushing %d blocks, %d txs, ~%d MB" % (
+                            policy.blocks, policy.txs,
+                            policy.bytes // (1024 * 1024)))
+                    elapsed = max(time.time() - last_flush, 1e-6)
+                    last_flush = time.time()
+                    metrics.set("blocks_per_second", policy.blocks / elapsed)
+                    metrics.set("txs_per_second", policy.txs / elapsed)
+                    policy.reset()
+                    # merge the decoded blocks back in height order
+                    for i in decoded:
+                        txes.extend(i.result())
+                    decoded = []
+                    # only one batch is committed at a time
+                    if commit is not None:
+                        total_addrs += commit.result()
+                        commit = None
+                    batch = (blks, txes, votes, self._utxos.take(),
+                             blk["height"], coin_supply,
+                             blk["height"] > chain_height - JOURNAL_DEPTH)
+                    if prefetcher is not None and profiler is None:
+                        commit = self._committer.submit(
+                            self._commit_batch, *batch)
+                    else:
+                        total_addrs += self._commit_batch(*batch)
+                    if profiler is not None:
+                        profiler.flushed(blk["height"])
+                    total_txes += len(txes)
+                    total_blks += len(blks)
+                    blks = []
+                    txes = []
+                    votes = []
+                if last_height % 4000 == 0:
+                    logger.info(
+                        "Prunning blocks collection older "
+                        "than: %d" % (last_height - 5000))
+                    self._db.db.blocks.remove(
+                        {"height": {"$lt": last_height - 5000}})
+                    self._db.prune_utxos(last_height - 5000)
+                    self._db.db.undo.delete_many(
+                        {"height": {"$lt": last_height - 5000}})
+                last_blk = blk
+                last_height += 1
+            if commit is not None:
+                total_addrs += commit.result()
+                commit = None
+        finally:
+            if profiler is not None:
+                profiler.pause()
+            if prefetcher is not None:
+                prefetcher.close()
+            if commit is not None:
+                # never leave a commit running behind the next attempt
+                concurrent.futures.wait([commit])
         logger.info(
             "Finished updating blocks. Total addresses touched: %d, "
             "Total blocks processed: %d. Total transactions: %d" % (
                 total_addrs, total_blks, total_txes))
+
+    def sync_range(self, start, end):
+        """Store the txes, votes and outputs of blocks start to end.
+        The changes to addresses and tokens are returned for the merge
+        stage of rebuild() instead of being applied"""
+        self._utxos.clear()
+        blk = self.get_block_at_height(start)
+        prevhash = blk.get("previousblockhash")
+        txes = []
+        votes = []
+        while True:
+            txes.extend(self.get_block_transactions(blk))
+            blk_vote = self.get_block_vote(blk)
+            if blk_vote is not None:
+                votes.append(blk_vote)
+            if blk["height"] >= end:
+                break
+            next_blk = self.get_block(blk["nextblockhash"])
+            if next_blk.get("previousblockhash") != blk["hash"]:
+                raise ReorgException(
+                    "Chain reorg detected at block %d" % next_blk["height"])
+            blk = next_blk
+        # outputs of earlier ranges may not be stored yet, their
+        # spends are applied by the merge stage
+        created, spent = self._utxos.take()
+        self._db.update_transactions(txes)
+        self._db.update_utxos(list(created.values()), {})
+        self._utxos.clear()
+        if len(votes) > 0:
+            self._db.db.votes.insert_many(votes)
+        return {
+            "prevhash": prevhash,
+            "hash": blk["hash"],
+            "txes": len(txes),
+            "spent": spent,
+            "addresses": self._db.address_deltas(txes),
+            "tokens": self._db.token_deltas(txes),
+        }
+
+    def rebuild(self, workers, shard_size=1000):
+        """Resync from genesis. Worker processes each sync a range of
+        blocks, their address and token changes are folded in height
+        order, which gives the same result as a serial sync."""
+        chain_height = self.blockchain_height() - REBUILD_TIP_DISTANCE
+        try:
+            coin_supply = self.get_coin_supply()
+        except Exception as err:
+            logger.warning("Failed to get coin supply: %s" % err)
+            coin_supply = 0
+        ranges = collections.deque()
+        last_hash = None
+        merged = -1
+        checkpoint = self._db.get_checkpoint()
+        if (checkpoint is not None and checkpoint.get("rebuild") and
+                self._batch_in_chain(checkpoint, chain_height)):
+            # an interrupted rebuild carries on after its last merged
+            # range. A range it was merging is merged again as the same
+            # batch, which skips what was already written.
+            if checkpoint["done"]:
+                merged = checkpoint["end"]
+                last_hash = checkpoint["batch"].split("-", 1)[1]
+            else:
+                merged = checkpoint["start"] - 1
+                ranges.append((checkpoint["start"], checkpoint["end"]))
+            self._db.discard_above(merged)
+            first = checkpoint["end"] + 1
+            logger.info(
+                "Resuming the rebuild after block %d up to block %d with "
+                "%d workers" % (merged, chain_height, workers))
+        else:
+            logger.info("Rebuilding up to block %d with %d workers" % (
+                chain_height, workers))
+            self._db.reset()
+            first = 0
+        ranges.extend(
+            (i, min(i + shard_size - 1, chain_height))
+            for i in range(first, chain_height + 1, shard_size))
+        running = collections.deque()
+        total_txes = 0
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_rebuild_worker,
+                initargs=(self._cfg_path,)) as pool:
+            while ranges or running:
+                # bound the number of finished ranges waiting for the merge
+                while ranges and len(running) < workers * 2:
+                    start, end = ranges.popleft()
+                    running.append(
+                        (start, end, pool.submit(_sync_range, start, end)))
+                start, end, future = running.popleft()
+                try:
+                    result = future.result()
+                    if (last_hash is not None and
+                            result["prevhash"] != last_hash):
+                        raise ReorgException(
+                            "Chain reorg detected at block %d" % start)
+                # a worker's call_method() gives up with sys.exit()
+                except (Exception, SystemExit) as err:
+                    logger.warning(
+                        "Rebuild stopped after block %d, the sync takes "
+                        "over from there: %r" % (merged, err))
+                    for i in running:
+                        i[2].cancel()
+                    break
+                # the batch id of a regular sync of the same range, a
+                # restart without workers writes it again the same way
+                batch = "%d-%s" % (start, result["hash"])
+                self._db.start_checkpoint(batch, start, end, rebuild=True)
+                self._db.update_utxos([], result["spent"])
+                # tokens first, the address changes count their holders
+                self._db.apply_token_deltas(result["tokens"], batch)
+                addrs_touched = self._db.apply_address_deltas(
+                    result["addresses"], batch)
+                self._update_stats(end, coin_supply)
+                self._db.finish_checkpoint(batch)
+                last_hash = result["hash"]
+                merged = end
+                total_txes += result["txes"]
+                logger.info(
+                    "Merged blocks %d to %d. Number of addresses touched: "
+                    "%d. Number of transactions: %d" % (
+                        start, end, addrs_touched, result["txes"]))
+        if merged < chain_height:
+            # stored by ranges that never got merged, the sync writes
+            # them again
+            self._db.discard_above(merged)
+            if (last_hash is not None and
+                    self.get_block_hash(merged) != last_hash):
+                logger.error(
+                    "Block %d was orphaned after it was rebuilt, run the "
+                    "rebuild again" % merged)
+                sys.exit(1)
         self._db.update_richlist()
+        logger.info("Rebuild finished at block %d. Total transactions: %d" % (
+            merged, total_txes))
 
     def _has_node(self):
         return shutil.which("node") is not None
@@ -1365,8 +3556,29 @@ class Daemon(object):
                     }, upsert=True)
 
 
-    def run(self):
+    def _tip_follower(self, follow, notify_port, poll_interval):
+        if follow == "waitfornewblock":
+            return TipLongPoller(self._url, poll_interval)
+        if follow == "notify":
+            return TipListener(notify_port, poll_interval)
+        return TipPoller(poll_interval)
+
+    def run(self, rebuild_workers=0, rebuild_shard_size=1000,
+            follow="poll", notify_port=18669, poll_interval=10,
+            mempool=False, metrics_port=0, metrics_file=None,
+            profile=None, profile_flushes=5, profile_memory=False):
         count = 0
+        self._metrics_file = metrics_file
+        if profile is not None:
+            self._profiler = SyncProfiler(
+                profile, profile_flushes, profile_memory)
+        if metrics_port > 0:
+            MetricsServer(metrics_port)
+        follower = self._tip_follower(follow, notify_port, poll_interval)
+        tip_hash = None
+        announced = None
+        if rebuild_workers > 0:
+            self.rebuild(rebuild_workers, rebuild_shard_size)
         stats = self._db.get_stats()
         self._wait_for_blockchain_sync()
         self._ensure_blocks_collection_in_sync(stats["last"])
@@ -1374,14 +3586,18 @@ class Daemon(object):
         # self.rollback_to_height(2972177)
         while True:
             try:
-                self._process_blocks()
+                self._process_blocks(tip_hash, announced)
+                if mempool and initial_sync_done:
+                    self.sync_mempool()
                 self._run_peers_sync()
                 #self._run_markets_sync()
             except ReorgException:
+                tip_hash = None
                 continue
             except Exception as err:
                 logger.exception("got exception processing blocks")
-            time.sleep(10)
+            tip_hash = follower.wait()
+            announced = time.time() if tip_hash is not None else None
             if count % 100 == 0:
                 self._run_proposals_sync()
                 count = 0
@@ -1403,5 +3619,9 @@ if __name__ == "__main__":
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    daemon = Daemon(args.explorer_config)
-    daemon.run()
+    daemon = Daemon(args.explorer_config, args.prefetch_workers,
+                    args.decode_workers)
+    daemon.run(args.rebuild_workers, args.rebuild_shard_size, args.follow,
+               args.notify_port, args.poll_interval, args.mempool,
+               args.metrics_port, args.metrics_file, args.profile,
+               args.profile_flushes, args.profile_memory)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""What the sync guarantees about the data it writes: a batch written
+again counts once, a rewind restores the balances from before the
+rolled back blocks, a flush interrupted by a crash is finished by the
+next sync, and a rebuild gives the same result as a serial sync.
+
+The blocks come from the synthetic chain of the benchmarks. mongomock
+cannot run the updates with array filters the sync relies on, so these
+need a mongod. They sync into throwaway databases with the mongo
+settings of the settings.json given by EXPLORER_SYNC_TEST_CONFIG, and
+are skipped without it:
+
+    EXPLORER_SYNC_TEST_CONFIG=$HOME/explorer/settings.json \\
+        python3 -m unittest discover -s tests
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.insert(0, os.path.join(here, "..", "benchmarks"))
+import explorer_sync
+from replay import make_daemon
+from standin import StandIn
+from synthetic import SyntheticChain
+
+# only defined when the sync runs as a script
+explorer_sync.logger = logging.getLogger("explorer_sync")
+
+CONFIG = os.environ.get("EXPLORER_SYNC_TEST_CONFIG")
+DATABASE = "explorer-sync-test"
+
+# what the web tier reads, sorted by these fields. The ids of the
+# first ones are generated by mongo.
+COLLECTIONS = (
+    ("addresses", ("a_id",)),
+    ("tokens", ("t_id",)),
+    ("token_balances", ("t_id", "a_id")),
+    ("address_txs", ("a_id", "blockindex", "txid")),
+    ("distribution", ("coin",)),
+    ("txes", ("_id",)),
+    ("token_transfers", ("_id",)),
+    ("utxos", ("_id",)),
+    ("votes", ("_id",)),
+)
+GENERATED_IDS = ("addresses", "tokens", "token_balances", "address_txs",
+                 "distribution")
+# bookkeeping of the sync, not part of the data
+IGNORED = ("batch", "holders_batch")
+
+
+class Crash(Exception):
+    """Stands in for the process being killed"""
+
+
+def strip(doc):
+    if isinstance(doc, dict):
+        return dict((k, strip(v)) for k, v in doc.items()
+                    if k not in IGNORED)
+    if isinstance(doc, list):
+        return [strip(i) for i in doc]
+    return doc
+
+
+def snapshot(daemon):
+    db = daemon._db.db
+    data = {}
+    for name, key in COLLECTIONS:
+        docs = [strip(doc) for doc in db[name].find()]
+        if name in GENERATED_IDS:
+            for doc in docs:
+                del doc["_id"]
+        data[name] = sorted(docs, key=lambda d: [str(d.get(k)) for k in key])
+    data["last"] = daemon._db.get_stats()["last"]
+    return data
+
+
+def balances(data):
+    """data without what a rollback leaves behind on purpose: entries
+    emptied by it are kept at zero, and the top shares of the
+    distribution wait for the next richlist update"""
+    data = dict(data)
+    addresses = []
+    for doc in data["addresses"]:
+        doc = dict(doc, tokens=[t for t in doc["tokens"] if t["amount"]])
+        if doc["received"] or doc["sent"] or doc["tokens"]:
+            addresses.append(doc)
+    data["addresses"] = addresses
+    data["token_balances"] = [
+        doc for doc in data["token_balances"]
+        if doc["received"] or doc["sent"]]
+    data["distribution"] = [
+        dict((k, v) for k, v in doc.items() if k != "top")
+        for doc in data["distribution"]]
+    return data
+
+
+@unittest.skipUnless(CONFIG, "EXPLORER_SYNC_TEST_CONFIG is not set")
+class DataPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self._workdir = tempfile.mkdtemp(prefix="explorer-sync-test-")
+        self._cwd = os.getcwd()
+        self._standins = []
+        self._daemons = []
+
+    def tearDown(self):
+        for daemon in self._daemons:
+            daemon._db._db_conn.drop_database(daemon._db.db.name)
+        for standin in self._standins:
+            standin.close()
+        os.chdir(self._cwd)
+        shutil.rmtree(self._workdir)
+
+    def daemon(self, chain, database=DATABASE, max_blocks=20):
+        """A Daemon syncing chain into an empty database, in batches of
+        max_blocks"""
+        standin = StandIn(chain)
+        self._standins.append(standin)
+        args = argparse.Namespace(
+            explorer_config=os.path.abspath(CONFIG), database=database,
+            max_blocks=max_blocks, prefetch_workers=0, decode_workers=0)
+        workdir = tempfile.mkdtemp(dir=self._workdir)
+        daemon = make_daemon(args, standin, workdir, 1)
+        self._daemons.append(daemon)
+        return daemon
+
+    @staticmethod
+    def chain(height):
+        return SyntheticChain(height, addresses=300, txs_per_block=6)
+
+    def synced(self, height):
+        """What a plain sync of the chain up to height gives"""
+        daemon = self.daemon(self.chain(height), DATABASE + "-reference")
+        daemon._process_blocks()
+        return snapshot(daemon)
+
+    def test_batch_written_again_counts_once(self):
+        daemon = self.daemon(self.chain(120))
+        commit = daemon._commit_batch
+
+        def commit_twice(*args):
+            commit(*args)
+            return commit(*args)
+        daemon._commit_batch = commit_twice
+        daemon._process_blocks()
+        self.assertEqual(snapshot(daemon), self.synced(120))
+
+    def test_interrupted_flush_is_finished_by_the_next_sync(self):
+        expected = self.synced(120)
+        # the third batch is interrupted once its tokens were written,
+        # before or after its addresses
+        for written in (False, True):
+            with self.subTest(addresses_written=written):
+                daemon = self.daemon(
+                    self.chain(120), "%s-%s" % (DATABASE, written))
+                db = daemon._db
+                apply_address_deltas = db.apply_address_deltas
+                calls = []
+
+                def crash(*args, **kwargs):
+                    calls.append(None)
+                    if len(calls) < 3:
+                        return apply_address_deltas(*args, **kwargs)
+                    if written:
+                        apply_address_deltas(*args, **kwargs)
+                    raise Crash()
+                db.apply_address_deltas = crash
+                with self.assertRaises(Crash):
+                    daemon._process_blocks()
+                checkpoint = db.get_checkpoint()
+                self.assertFalse(checkpoint["done"])
+                self.assertEqual(
+                    db.get_stats()["last"], checkpoint["start"] - 1)
+                db.apply_address_deltas = apply_address_deltas
+                daemon._utxos.clear()
+                daemon._process_blocks()
+                self.assertTrue(db.get_checkpoint()["done"])
+                self.assertEqual(snapshot(daemon), expected)
+
+    def test_rewind_restores_the_balances(self):
+        chain = self.chain(100)
+        daemon = self.daemon(chain)
+        daemon._process_blocks()
+        before = snapshot(daemon)
+        chain.advance(5)
+        daemon._process_blocks()
+        self.assertEqual(daemon._db.get_stats()["last"], 105)
+        # the last 5 blocks are replaced by as many others
+        chain.reorg(5, 0)
+        fork = daemon.rewind(0)
+        self.assertEqual(fork["height"], 100)
+        self.assertEqual(balances(snapshot(daemon)), balances(before))
+
+    def test_rebuild_gives_the_same_result_as_a_serial_sync(self):
+        # the rebuild stops REBUILD_TIP_DISTANCE blocks below the tip
+        height = 150
+        daemon = self.daemon(
+            self.chain(height + explorer_sync.REBUILD_TIP_DISTANCE))
+        daemon.rebuild(workers=3, shard_size=25)
+        self.assertEqual(snapshot(daemon), self.synced(height))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Tip followers: what is accepted as an announced block hash and when
+a wait counts as an announcement.
+
+    python3 -m unittest discover -s tests
+"""
+
+import logging
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import explorer_sync
+from explorer_sync import (JSONRPCException, TipListener, TipLongPoller,
+                           TipPoller)
+
+# only defined when the sync runs as a script
+explorer_sync.logger = logging.getLogger("explorer_sync")
+
+HASH_A = "a" * 64
+HASH_B = "0123456789abcdef" * 4
+
+
+class FakeSender(object):
+    """Stands in for -blocknotify, sends datagrams to a listener"""
+
+    def __init__(self, listener):
+        self._addr = listener._sock.getsockname()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        self._sock.sendto(data, self._addr)
+
+    def close(self):
+        self._sock.close()
+
+
+class FakeConn(object):
+    """Answers waitfornewblock with the tips it was given"""
+
+    def __init__(self, *tips):
+        self._tips = list(tips)
+
+    def waitfornewblock(self, timeout):
+        tip = self._tips.pop(0)
+        if isinstance(tip, Exception):
+            raise tip
+        return {"hash": tip, "height": 1}
+
+
+class TipPollerTest(unittest.TestCase):
+
+    def test_never_knows_the_tip(self):
+        self.assertIsNone(TipPoller(0).wait())
+
+
+class TipListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = TipListener(0, interval=0.2)
+        self.sender = FakeSender(self.listener)
+
+    def tearDown(self):
+        self.sender.close()
+        self.listener.close()
+
+    def test_hash(self):
+        self.sender.send(HASH_A + "\n")
+        self.assertEqual(self.listener.wait(), HASH_A)
+
+    def test_hash_is_lowercased(self):
+        self.sender.send(HASH_B.upper())
+        self.assertEqual(self.listener.wait(), HASH_B)
+
+    def test_timeout(self):
+        self.assertIsNone(self.listener.wait())
+
+    def test_garbage_is_ignored(self):
+        for data in ("", "hello", HASH_A[:63], HASH_A + "0", "g" * 64,
+                     b"\xff" * 64, HASH_A + " " + HASH_B):
+            self.sender.send(data)
+        self.assertIsNone(self.listener.wait())
+
+    def test_hash_after_garbage(self):
+        self.sender.send("not a hash")
+        self.sender.send(HASH_A)
+        self.assertEqual(self.listener.wait(), HASH_A)
+
+    def test_latest_hash_wins(self):
+        self.sender.send(HASH_A)
+        self.sender.send(HASH_B)
+        self.sender.send("trailing garbage")
+        self.assertEqual(self.listener.wait(), HASH_B)
+        self.assertIsNone(self.listener.wait())
+
+
+class TipLongPollerTest(unittest.TestCase):
+
+    def poller(self, *tips):
+        poller = TipLongPoller("http://unused", interval=0)
+        poller._conn = FakeConn(*tips)
+        return poller
+
+    def test_unchanged_tip_is_not_an_announcement(self):
+        poller = self.poller(HASH_A, HASH_A, HASH_B, HASH_B)
+        # the first answer only tells the tip being waited on
+        self.assertIsNone(poller.wait())
+        self.assertIsNone(poller.wait())
+        self.assertEqual(poller.wait(), HASH_B)
+        self.assertIsNone(poller.wait())
+
+    def test_falls_back_to_polling(self):
+        poller = self.poller(
+            JSONRPCException({"code": -32601, "message": "Method not found"}))
+        self.assertIsNone(poller.wait())
+        self.assertIsNone(poller.wait())
+        self.assertFalse(poller._supported)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,17 @@ var mongoose = require('mongoose')
   , Stats = require('../models/stats')
   , Markets = require('../models/markets')
   , Address = require('../models/address')
+  , AddressTx = require('../models/addresstx')
   , Tx = require('../models/tx')
   , Token = require('../models/token')
+  , TokenBalance = require('../models/tokenbalance')
+  , TokenTransfer = require('../models/tokentransfer')
   , Vote = require('../models/vote')
   , Proposal = require('../models/proposal')
   , Richlist = require('../models/richlist')
+  , Distribution = require('../models/distribution')
+  , Utxo = require('../models/utxo')
+  , Mempool = require('../models/mempool')
   , Peers = require('../models/peers')
   , Heavy = require('../models/heavy')
   , lib = require('./explorer')
@@ -32,6 +38,25 @@ function find_address(hash, cb) {
   });
 }
 
+// latest count entries of the history of an address, older than
+// before ({blockindex, txid}) if given
+function find_address_txs(hash, count, before, cb) {
+  var query = {a_id: hash};
+  if (before) {
+    query.$or = [
+      {blockindex: {$lt: before.blockindex}},
+      {blockindex: before.blockindex, txid: {$lt: before.txid}}
+    ];
+  }
+  AddressTx.find(query).sort({blockindex: -1, txid: -1}).limit(count).lean().exec(function(err, txs) {
+    if(txs) {
+      return cb(txs);
+    } else {
+      return cb([]);
+    }
+  });
+}
+
 function find_token(tokenId, cb) {
   Token.findOne({t_id:tokenId}, function(err, token) {
     if(token) {
@@ -93,6 +118,36 @@ function find_block_votes_by_address(address, cb) {
 
 
 
+function find_address_utxos(address, cb) {
+  Utxo.find({address: address, spent: null}).sort({height: 'desc'}).exec(function(err, utxos) {
+    if(utxos) {
+      return cb(utxos);
+    } else {
+      return cb([]);
+    }
+  });
+}
+
+function find_mempool_tx(txid, cb) {
+  Mempool.findOne({_id: txid}, function(err, tx) {
+    if(tx) {
+      return cb(tx);
+    } else {
+      return cb(null);
+    }
+  });
+}
+
+function find_address_mempool(address, cb) {
+  Mempool.find({addresses: address}).sort({timestamp: 'desc'}).exec(function(err, txs) {
+    if(txs) {
+      return cb(txs);
+    } else {
+      return cb([]);
+    }
+  });
+}
+
 function find_richlist(coin, cb) {
   Richlist.findOne({coin: coin}, function(err, richlist) {
     if(richlist) {
@@ -514,6 +569,46 @@ module.exports = {
     });
   },
 
+  // history of an address, newest first. Addresses synced before the
+  // history got its own collection fall back to the embedded txs.
+  get_address_txs: function(address, count, before, cb) {
+    find_address_txs(address.a_id, count, before, function(txs) {
+      if (txs.length > 0 || before || !address.txs) {
+        return cb(txs);
+      }
+      return cb(address.txs.slice(-count).reverse().map(function(tx) {
+        return {a_id: address.a_id, txid: tx.addresses, type: tx.type};
+      }));
+    });
+  },
+
+  // txs by txid, in the order of txids
+  get_txs_by_id: function(txids, cb) {
+    Tx.find({txid: {$in: txids}}, function(err, txs) {
+      var by_id = {};
+      for (var i = 0; txs && i < txs.length; i++) {
+        by_id[txs[i].txid] = txs[i];
+      }
+      return cb(txids.filter(function(txid) {
+        return by_id[txid];
+      }).map(function(txid) {
+        return by_id[txid];
+      }));
+    });
+  },
+
+  get_address_utxos: function(hash, cb) {
+    find_address_utxos(hash, function(utxos){
+      return cb(utxos);
+    });
+  },
+
+  get_address_mempool: function(hash, cb) {
+    find_address_mempool(hash, function(txs){
+      return cb(txs);
+    });
+  },
+
   count_addresses: function(cb) {
     Address.count({}, function (err, count) {
       if(count) {
@@ -566,6 +661,12 @@ module.exports = {
     });
   },
 
+  get_mempool_tx: function(txid, cb) {
+    find_mempool_tx(txid, function(tx){
+      return cb(tx);
+    });
+  },
+
   get_txs: function(block, cb) {
     var txs = [];
     if (!(block && block.tx)) return cb(txs);
@@ -639,6 +740,28 @@ module.exports = {
     });
   },
 
+  // top count holders of a token, from the (t_id, amount) index
+  get_token_holders: function(tokenId, count, cb) {
+    TokenBalance.find({t_id: tokenId, amount: {$gt: 0}}).sort({amount: -1}).limit(count).lean().exec(function(err, holders) {
+      if (holders) {
+        return cb(holders);
+      } else {
+        return cb([]);
+      }
+    });
+  },
+
+  // latest count transfers of a token, from the (t_id, height) index
+  get_token_transfers: function(tokenId, count, cb) {
+    TokenTransfer.find({t_id: tokenId}).sort({height: -1}).limit(count).lean().exec(function(err, transfers) {
+      if (transfers) {
+        return cb(transfers);
+      } else {
+        return cb([]);
+      }
+    });
+  },
+
   get_tokens: function(cb) {
     Token.find({}).sort({first_block: 'desc'}).exec(function(err, tokens) {
       if (err) {
@@ -785,30 +908,8 @@ module.exports = {
       t_76_100: {percent: 0, total: 0 },
       t_101plus: {percent: 0, total: 0 }
     };
-    lib.syncLoop(richlist.balance.length, function (loop) {
-      var i = loop.iteration();
-      var count = i + 1;
-      var percentage = ((richlist.balance[i].balance / 100000000) / stats.supply) * 100;
-      // skipping entry 0, the burn address
-      // skipping entry 1, the binance address
-      if (count <= 25 && i > 1) {
-        distribution.t_1_25.percent = distribution.t_1_25.percent + percentage;
-        distribution.t_1_25.total = distribution.t_1_25.total + (richlist.balance[i].balance / 100000000);
-      }
-      if (count <= 50 && count > 25) {
-        distribution.t_26_50.percent = distribution.t_26_50.percent + percentage;
-        distribution.t_26_50.total = distribution.t_26_50.total + (richlist.balance[i].balance / 100000000);
-      }
-      if (count <= 75 && count > 50) {
-        distribution.t_51_75.percent = distribution.t_51_75.percent + percentage;
-        distribution.t_51_75.total = distribution.t_51_75.total + (richlist.balance[i].balance / 100000000);
-      }
-      if (count <= 100 && count > 75) {
-        distribution.t_76_100.percent = distribution.t_76_100.percent + percentage;
-        distribution.t_76_100.total = distribution.t_76_100.total + (richlist.balance[i].balance / 100000000);
-      }
-      loop.next();
-    }, function(){
+    var groups = ['t_1_25', 't_26_50', 't_51_75', 't_76_100'];
+    var finish = function() {
       distribution.t_101plus.percent = parseFloat(100 - distribution.t_76_100.percent - distribution.t_51_75.percent - distribution.t_26_50.percent - distribution.t_1_25.percent).toFixed(2);
       distribution.t_101plus.total = parseFloat(distribution.supply - distribution.t_76_100.total - distribution.t_51_75.total - distribution.t_26_50.total - distribution.t_1_25.total).toFixed(8);
       distribution.t_1_25.percent = parseFloat(distribution.t_1_25.percent).toFixed(2);
@@ -820,6 +921,51 @@ module.exports = {
       distribution.t_76_100.percent = parseFloat(distribution.t_76_100.percent).toFixed(2);
       distribution.t_76_100.total = parseFloat(distribution.t_76_100.total).toFixed(8);
       return cb(distribution);
+    };
+    // precomputed by the sync
+    Distribution.findOne({coin: settings.coin}).lean().exec(function(err, dist) {
+      if (dist && dist.top) {
+        for (var g = 0; g < groups.length; g++) {
+          var total = (dist.top[groups[g]] || 0) / 100000000;
+          distribution[groups[g]].total = total;
+          distribution[groups[g]].percent = (total / stats.supply) * 100;
+        }
+        distribution.holders = dist.holders;
+        distribution.bands = dist.bands.map(function(band) {
+          return {
+            min: band.min / 100000000,
+            max: band.max == null ? null : band.max / 100000000,
+            holders: band.holders,
+            total: parseFloat(band.balance / 100000000).toFixed(8),
+            percent: parseFloat(((band.balance / 100000000) / stats.supply) * 100).toFixed(2)
+          };
+        });
+        return finish();
+      }
+      lib.syncLoop(richlist.balance.length, function (loop) {
+        var i = loop.iteration();
+        var count = i + 1;
+        var percentage = ((richlist.balance[i].balance / 100000000) / stats.supply) * 100;
+        // skipping entry 0, the burn address
+        // skipping entry 1, the binance address
+        if (count <= 25 && i > 1) {
+          distribution.t_1_25.percent = distribution.t_1_25.percent + percentage;
+          distribution.t_1_25.total = distribution.t_1_25.total + (richlist.balance[i].balance / 100000000);
+        }
+        if (count <= 50 && count > 25) {
+          distribution.t_26_50.percent = distribution.t_26_50.percent + percentage;
+          distribution.t_26_50.total = distribution.t_26_50.total + (richlist.balance[i].balance / 100000000);
+        }
+        if (count <= 75 && count > 50) {
+          distribution.t_51_75.percent = distribution.t_51_75.percent + percentage;
+          distribution.t_51_75.total = distribution.t_51_75.total + (richlist.balance[i].balance / 100000000);
+        }
+        if (count <= 100 && count > 75) {
+          distribution.t_76_100.percent = distribution.t_76_100.percent + percentage;
+          distribution.t_76_100.total = distribution.t_76_100.total + (richlist.balance[i].balance / 100000000);
+        }
+        loop.next();
+      }, finish);
     });
   },
   // updates heavy stats for coin
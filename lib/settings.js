@@ -135,6 +135,13 @@ exports.genesis_block = "b2926a56ca64e0cd2430347e383f63ad7092f406088b9b86d6d68c2
 exports.heavy = false;
 exports.network = "mainnet";
 exports.txcount = 100;
+// only read by iquidus-sync, same as settings.json.template. "max_blocks"
+// can also be set to cap the number of blocks per commit
+exports.sync_flush = {
+  "max_txs": 100000,
+  "max_bytes": 536870912,
+  "max_seconds": 300
+};
 exports.show_sent_received = true;
 exports.supply = "COINBASE";
 exports.nethash = "getnetworkhashps";
@@ -0,0 +1,17 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+
+// address history, one document per address and tx, written by
+// iquidus-sync. type is vin or vout, the way the address shows up in
+// the tx.
+var AddressTxSchema = new Schema({
+  a_id: { type: String },
+  blockindex: { type: Number, default: 0 },
+  txid: { type: String, lowercase: true },
+  blockhash: { type: String, index: true },
+  type: { type: String },
+}, {id: false});
+
+AddressTxSchema.index({a_id: 1, blockindex: -1, txid: -1}, {unique: true});
+
+module.exports = mongoose.model('AddressTx', AddressTxSchema, 'address_txs');
@@ -0,0 +1,19 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+
+// wealth distribution, kept up to date by iquidus-sync. Balances are
+// in satoshis, bands hold the addresses with min <= balance < max.
+var DistributionSchema = new Schema({
+  coin: { type: String },
+  bands: { type: Array, default: [] },
+  holders: { type: Number, default: 0 },
+  balance: { type: Number, default: 0 },
+  top: { type: Object, default: {} },
+}, {id: false});
+
+module.exports = mongoose.model('Distribution', DistributionSchema, 'distribution');
+
+/*
+bands : [{ min: 0, max: 100000, holders: 0, balance: 0 }]
+top : { t_1_25: 0, t_26_50: 0, t_51_75: 0, t_76_100: 0 }
+*/
@@ -0,0 +1,18 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+
+// unconfirmed txs, written by iquidus-sync --mempool
+var MempoolSchema = new Schema({
+  _id: { type: String },
+  txid: { type: String, lowercase: true, index: true},
+  vin: { type: Array, default: [] },
+  vout: { type: Array, default: [] },
+  total: { type: Number, default: 0 },
+  has_token: { type: Boolean, default: false },
+  timestamp: { type: Number, default: 0 },
+  blockhash: { type: String, default: '-' },
+  blockindex: {type: Number, default: -1},
+  addresses: { type: Array, default: [], index: true },
+}, {id: false});
+
+module.exports = mongoose.model('Mempool', MempoolSchema, 'mempool');
@@ -0,0 +1,16 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+
+// amount of a token held by an address, written by iquidus-sync
+var TokenBalanceSchema = new Schema({
+  t_id: { type: String },
+  a_id: { type: String },
+  sent: { type: Number, default: 0 },
+  received: { type: Number, default: 0 },
+  amount: { type: Number, default: 0 },
+}, {id: false});
+
+TokenBalanceSchema.index({t_id: 1, a_id: 1}, {unique: true});
+TokenBalanceSchema.index({t_id: 1, amount: -1});
+
+module.exports = mongoose.model('TokenBalance', TokenBalanceSchema, 'token_balances');
@@ -0,0 +1,19 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+
+// one document per token output, written by iquidus-sync. from is the
+// first input holding the token, null for issuance.
+var TokenTransferSchema = new Schema({
+  _id: { type: String },
+  t_id: { type: String },
+  txid: { type: String, lowercase: true },
+  height: { type: Number, default: 0 },
+  blockhash: { type: String, index: true },
+  from: { type: String, default: null },
+  to: { type: String },
+  amount: { type: Number, default: 0 },
+}, {id: false});
+
+TokenTransferSchema.index({t_id: 1, height: -1});
+
+module.exports = mongoose.model('TokenTransfer', TokenTransferSchema, 'token_transfers');
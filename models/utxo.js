@@ -0,0 +1,15 @@
+var mongoose = require('mongoose')
+  , Schema = mongoose.Schema;
+ 
+var UtxoSchema = new Schema({
+  _id: { type: String },
+  address: { type: String, index: true},
+  amount: { type: Number, default: 0 },
+  is_cold_stake: { type: Boolean, default: false },
+  tokens: { type: Array, default: [] },
+  blockhash: { type: String, index: true},
+  height: { type: Number, default: 0 },
+  spent: { type: Object, default: null },
+}, {id: false});
+
+module.exports = mongoose.model('Utxo', UtxoSchema);
@@ -55,7 +55,13 @@ function route_get_tx(res, txid) {
         });
       }
       else {
-        route_get_index(res, 'TX not found: ' + txid);
+        db.get_mempool_tx(txid, function(utx) {
+          if (utx) {
+            res.render('tx', { active: 'tx', tx: utx, confirmations: settings.confirmations, blockcount: -1});
+          } else {
+            route_get_index(res, 'TX not found: ' + txid);
+          }
+        });
         // lib.get_rawtransaction(txid, function(rtx) {
         //   if (rtx.txid) {
         //     lib.prepare_vin(rtx, function(vin) {
@@ -102,7 +108,13 @@ function route_get_index(res, error) {
   res.render('index', { active: 'home', error: error, warning: null});
 }
 
-function route_get_address(res, hash, count) {
+// before: "blockindex:txid" of the last entry of the previous page
+function route_get_address(res, hash, count, before) {
+  count = parseInt(count);
+  if (before) {
+    var cursor = before.split(':');
+    before = {blockindex: parseInt(cursor[0]), txid: cursor[1]};
+  }
   db.get_address(hash, function(address) {
     if (address) {
       var txs = [];
@@ -127,23 +139,15 @@ function route_get_address(res, hash, count) {
         } else {
           block_votes = {}
         }
-        var hashes = address.txs.reverse();
-        if (address.txs.length < count) {
-          count = address.txs.length;
-        }
-        lib.syncLoop(count, function (loop) {
-          var i = loop.iteration();
-          db.get_tx(hashes[i].addresses, function(tx) {
-            if (tx) {
-              txs.push(tx);
-              loop.next();
-            } else {
-              loop.next();
-            }
+        db.get_address_txs(address, count, before, function(history) {
+          var older = null;
+          var last = history[history.length - 1];
+          if (history.length == count && last.blockindex != null) {
+            older = '/address/' + hash + '/' + count + '?before=' + last.blockindex + ':' + last.txid;
+          }
+          db.get_txs_by_id(history.map(function(entry) { return entry.txid; }), function(txs) {
+            res.render('address', { active: 'address', address: address, txs: txs, votes: block_votes, older: older});
           });
-        }, function(){
-
-          res.render('address', { active: 'address', address: address, txs: txs, votes: block_votes});
         });
       });
     } else {
@@ -155,7 +159,11 @@ function route_get_address(res, hash, count) {
 function route_get_token(res, tokenId) {
   db.get_token(tokenId, function(token) {
     if (token) {
-      res.render('token', {active: 'token', token: token});
+      db.get_token_holders(tokenId, settings.txcount, function(holders) {
+        db.get_token_transfers(tokenId, settings.txcount, function(transfers) {
+          res.render('token', {active: 'token', token: token, holders: holders, transfers: transfers});
+        });
+      });
     } else {
       route_get_index(res, tokenId + ' not found');
     }
@@ -343,11 +351,11 @@ router.get('/block/:hash', function(req, res) {
 });
 
 router.get('/address/:hash', function(req, res) {
-  route_get_address(res, req.param('hash'), settings.txcount);
+  route_get_address(res, req.param('hash'), settings.txcount, req.query.before);
 });
 
 router.get('/address/:hash/:count', function(req, res) {
-  route_get_address(res, req.param('hash'), req.param('count'));
+  route_get_address(res, req.param('hash'), req.param('count'), req.query.before);
 });
 
 router.post('/search', function(req, res) {